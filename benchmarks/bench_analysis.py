@@ -0,0 +1,233 @@
+"""
+Scaling benchmarks of the public analysis functions
+
+Runs indicators, univariate, multivariate, geo and loading functions on
+generated data, growing the number of rows, clinics and variables one at
+a time, and reports time, peak memory and the log-log scaling slope of
+every function. Without --save-baseline the results are compared with
+the baseline and the exit status is 1 if a function got slower or uses
+more memory than the baseline allows. Baselines are machine specific,
+save one before changing the code. A missing baseline is an error, pass
+--no-baseline to only measure.
+
+Usage:
+    python benchmarks/bench_analysis.py [--full] [--rows 10000,100000]
+        [--clinics 50,500] [--variables 20,100] [--only indicators]
+        [--baseline benchmarks/baseline.json] [--save-baseline]
+        [--no-baseline]
+        [--tolerance 0.5] [--output results.json] [--plot curves.png]
+"""
+import os
+import sys
+import argparse
+import tempfile
+import warnings
+
+import harness
+from meerkat_analysis import (util, indicators, univariate, multivariate,
+                              geo, synthetic)
+
+QUICK = {"rows": [10000, 100000], "clinics": [50, 500],
+         "variables": [20, 100]}
+FULL = {"rows": [10000, 100000, 1000000, 10000000],
+        "clinics": [50, 500, 5000], "variables": [20, 100, 400]}
+START = "2016-01-01"
+END = "2017-12-31"
+
+
+class Context:
+    """
+    The generated data of one size
+    """
+
+    def __init__(self, size, directory):
+        self.size = size
+        self.directory = directory
+        locations = synthetic.make_locations(size["clinics"],
+                                             start_date=START, end_date=END)
+        variables = synthetic.make_variables(size["variables"])
+        self.locations = util.Locations(locations)
+        self.variables = util.Variables(variables)
+        self.data = synthetic.generate_data(locations, variables,
+                                            size["rows"], START, END)
+        self.diseases = sorted(self.variables.groups["disease"])
+        self._export = None
+
+    def fresh(self):
+        """
+        Returns the data without cached derived columns
+        """
+        return self.data.copy(deep=False)
+
+    def export(self):
+        """
+        Returns the filename of the data written as a structured export
+        """
+        if self._export is None:
+            self._export = os.path.join(self.directory, "export.csv")
+            synthetic.write_export(self._export,
+                                   self.locations.locations,
+                                   self.variables.variables,
+                                   self.size["rows"], START, END)
+        return self._export
+
+
+def case(name, axes=("rows", "clinics", "variables")):
+    def decorator(setup):
+        CASES.append(harness.Case(name, setup, axes))
+        return setup
+    return decorator
+
+
+CASES = []
+
+
+@case("indicators.count", axes=("rows", "clinics"))
+def bench_count(context):
+    data = context.fresh()
+    return lambda: indicators.count(data, "dis_1", START, END)
+
+
+@case("indicators.count_over_count", axes=("rows", "clinics"))
+def bench_count_over_count(context):
+    data = context.fresh()
+    return lambda: indicators.count_over_count(data, "dis_1", "gen_1",
+                                               START, END)
+
+
+@case("indicators.number_per_week_clinic", axes=("rows", "clinics"))
+def bench_number_per_week_clinic(context):
+    data = context.fresh()
+    return lambda: indicators.number_per_week_clinic(
+        data, "dis_1", context.locations, START, END)
+
+
+@case("indicators.number_of_sites", axes=("rows", "clinics"))
+def bench_number_of_sites(context):
+    data = context.fresh()
+    return lambda: indicators.number_of_sites(data, "clinic", START, END)
+
+
+@case("univariate.breakdown_by_category")
+def bench_breakdown_by_category(context):
+    data = context.fresh()
+    return lambda: univariate.breakdown_by_category(context.variables,
+                                                    "disease", data)
+
+
+@case("univariate.incidence_rate", axes=("rows",))
+def bench_incidence_rate(context):
+    data = context.fresh()
+    return lambda: univariate.incidence_rate(data, population=1000000,
+                                             var_id="dis_1")
+
+
+@case("multivariate.cross_table")
+def bench_cross_table(context):
+    data = context.fresh()
+    return lambda: multivariate.cross_table(context.variables, "age",
+                                            "disease", data)
+
+
+@case("multivariate.incidence_rate_by_category", axes=("rows",))
+def bench_incidence_rate_by_category(context):
+    data = context.fresh()
+    return lambda: multivariate.incidence_rate_by_category(
+        data, "age", context.variables, var_id="dis_1")
+
+
+@case("multivariate.incidence_rate_by_location", axes=("rows", "clinics"))
+def bench_incidence_rate_by_location(context):
+    data = context.fresh()
+    return lambda: multivariate.incidence_rate_by_location(
+        data, "district", context.locations, context.variables,
+        var_id="dis_1")
+
+
+@case("multivariate.odds_ratio_many")
+def bench_odds_ratio_many(context):
+    data = context.fresh()
+    return lambda: multivariate.odds_ratio_many(data, context.diseases,
+                                                ("gen_1", "gen_2"))
+
+
+@case("geo.incidence_rate_by_location", axes=("rows", "clinics"))
+def bench_geo_incidence_rate_by_location(context):
+    data = context.fresh()
+    return lambda: geo.incidence_rate_by_location(data, context.locations,
+                                                  "dis_1")
+
+
+@case("geo.smoothed_rates")
+def bench_smoothed_rates(context):
+    data = context.fresh()
+    return lambda: geo.smoothed_rates(data, context.locations,
+                                      context.diseases)
+
+
+@case("util.load_structured_data", axes=("rows", "variables"))
+def bench_load_structured_data(context):
+    filename = context.export()
+    return lambda: util.load_structured_data(filename, context.variables)
+
+
+def parse_sizes(arguments):
+    sizes = dict(FULL if arguments.full else QUICK)
+    for axis in sizes:
+        value = getattr(arguments, axis)
+        if value:
+            sizes[axis] = [int(v) for v in value.split(",")]
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--full", action="store_true",
+                        help="10k to 10M rows, 50 to 5000 clinics and 20 "
+                        "to 400 variables")
+    for axis in QUICK:
+        parser.add_argument("--" + axis, help="comma separated sizes")
+    parser.add_argument("--only", default="",
+                        help="only cases with names containing this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--no-baseline", action="store_true",
+                        help="do not compare with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--output")
+    parser.add_argument("--plot")
+    arguments = parser.parse_args(argv)
+    compare = not (arguments.save_baseline or arguments.no_baseline)
+    if compare and not os.path.exists(arguments.baseline):
+        parser.error("No baseline at {}, save one with --save-baseline or "
+                     "pass --no-baseline".format(arguments.baseline))
+    warnings.simplefilter("ignore", FutureWarning)
+
+    cases = [c for c in CASES if arguments.only in c.name]
+    with tempfile.TemporaryDirectory() as directory:
+        results = harness.run(cases, parse_sizes(arguments),
+                              lambda size: Context(size, directory),
+                              arguments.repeat)
+    print()
+    for (name, axis), slope in sorted(harness.scaling(results).items()):
+        print("{:<45} {:>10} slope {:5.2f}".format(name, axis, slope))
+    if arguments.output:
+        harness.save(results, arguments.output)
+    if arguments.plot:
+        harness.plot(results, arguments.plot)
+    if arguments.save_baseline:
+        harness.save(results, arguments.baseline)
+        return 0
+    if not compare:
+        return 0
+    regressions = harness.compare(results, harness.load(arguments.baseline),
+                                  arguments.tolerance)
+    for key, what, old, new in regressions:
+        print("REGRESSION {} {}: {:.4g} -> {:.4g}".format(key, what, old, new))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
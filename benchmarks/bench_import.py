@@ -0,0 +1,75 @@
+"""
+Benchmarks the import time of meerkat_analysis
+
+Every import runs in a fresh interpreter. Reports the best wall time,
+whether matplotlib was loaded and the slowest imported packages.
+
+Usage:
+    python benchmarks/bench_import.py [repeat]
+"""
+import sys
+import time
+import subprocess
+
+IMPORTS = [
+    "import meerkat_analysis",
+    "from meerkat_analysis import indicators, univariate, multivariate, geo",
+    "from meerkat_analysis import indicators, univariate, multivariate, geo, "
+    "plotting; plotting.pylab()",
+]
+
+
+def import_time(statement, repeat=5):
+    """
+    Returns the best time of running statement in a new interpreter
+    minus the time of starting one, and if matplotlib was imported
+    """
+    check = "; import sys; print('matplotlib' in sys.modules)"
+    best = float("inf")
+    empty = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        empty = min(empty, time.perf_counter() - start)
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", statement + check],
+                                check=True, capture_output=True, text=True)
+        best = min(best, time.perf_counter() - start)
+    return best - empty, output.stdout.strip() == "True"
+
+
+def slowest_packages(statement, n=8):
+    """
+    Returns the top level packages with the largest cumulative import
+    time of any of their modules in microseconds from python -X importtime
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             statement], check=True, capture_output=True,
+                            text=True).stderr
+    totals = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line.split("|")
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue
+        name = parts[2].strip().split(".")[0]
+        totals[name] = max(totals.get(name, 0), cumulative)
+    return sorted(totals.items(), key=lambda item: -item[1])[:n]
+
+
+def main(repeat=5):
+    for statement in IMPORTS:
+        seconds, matplotlib = import_time(statement, repeat)
+        print("{:<75} {:6.3f} s matplotlib={}".format(statement, seconds,
+                                                      matplotlib))
+    print()
+    for name, microseconds in slowest_packages(IMPORTS[1]):
+        print("{:<30} {:6.3f} s".format(name, microseconds / 1e6))
+
+
+if __name__ == "__main__":
+    arguments = [int(a) for a in sys.argv[1:]]
+    main(*arguments)
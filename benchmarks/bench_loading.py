@@ -0,0 +1,61 @@
+"""
+Benchmarks loading of the structured export
+
+Compares a plain pd.read_csv with load_structured_data and
+read_csv_parallel on a generated export.
+
+Usage:
+    python benchmarks/bench_loading.py [rows] [variables] [workers]
+"""
+import os
+import sys
+import time
+import tempfile
+import pandas as pd
+
+from meerkat_analysis import util, synthetic
+
+
+def write_export(filename, rows, n_variables, seed=0):
+    """
+    Writes a generated structured export with n_variables diseases
+    """
+    locations = synthetic.make_locations(500, seed=seed)
+    variables = synthetic.make_variables(n_variables)
+    synthetic.write_export(filename, locations, variables, rows, seed=seed)
+    return util.Variables(variables)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def plain_read_csv(filename):
+    return pd.read_csv(filename, parse_dates=["date"], dayfirst=True).fillna(0)
+
+
+def main(rows=200000, n_variables=100, workers=None):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "export.csv")
+        variables = write_export(filename, rows, n_variables)
+        print("{} rows, {} variables, {:.1f} MB".format(
+            rows, n_variables, os.path.getsize(filename) / 1e6))
+        runs = [("pd.read_csv", plain_read_csv, (filename,), {}),
+                ("load_structured_data", util.load_structured_data,
+                 (filename, variables), {}),
+                ("read_csv_parallel", util.read_csv_parallel,
+                 (filename, variables), {"workers": workers})]
+        baseline = None
+        for name, function, args, kwargs in runs:
+            seconds, data = timed(function, *args, **kwargs)
+            baseline = baseline or seconds
+            print("{:<22} {:8.2f} s {:6.1f}x {:10.1f} MB".format(
+                name, seconds, baseline / seconds,
+                util.memory_usage(data) / 1e6))
+
+
+if __name__ == "__main__":
+    arguments = [int(a) for a in sys.argv[1:]]
+    main(*arguments)
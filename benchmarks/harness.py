@@ -0,0 +1,192 @@
+"""
+A small benchmark harness with scaling curves and baselines
+
+Every case is run at a range of sizes along each axis with the other
+axes at their smallest size. Time is the best of a few runs and peak
+memory is measured with tracemalloc in a separate run. Results are saved
+as json, compared with a stored baseline and summarised as the log-log
+slope of time against size, 1 for linear and 2 for quadratic behaviour.
+"""
+import json
+import math
+import time
+import tracemalloc
+
+
+class Case:
+    """
+    One benchmarked function
+
+    """
+
+    def __init__(self, name, setup, axes=("rows", "clinics", "variables")):
+        """
+        Args:
+            name: name of the case
+            setup: function taking a context and returning the function to
+                   time, called again before every run
+            axes: the axes the case is run along
+        """
+        self.name = name
+        self.setup = setup
+        self.axes = axes
+
+
+def measure(case, context, repeat=3):
+    """
+    Returns the best time in seconds and the peak traced memory in bytes
+    """
+    best = float("inf")
+    for i in range(repeat):
+        function = case.setup(context)
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    function = case.setup(context)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def points(sizes):
+    """
+    Returns (axis, size) for one sweep along every axis
+
+    Args:
+        sizes: dictionary of axis: list of sizes, the first is the base
+    """
+    base = {axis: values[0] for axis, values in sizes.items()}
+    ret = []
+    for axis, values in sizes.items():
+        for value in values:
+            size = dict(base)
+            size[axis] = value
+            ret.append((axis, size))
+    return ret
+
+
+def key(case, size):
+    return "{}[{}]".format(case, ",".join("{}={}".format(a, size[a])
+                                          for a in sorted(size)))
+
+
+def run(cases, sizes, make_context, repeat=3, log=print):
+    """
+    Runs all cases along all axes
+
+    Args:
+        cases: list of Case
+        sizes: dictionary of axis: list of sizes
+        make_context: function from a size dictionary to the context
+                      passed to the cases
+        repeat: number of timed runs
+        log: function called with a line per result
+    Returns:
+        list of result dictionaries
+    """
+    results = []
+    contexts = {}
+    measured = {}
+    for axis, size in points(sizes):
+        frozen = tuple(sorted(size.items()))
+        if frozen not in contexts:
+            contexts.clear()
+            contexts[frozen] = make_context(size)
+        for case in cases:
+            if axis not in case.axes:
+                continue
+            name = key(case.name, size)
+            if name not in measured:
+                measured[name] = measure(case, contexts[frozen], repeat)
+            seconds, peak = measured[name]
+            result = {"case": case.name, "axis": axis, "size": size,
+                      "key": name, "seconds": seconds, "peak": peak}
+            results.append(result)
+            log("{:<45} {:>8}={:<9} {:9.4f} s {:9.1f} MB".format(
+                case.name, axis, size[axis], seconds, peak / 1e6))
+    return results
+
+
+def scaling(results):
+    """
+    Returns the log-log slope of time against size for every case and axis
+    """
+    curves = {}
+    for r in results:
+        curves.setdefault((r["case"], r["axis"]), []).append(
+            (r["size"][r["axis"]], r["seconds"]))
+    ret = {}
+    for (case, axis), curve in curves.items():
+        curve = sorted(set(curve))
+        if len(curve) < 2:
+            continue
+        x = [math.log(s) for s, t in curve]
+        y = [math.log(max(t, 1e-9)) for s, t in curve]
+        mx = sum(x) / len(x)
+        my = sum(y) / len(y)
+        ret[(case, axis)] = (sum((a - mx) * (b - my) for a, b in zip(x, y)) /
+                             sum((a - mx) ** 2 for a in x))
+    return ret
+
+
+def compare(results, baseline, tolerance=0.5, min_seconds=0.01):
+    """
+    Returns the results that regressed compared with the baseline
+
+    Args:
+        results: list of results
+        baseline: list of results of the baseline
+        tolerance: allowed relative increase of time and peak memory
+        min_seconds: time differences below this are ignored as noise
+    Returns:
+        list of (key, what, baseline value, new value)
+    """
+    stored = {r["key"]: r for r in baseline}
+    ret = []
+    for r in {r["key"]: r for r in results}.values():
+        if r["key"] not in stored:
+            continue
+        old = stored[r["key"]]
+        if (r["seconds"] > old["seconds"] * (1 + tolerance) and
+                r["seconds"] - old["seconds"] > min_seconds):
+            ret.append((r["key"], "seconds", old["seconds"], r["seconds"]))
+        if r["peak"] > old["peak"] * (1 + tolerance) + 2**20:
+            ret.append((r["key"], "peak", old["peak"], r["peak"]))
+    return ret
+
+
+def plot(results, filename):
+    """
+    Plots the scaling curves of every axis to filename
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    axes_names = sorted(set(r["axis"] for r in results))
+    figure = Figure(figsize=(6 * len(axes_names), 5))
+    for number, axis in enumerate(axes_names):
+        ax = figure.add_subplot(1, len(axes_names), number + 1)
+        for case in sorted(set(r["case"] for r in results)):
+            curve = sorted((r["size"][axis], r["seconds"]) for r in results
+                           if r["case"] == case and r["axis"] == axis)
+            if curve:
+                ax.loglog(*zip(*curve), marker="o", label=case)
+        ax.set_xlabel(axis)
+        ax.set_ylabel("seconds")
+    ax.legend(fontsize="x-small", loc="best")
+    figure.tight_layout()
+    figure.savefig(filename)
+
+
+def save(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
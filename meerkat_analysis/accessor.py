@@ -0,0 +1,278 @@
+import numpy as np
+import pandas as pd
+
+from .prepared import date_window
+from .profiling import instrument
+
+
+def fingerprint(values):
+    """
+    Returns a cheap fingerprint of an array to detect replaced columns
+
+    The fingerprint combines the memory address, length and dtype, it
+    does not look at the values. Assigning a new column changes it, an
+    in-place edit of the values does not.
+
+    Args:
+        values: array or series
+    """
+    if isinstance(values, pd.Series):
+        values = values.values
+    if isinstance(values, pd.Categorical):
+        values = values.codes
+    values = np.asarray(values)
+    return (values.__array_interface__["data"][0], len(values),
+            values.dtype.str)
+
+
+def week_day(freq):
+    """
+    Returns the day the epi week starts on (Mon=0) from a weekly
+    frequency string such as W-MON
+    """
+    if isinstance(freq, str):
+        return pd.tseries.frequencies.to_offset(freq).weekday
+    return int(freq)
+
+
+@instrument
+def epi_weeks(dates, epi_week_start_day):
+    """
+    Returns the start of the epi week of every date
+
+    Gives the same weeks as grouping by pd.Grouper(freq=freq, label="left",
+    closed="left").
+
+    Args:
+        dates: array or series of dates
+        epi_week_start_day: day the week starts (Mon=0) or a W-XXX freq
+    Returns:
+        datetime64 array
+    """
+    days = np.asarray(dates, dtype="datetime64[ns]").astype("datetime64[D]")
+    # 1970-01-01 was a Thursday
+    weekday = (days.astype(np.int64) + 3) % 7
+    offset = (weekday - week_day(epi_week_start_day)) % 7
+    return (days - offset.astype("timedelta64[D]")).astype("datetime64[ns]")
+
+
+@instrument
+def level_ancestors(locations, level):
+    """
+    Returns a dictionary from location id to the id of its ancestor on level
+
+    Args:
+        locations: Locations class
+        level: location level
+    """
+    locs = locations.locations
+    ret = {}
+    for loc_id in locs:
+        current = str(loc_id)
+        while current in locs and locs[current]["level"] != level:
+            current = str(locs[current]["parent_location"])
+        if current in locs:
+            ret[int(loc_id)] = int(current)
+    return ret
+
+
+@pd.api.extensions.register_dataframe_accessor("meerkat")
+class MeerkatAccessor:
+    """
+    Derived columns of the structured data, computed once per frame
+
+    Available as data.meerkat after importing meerkat_analysis. Bind the
+    Variables and Locations of the data with data.meerkat.bind. Every
+    derived value is cached on the frame together with a fingerprint of
+    the columns it was derived from and recomputed if one of them was
+    replaced, e.g. by data["date"] = ... . Values are not compared, so
+    after editing the data in place, e.g. with data.loc[...] = ..., call
+    data.meerkat.clear().
+
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._cache = {}
+        self.variables = None
+        self.locations = None
+
+    def bind(self, variables=None, locations=None):
+        """
+        Binds the Variables and Locations context of the data
+
+        Args:
+            variables: Variables class
+            locations: Locations class
+        Returns:
+            the accessor
+        """
+        if variables is not None:
+            self.variables = variables
+        if locations is not None:
+            self.locations = locations
+        return self
+
+    def cached(self, key, columns, compute):
+        """
+        Returns compute() cached under key until one of columns is
+        replaced
+
+        Args:
+            key: cache key
+            columns: the columns the value is derived from
+            compute: function computing the value
+        """
+        state = tuple(fingerprint(self._data[c]) if c in self._data.columns
+                      else None for c in columns)
+        if key in self._cache and self._cache[key][0] == state:
+            return self._cache[key][1]
+        value = compute()
+        self._cache[key] = (state, value)
+        return value
+
+    def clear(self):
+        """
+        Removes all cached values, needed after editing the data in place
+        """
+        self._cache = {}
+
+    def epi_week(self, epi_week_start_day=0):
+        """
+        Returns the start of the epi week of every row
+
+        Args:
+            epi_week_start_day: day the week starts (Mon=0) or a W-XXX freq
+        Returns:
+            datetime64 array
+        """
+        day = week_day(epi_week_start_day)
+        return self.cached(("epi_week", day), ["date"],
+                           lambda: epi_weeks(self._data["date"], day))
+
+    def codes(self, column):
+        """
+        Returns integer codes and unique values of a column
+
+        Args:
+            column: column name
+        Returns:
+            (codes, uniques): missing values have code -1
+        """
+        return self.cached(("codes", column), [column],
+                           lambda: pd.factorize(self._data[column]))
+
+    def record_key(self):
+        """
+        Returns a packed int64 key of the clinic and date of every row
+
+        Rows have the same key if and only if they have the same clinic
+        and date, missing values included.
+        """
+        def compute():
+            clinic_codes, clinics = self.codes("clinic")
+            date_codes, dates = self.codes("date")
+            return ((clinic_codes.astype(np.int64) + 1) * (len(dates) + 1) +
+                    date_codes + 1)
+        return self.cached("record_key", ["clinic", "date"], compute)
+
+    def first_records(self, column):
+        """
+        Returns a boolean mask of the first row of every combination of
+        clinic, date and value of column
+
+        Equivalent to keeping the rows of drop_duplicates on clinic, date
+        and column, but only hashes one int64 key per row.
+
+        Args:
+            column: column name
+        """
+        def compute():
+            key = self.record_key()
+            codes, uniques = pd.factorize(self._data[column])
+            combined = key * (len(uniques) + 1) + codes + 1
+            return ~pd.Series(combined).duplicated().values
+        return self.cached(("first_records", column),
+                           ["clinic", "date", column], compute)
+
+    def ancestor(self, level, locations=None):
+        """
+        Returns the id of the location on level containing each row's clinic
+
+        Args:
+            level: location level
+            locations: Locations class, defaults to the bound locations
+        Returns:
+            int64 array, -1 where the clinic is unknown
+        """
+        locations = self._context("locations", locations)
+
+        def compute():
+            codes, uniques = self.codes("clinic")
+            ancestors = level_ancestors(locations, level)
+            mapped = np.array([ancestors.get(int(u), -1) if not pd.isnull(u)
+                               else -1 for u in uniques] + [-1],
+                              dtype=np.int64)
+            return mapped[codes]
+        return self.cached(("ancestor", level, id(locations)), ["clinic"],
+                           compute)
+
+    def category(self, category, variables=None):
+        """
+        Returns the position in the sorted category ids of the variable
+        present in each row
+
+        Args:
+            category: name of category
+            variables: Variables class, defaults to the bound variables
+        Returns:
+            (positions, ids): positions is -1 for rows with no variable
+        """
+        variables = self._context("variables", variables)
+        if category not in variables.groups:
+            raise KeyError("Category does not exists")
+        ids = sorted(variables.groups[category])
+
+        def compute():
+            present = [i for i in ids if i in self._data.columns]
+            positions = np.full(len(self._data), -1, dtype=np.int64)
+            if present:
+                values = (self._data[present] == 1).values
+                found = values.any(axis=1)
+                first = np.array([ids.index(i) for i in present])
+                positions[found] = first[values[found].argmax(axis=1)]
+            return positions, ids
+        return self.cached(("category", category, id(variables)), ids,
+                           compute)
+
+    def _context(self, name, value):
+        if value is None:
+            value = getattr(self, name)
+        if value is None:
+            raise KeyError("No {} bound, use data.meerkat.bind".format(name))
+        return value
+
+
+@instrument
+def weekly_window(data, start_date, end_date, freq, columns=()):
+    """
+    Returns the rows of data with start_date <= date <= end_date and the
+    start of their epi week
+
+    Epi weeks of data frames are taken from the data.meerkat cache.
+
+    Args:
+        data: data frame, SparseData, PreparedData or dataset object
+        start_date: start date
+        end_date: end date
+        freq: W-XXX frequency of the weeks
+        columns: variable columns needed from SparseData
+    Returns:
+        (data, weeks): data frame and datetime64 array
+    """
+    if isinstance(data, pd.DataFrame):
+        dates = data["date"]
+        in_window = np.asarray((dates >= start_date) & (dates <= end_date))
+        return data[in_window], data.meerkat.epi_week(freq)[in_window]
+    data = date_window(data, start_date, end_date, columns)
+    return data, epi_weeks(data["date"], freq)
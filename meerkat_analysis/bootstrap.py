@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from . import util
+from . import sparse
+from .profiling import instrument
+
+
+def cluster_weights(rng, n_clusters, size):
+    """
+    Draws bootstrap resamples of clusters as weight matrices
+
+    Args:
+        rng: numpy Generator
+        n_clusters: number of clusters
+        size: number of resamples
+    Returns:
+        int array of shape (size, n_clusters) with how many times each
+        cluster is drawn in each resample
+    """
+    return rng.multinomial(n_clusters, np.full(n_clusters, 1 / n_clusters),
+                           size=size)
+
+
+def ratio(sums):
+    """
+    Statistic sums[:, 0] / sums[:, 1]
+    """
+    return sums[:, 0] / sums[:, 1]
+
+
+def ratio_of_ratios(sums):
+    """
+    Statistic (sums[:, 0] / sums[:, 1]) / (sums[:, 2] / sums[:, 3]), the
+    odds ratio of calc_odds_ratio
+    """
+    return (sums[:, 0] / sums[:, 1]) / (sums[:, 2] / sums[:, 3])
+
+
+def _replicate_block(seed, size, aggregates, statistic):
+    """
+    Computes the statistic for one block of resamples
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = aggregates.shape[0]
+    weights = cluster_weights(rng, n_clusters, size).astype(np.float64)
+    sums = weights @ aggregates.reshape(n_clusters, -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return statistic(sums.reshape((size,) + aggregates.shape[1:]))
+
+
+@instrument
+def bootstrap(aggregates, statistic, replicates=10000, alpha=0.05, seed=None,
+              workers=1, block_size=1000):
+    """
+    Percentile cluster bootstrap of a statistic of summed cluster
+    aggregates
+
+    Resamples are drawn as cluster weight matrices in fixed size blocks,
+    each with its own random stream spawned from seed, so the result does
+    not depend on the number of workers.
+
+    Args:
+        aggregates: array of shape (clusters, components, series)
+        statistic: function from sums of shape (resamples, components,
+                   series) to (resamples, series), such as ratio
+        replicates: number of resamples
+        alpha: 1 - confidence level
+        seed: seed of the random streams
+        workers: number of processes, 1 runs in this process
+        block_size: resamples per block
+    Returns:
+        (estimate, lower, upper): arrays of length series
+    """
+    aggregates = np.asarray(aggregates, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        estimate = statistic(aggregates.sum(axis=0)[None])[0]
+    sizes = [block_size] * (replicates // block_size)
+    if replicates % block_size:
+        sizes.append(replicates % block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [seeds, sizes, [aggregates] * len(sizes),
+                 [statistic] * len(sizes)]
+    if workers == 1:
+        blocks = list(map(_replicate_block, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            blocks = list(pool.map(_replicate_block, *arguments))
+    replicated = np.concatenate(blocks)
+    replicated[~np.isfinite(replicated)] = np.nan
+    lower, upper = np.nanpercentile(replicated,
+                                    [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                                    axis=0)
+    return estimate, lower, upper
+
+
+@instrument
+def cluster_sums(data, columns, cluster="clinic"):
+    """
+    Returns the sums of columns for every cluster
+
+    Args:
+        data: data frame or SparseData
+        columns: list of column ids
+        cluster: the column defining the clusters
+    Returns:
+        (sums, clusters): array of shape (clusters, len(columns)) and the
+        cluster values
+    """
+    codes, clusters = pd.factorize(data[cluster])
+    return sparse.grouped_sums(data, codes, len(clusters), columns), clusters
+
+
+@instrument
+def cluster_masks(data, masks, cluster="clinic"):
+    """
+    Returns the number of rows where each boolean mask is set for every
+    cluster
+    """
+    codes, clusters = pd.factorize(data[cluster])
+    return np.stack([np.bincount(codes[(codes >= 0) & m],
+                                 minlength=len(clusters)) for m in masks],
+                    axis=1)
+
+
+@instrument
+def incidence_rate(data, var_id, locations=None, cluster="clinic",
+                   replicates=10000, alpha=0.05, seed=None, workers=1):
+    """
+    Incidence rate with a cluster bootstrap confidence interval
+
+    Args:
+        data: data frame or SparseData
+        var_id: variable id
+        locations: Locations class, the populations of the clusters are
+                   used as denominators. Defaults to the number of rows
+        cluster: the column defining the clusters
+        replicates: number of resamples
+        alpha: 1 - confidence level
+        seed: seed of the random streams
+        workers: number of processes
+    Returns:
+       incidence rate, confidence interval
+    """
+    data = util.analysis_data(data)
+    cases, clusters = cluster_sums(data, [var_id], cluster)
+    if locations is not None:
+        population = np.array([locations.population(int(c))
+                               for c in clusters], dtype=np.float64)
+    else:
+        population = cluster_masks(data, [np.ones(len(data), dtype=bool)],
+                                   cluster)[:, 0]
+    aggregates = np.stack([cases[:, 0], population], axis=1)[:, :, None]
+    estimate, lower, upper = bootstrap(aggregates, ratio, replicates, alpha,
+                                       seed, workers)
+    return (estimate[0], (lower[0], upper[0]))
+
+
+@instrument
+def count_over_count(data, numerator_id, denominator_id, restrict=False,
+                     cluster="clinic", replicates=10000, alpha=0.05, seed=None,
+                     workers=1):
+    """
+    The proportion of indicators.count_over_count with a cluster bootstrap
+    confidence interval
+
+    Args:
+        data: data frame or SparseData, restrict the dates beforehand
+        numerator_id: the numerator_id
+        denominator_id: the denominator id
+        restrict: if true only data rows with denominator counts for numerator
+        cluster: the column defining the clusters
+        replicates: number of resamples
+        alpha: 1 - confidence level
+        seed: seed of the random streams
+        workers: number of processes
+    Returns:
+       proportion, confidence interval
+    """
+    data = sparse.select(util.analysis_data(data),
+                         [numerator_id, denominator_id, restrict])
+    denominator = np.asarray(data[denominator_id] == 1)
+    if restrict:
+        denominator &= np.asarray(data[restrict] == 1)
+    numerator = denominator & np.asarray(data[numerator_id].fillna(0) != 0)
+    counts = cluster_masks(data, [numerator, denominator], cluster)
+    estimate, lower, upper = bootstrap(counts[:, :, None], ratio, replicates,
+                                       alpha, seed, workers)
+    return (estimate[0], (lower[0], upper[0]))
+
+
+@instrument
+def odds_ratio(data, diseases, group, cluster="clinic", variables=None,
+               replicates=10000, alpha=0.05, seed=None, workers=1):
+    """
+    Odds ratios of diseases by group as in multivariate.odds_ratio_many with
+    cluster bootstrap confidence intervals
+
+    Args:
+        data: data frame or SparseData
+        diseases: list of disease ids
+        group: (gr_1, gr_2)
+        cluster: the column defining the clusters
+        variables: Variables class for names
+        replicates: number of resamples
+        alpha: 1 - confidence level
+        seed: seed of the random streams
+        workers: number of processes
+    Returns:
+        data frame with odds_ratio, ci_lower and ci_upper for each disease
+    """
+    data = util.analysis_data(data)
+    codes, clusters = pd.factorize(data[cluster])
+    cases, sizes = sparse.group_counts(data, codes, len(clusters), diseases,
+                                       group)
+    sizes = np.repeat(sizes[:, :, None], len(diseases), axis=2)
+    aggregates = np.stack([cases[:, 0], sizes[:, 0], cases[:, 1],
+                           sizes[:, 1]], axis=1)
+    estimate, lower, upper = bootstrap(aggregates, ratio_of_ratios,
+                                       replicates, alpha, seed, workers)
+    if variables:
+        index = [variables.name(d) for d in diseases]
+    else:
+        index = list(diseases)
+    return pd.DataFrame({"odds_ratio": estimate, "ci_lower": lower,
+                         "ci_upper": upper}, index=index,
+                        columns=["odds_ratio", "ci_lower", "ci_upper"])
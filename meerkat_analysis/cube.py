@@ -0,0 +1,341 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+from . import util
+from . import sparse
+from . import univariate
+from .accessor import epi_weeks, level_ancestors, week_day
+from .indicators import fix_dates
+from .util.loading import KEY_COLUMNS
+from .profiling import instrument
+
+WEEK = np.timedelta64(7, "D")
+
+
+class CountCube:
+    """
+    Weekly counts per location and variable
+
+    counts[i, j, k] is the sum of variable k in location i during the epi
+    week starting on weeks[j]. days holds the counts number_per_week_clinic
+    uses: duplicate records of a clinic on one date are removed and, as
+    its weekly bins are closed on the right, records at midnight of a week
+    start count in the week before. A cube can be rolled up from clinics
+    to any higher location level.
+
+    """
+
+    def __init__(self, locations, weeks, variables, counts,
+                 epi_week_start_day, days=None):
+        """
+        Initialises the class, use build_cube to build it from data
+
+        Args:
+            locations: location ids of the first axis
+            weeks: week starts of the second axis
+            variables: variable ids of the third axis
+            counts: int32 array of shape (locations, weeks, variables),
+                    int64 if a rolled up count does not fit in int32
+            epi_week_start_day: day the weeks start on (Mon=0)
+            days: deduplicated counts of the same shape
+        """
+        self.locations = np.asarray(locations, dtype=np.int64)
+        self.weeks = pd.DatetimeIndex(weeks)
+        self.variables = list(variables)
+        self.counts = counts
+        self.days = days
+        self.epi_week_start_day = epi_week_start_day
+        self._index = {v: i for i, v in enumerate(self.variables)}
+
+    def variable(self, var_id, deduplicated=False):
+        """
+        Returns the location x week counts of var_id
+
+        Args:
+            var_id: variable id
+            deduplicated: use the deduplicated counts
+        """
+        counts = self.days if deduplicated else self.counts
+        if counts is None:
+            raise KeyError("Cube was built without deduplicated counts")
+        if var_id not in self._index:
+            return np.zeros(counts.shape[:2], dtype=counts.dtype)
+        return counts[:, :, self._index[var_id]]
+
+    def week_range(self, start_date, end_date):
+        """
+        Returns the slice of the weeks starting between start_date and
+        end_date
+
+        Args:
+            start_date: start date
+            end_date: end date
+        """
+        start = self.weeks.searchsorted(pd.Timestamp(start_date), side="left")
+        end = self.weeks.searchsorted(pd.Timestamp(end_date), side="right")
+        return slice(start, end)
+
+    @instrument
+    def rollup(self, locations, level):
+        """
+        Returns the cube summed up to the locations on level
+
+        Args:
+            locations: Locations class
+            level: location level
+        Returns:
+            CountCube with one row per location on level
+        """
+        ancestors = level_ancestors(locations, level)
+        parents = np.array([ancestors.get(int(l), -1) for l in self.locations],
+                           dtype=np.int64)
+        targets = np.array(sorted(int(l) for l in locations.get_level(
+            level, only_case_report=False)), dtype=np.int64)
+        # Sums rows through a sparse location x clinic membership matrix,
+        # clinics without an ancestor on level are left out
+        positions = pd.Index(targets).get_indexer(parents)
+        membership = sparse.key_matrix(positions, len(targets)).astype(
+            np.int64)
+
+        def roll(counts):
+            if counts is None:
+                return None
+            rolled = np.asarray(membership @ counts.reshape(
+                len(self.locations), -1))
+            limits = np.iinfo(np.int32)
+            if rolled.size == 0 or (rolled.min() >= limits.min and
+                                    rolled.max() <= limits.max):
+                rolled = rolled.astype(np.int32)
+            return rolled.reshape((len(targets),) + counts.shape[1:])
+        return CountCube(targets, self.weeks, self.variables,
+                         roll(self.counts), self.epi_week_start_day,
+                         roll(self.days))
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by the counts
+        """
+        return self.counts.nbytes + (self.days.nbytes
+                                     if self.days is not None else 0)
+
+
+def _chunks(source, variables, chunk_rows):
+    if isinstance(source, str):
+        return util.iter_structured_csv(source, variables,
+                                        chunk_rows=chunk_rows)
+    if isinstance(source, pd.DataFrame) or hasattr(source, "analysis_data"):
+        return [source]
+    if isinstance(source, sparse.SparseData):
+        return [source.to_frame()]
+    return source
+
+
+def _variable_ids(data, variables):
+    if variables is not None:
+        return [c for c in data.columns if c in variables.variables]
+    return [c for c in data.columns if c not in KEY_COLUMNS + ["id"]
+            and pd.api.types.is_numeric_dtype(data[c])]
+
+
+@instrument
+def build_cube(source, variables=None, variable_ids=None,
+               epi_week_start_day=0, chunk_rows=100000, deduplicate=True):
+    """
+    Builds a CountCube of clinic x week x variable counts in one pass
+
+    Deduplicated counts assume 0/1 indicator variables.
+
+    Args:
+        source: data frame, dataset object, csv filename or an iterable
+                of data frames
+        variables: Variables class, needed for csv files. The cube holds
+                   the columns that are variables
+        variable_ids: the variables to count, overrides variables
+        epi_week_start_day: day the weeks start on (Mon=0)
+        chunk_rows: number of rows per chunk of csv files
+        deduplicate: also build the deduplicated counts
+    Returns:
+        CountCube
+    """
+    weekly = []
+    daily = []
+    for chunk in _chunks(source, variables, chunk_rows):
+        chunk = util.analysis_data(chunk)
+        if variable_ids is None:
+            variable_ids = _variable_ids(chunk, variables)
+        clinics = np.asarray(chunk["clinic"], dtype=np.float64)
+        dates = np.asarray(chunk["date"], dtype="datetime64[ns]")
+        keep = ~np.isnan(clinics) & ~np.isnat(dates)
+        values = chunk[[v for v in variable_ids if v in chunk.columns]]
+        values = values.reindex(columns=variable_ids)[keep].fillna(0)
+        clinics = clinics[keep].astype(np.int64)
+        dates = dates[keep]
+        weekly.append(values.groupby([clinics, epi_weeks(dates,
+                                      epi_week_start_day)]).sum())
+        if deduplicate:
+            daily.append(values.groupby([clinics, dates]).max())
+    if variable_ids is None:
+        variable_ids = []
+
+    def combine(parts, how):
+        if not parts:
+            return pd.DataFrame(columns=variable_ids)
+        return getattr(pd.concat(parts).groupby(level=[0, 1]), how)()
+
+    counts = combine(weekly, "sum")
+    clinic_ids = np.unique(counts.index.get_level_values(0)).astype(np.int64)
+    week_starts = counts.index.get_level_values(1)
+    if len(week_starts):
+        weeks = pd.date_range(week_starts.min(), week_starts.max(),
+                              freq=timedelta(days=7))
+    else:
+        weeks = pd.DatetimeIndex([])
+
+    def to_array(frame):
+        array = np.zeros((len(clinic_ids), len(weeks), len(variable_ids)),
+                         dtype=np.int32)
+        if len(frame) == 0:
+            return array
+        rows = np.searchsorted(clinic_ids,
+                               frame.index.get_level_values(0).values)
+        cols = (frame.index.get_level_values(1).values -
+                np.datetime64(weeks[0])) // WEEK
+        array[rows, cols.astype(np.int64)] = frame.values
+        return array
+
+    days = None
+    if deduplicate:
+        per_day = combine(daily, "max")
+        day_weeks = epi_weeks(per_day.index.get_level_values(1) -
+                              np.timedelta64(1, "ns"), epi_week_start_day)
+        days = to_array(per_day.groupby(
+            [per_day.index.get_level_values(0), day_weeks]).sum())
+    return CountCube(clinic_ids, weeks, variable_ids, to_array(counts),
+                     epi_week_start_day, days)
+
+
+def _window(cube, start_date, end_date, epi_week_start_day):
+    start_date, end_date, freq = fix_dates(start_date, end_date,
+                                           epi_week_start_day)
+    if week_day(freq) != cube.epi_week_start_day:
+        raise KeyError("Cube was built with epi weeks starting on day {}".format(
+            cube.epi_week_start_day))
+    return start_date, end_date, freq
+
+
+@instrument
+def count(cube, var_id, start_date=None, end_date=None,
+          epi_week_start_day=None):
+    """
+    Cube version of indicators.count
+
+    The window is rounded to the whole epi weeks starting between
+    start_date and end_date.
+
+    Args:
+        cube: CountCube
+        var_id: the variable id to count
+        start_date: start date
+        end_date: end_date
+        epi_week_start_day: what day of the week to start the timeline(Mon=0)
+    Returns:
+       (total, timeline): a total and weekly timeline
+    """
+    start_date, end_date, freq = _window(cube, start_date, end_date,
+                                         epi_week_start_day)
+    dates = pd.date_range(start_date, end_date, freq=freq, closed="left")
+    weeks = cube.week_range(start_date, end_date)
+    totals = cube.variable(var_id)[:, weeks].sum(axis=0)
+    timeline = pd.Series(totals, index=cube.weeks[weeks], dtype=float)
+    return (totals.sum(), timeline.reindex(dates).fillna(0))
+
+
+@instrument
+def number_per_week_clinic(cube, variable, locations, start_date=None,
+                           end_date=None, epi_week_start_day=None):
+    """
+    Cube version of indicators.number_per_week_clinic with duplicates
+    dropped
+
+    Args:
+        cube: CountCube of clinics
+        variable: the variable id to count
+        locations: Locations class
+        start_date: start date
+        end_date: end_date
+        epi_week_start_day: what day of the week to start the timeline(Mon=0)
+    Returns:
+       clinic_timeline: all clinics with a timeline
+    """
+    start_date, end_date, freq = _window(cube, start_date, end_date,
+                                         epi_week_start_day)
+    counts = cube.variable(variable, deduplicated=True)
+    locs = locations.locations
+    tuples = []
+    values = []
+    for clinic in sorted(int(l) for l in locs
+                         if locs[l]["level"] == "clinic"):
+        loc = locs[str(clinic)]
+        if not loc["case_report"]:
+            continue
+        clinic_start = max(pd.Timestamp(loc["start_date"]),
+                           pd.Timestamp(start_date))
+        dates = pd.date_range(clinic_start, end_date, freq=freq)
+        row = np.searchsorted(cube.locations, clinic)
+        if row < len(cube.locations) and cube.locations[row] == clinic:
+            positions = cube.weeks.get_indexer(dates)
+            found = np.where(positions >= 0,
+                             counts[row, np.maximum(positions, 0)], 0)
+        else:
+            found = np.zeros(len(dates))
+        tuples.extend((clinic, d) for d in dates)
+        values.extend(found)
+    index = pd.MultiIndex.from_tuples(tuples, names=["clinic", "date"])
+    return pd.Series(values, index=index, name=variable,
+                     dtype=float).sort_index()
+
+
+@instrument
+def breakdown_by_category(cube, variables, category, use_names=True):
+    """
+    Cube version of univariate.breakdown_by_category for variable
+    categories
+
+    Args:
+        cube: CountCube
+        variables: Variables class
+        category: name of category
+        use_names: return object used variable names instead of ids
+    """
+    if category not in variables.groups:
+        raise KeyError("Category does not exists")
+    results = pd.DataFrame(columns=["value"])
+    for i in sorted(variables.groups[category]):
+        name = variables.name(i) if use_names else i
+        results.loc[name] = [cube.variable(i).sum()]
+    return results
+
+
+@instrument
+def incidence_rate_by_location(cube, locations, var_id, level="clinic"):
+    """
+    Cube version of geo.incidence_rate_by_location
+
+    Args:
+        cube: CountCube of clinics
+        locations: Locations class
+        var_id: variable id
+        level: location level
+    Returns:
+       data frame with incidence rates for each location
+    """
+    rolled = cube.rollup(locations, level)
+    totals = pd.Series(rolled.variable(var_id).sum(axis=1),
+                       index=rolled.locations)
+    locs = locations.get_level(level)
+    counts = totals.reindex([int(l) for l in locs]).fillna(0)
+    populations = [locations.population(l) for l in locs]
+    ret = univariate.incidence_rates(counts.values, populations)
+    ret.index = [locations.name(l) for l in locs]
+    return ret
@@ -1,12 +1,57 @@
+import re
+import numpy as np
 import pandas as pd
-from statsmodels.stats import proportion
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
 
+from . import util
+from . import univariate
+from . import sparse
+from .accessor import level_ancestors
+from .profiling import instrument
 
+LEVELS = ["clinic", "district", "region", "country"]
+EARTH_RADIUS = 6371.0
+POINT = re.compile(r"^\s*POINT\s*\(\s*([-+.\deE]+)\s+([-+.\deE]+)\s*\)\s*$",
+                   re.IGNORECASE)
+
+
+@instrument
+def location_counts(data, level, var_id):
+    """
+    Returns the sum of var_id and the number of rows for every location
+    in the level column with one bincount
+
+    Args:
+        data: data frame or SparseData
+        level: location level column
+        var_id: variable id
+    Returns:
+        data frame indexed by location id with count and rows columns
+    """
+    if isinstance(data, pd.DataFrame):
+        codes, uniques = data.meerkat.codes(level)
+    else:
+        codes, uniques = pd.factorize(data[level])
+    found = codes >= 0
+    codes = codes[found]
+    rows = np.bincount(codes, minlength=len(uniques))
+    if var_id in data.columns:
+        values = np.asarray(data[var_id], dtype=np.float64)[found]
+        counts = np.bincount(codes, weights=np.nan_to_num(values),
+                             minlength=len(uniques))
+    else:
+        counts = np.zeros(len(uniques))
+    index = pd.Index(np.asarray(uniques, dtype=np.float64).astype(np.int64))
+    return pd.DataFrame({"count": counts, "rows": rows}, index=index)
+
+
+@instrument
 def incidence_rate_by_location(data, locations, var_id, level="clinic"):
     """
     Returns an incidence rate for each location
 
-    Args: 
+    Args:
         data: pandas data frame with data
         locations: location class
         var_id: variable_id
@@ -14,21 +59,460 @@ def incidence_rate_by_location(data, locations, var_id, level="clinic"):
     Returns:
        data frame with incidence rates for each location
     """
+    data = util.analysis_data(data)
+
+    locs = locations.get_level(level)
+    ids = [int(l) for l in locs]
+    counts = location_counts(data, level, var_id)["count"].reindex(ids)
+    populations = [locations.population(l) for l in locs]
+    ret = univariate.incidence_rates(counts.fillna(0).values, populations)
+    ret.index = [locations.name(l) for l in locs]
+    return ret
+
+
+@instrument
+def incidence_rates_by_level(data, locations, var_id, levels=LEVELS):
+    """
+    Returns the incidence rate of every location on all levels
+
+    Args:
+        data: pandas data frame with data
+        locations: location class
+        var_id: variable_id
+        levels: the levels to calculate for
+    Returns:
+       data frame indexed by (level, location name)
+    """
+    data = util.analysis_data(data)
+    return pd.concat([incidence_rate_by_location(data, locations, var_id,
+                                                 level=level)
+                      for level in levels], keys=levels,
+                     names=["level", "location"])
+
+
+@instrument
+def empirical_bayes(cases, populations, groups=None):
+    """
+    Empirical Bayes smoothing of rates towards the mean of their group
 
-    N = data.groupby(level).sum()[var_id]
+    Uses the method of moments estimates of Marshall (1991): every rate is
+    shrunk towards the group rate by how unstable it is given its
+    population compared with the spread of the rates in the group.
+
+    Args:
+        cases: array of shape (locations, variables)
+        populations: array of shape (locations,)
+        groups: integer group of every location, all in one group if None
+    Returns:
+        array of smoothed rates, nan where the population is 0
+    """
+    cases = np.asarray(cases, dtype=np.float64).reshape(len(populations), -1)
+    populations = np.asarray(populations, dtype=np.float64)
+    if groups is None:
+        groups = np.zeros(len(populations), dtype=np.int64)
+    groups = np.asarray(groups)
+    known = populations > 0
+    keys = np.where(known, groups, -1)
+    n_groups = groups.max() + 1 if len(groups) else 0
+    membership = sparse.key_matrix(keys, n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(known[:, None], cases / populations[:, None], np.nan)
+        group_cases = membership @ np.where(
+            known[:, None], cases, 0)
+        group_populations = np.bincount(keys[known], populations[known],
+                                        minlength=n_groups)
+        group_sizes = np.bincount(keys[known], minlength=n_groups)
+        mean = group_cases / group_populations[:, None]
+        deviation = populations[:, None] * (rates - mean[groups]) ** 2
+        variance = membership @ np.where(
+            known[:, None], deviation, 0) / group_populations[:, None]
+        prior = np.maximum(variance - mean * group_sizes[:, None] /
+                           group_populations[:, None], 0)[groups]
+        mean = mean[groups]
+        noise = mean / populations[:, None]
+        weight = np.where(prior + noise > 0, prior / (prior + noise), 0)
+        return np.where(known[:, None], mean + weight * (rates - mean),
+                        np.nan)
+
+
+@instrument
+def smoothed_rates(data, locations, var_ids, level="clinic", local=False):
+    """
+    Empirical Bayes smoothed incidence rates of every location on level
+
+    Args:
+        data: data frame or SparseData
+        locations: Locations class with populations
+        var_ids: list of variable ids
+        level: location level
+        local: shrink towards the locations with the same parent instead of
+               towards all locations on the level
+    Returns:
+        data frame of rates indexed by location name with a column per
+        variable
+    """
+    data = util.analysis_data(data)
     locs = locations.get_level(level)
-    print(locs)
-    ret = pd.DataFrame(columns=["incidence_rate", "ci_lower", "ci_upper"])
-    for l in locs:
-        if int(l) in N.index:
-            n = N[int(l)]
+    ids = pd.Index([int(l) for l in locs])
+    codes, uniques = pd.factorize(data[level])
+    positions = ids.get_indexer(np.asarray(uniques, dtype=np.float64)
+                                .astype(np.int64))
+    if len(uniques) == 0:
+        rows = np.full(len(codes), -1)
+    else:
+        rows = np.where(codes >= 0, positions[np.maximum(codes, 0)], -1)
+    cases = sparse.grouped_sums(data, rows, len(ids), list(var_ids))
+    populations = [locations.population(l) for l in locs]
+    groups = None
+    if local:
+        parents = [locations.locations[l]["parent_location"] for l in locs]
+        groups = pd.factorize(np.asarray(parents, dtype=object))[0]
+    ret = pd.DataFrame(empirical_bayes(cases, populations, groups),
+                       columns=list(var_ids))
+    ret.index = [locations.name(l) for l in locs]
+    return ret
+
+
+def parse_geolocation(value):
+    """
+    Parses a geolocation as "lat,lon" or a well known text "POINT(lon lat)"
+
+    Args:
+        value: geolocation string
+    Returns:
+        (lat, lon) or None if there is no valid geolocation
+    """
+    if not value or not isinstance(value, str):
+        return None
+    match = POINT.match(value)
+    try:
+        if match:
+            lon, lat = float(match.group(1)), float(match.group(2))
         else:
-            n = 0
-        i = n / locations.population(l)
-        confidence_interval = proportion.proportion_confint(n,
-                                                            locations.population(l)
-                                                            , method="wilson")
-        ret.loc[locations.name(l)] = [i,
-                                      i - confidence_interval[0],
-                                      confidence_interval[1] - i]
+            lat, lon = [float(v) for v in value.split(",")]
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def _unit_vectors(lat, lon):
+    """
+    Returns points on the unit sphere for arrays of latitudes and longitudes
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def _chord(distance):
+    """
+    Converts great circle distances in km to chord lengths on the unit sphere
+    """
+    angle = np.minimum(np.asarray(distance, dtype=np.float64) / EARTH_RADIUS,
+                       np.pi)
+    return 2 * np.sin(angle / 2)
+
+
+def _distance(chord):
+    """
+    Converts chord lengths on the unit sphere to great circle distances in km
+    """
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+class LocationIndex:
+    """
+    Spatial index of the locations on one level with a geolocation
+
+    The geolocations are parsed once and kept in a KD-tree over points on
+    the unit sphere, so all queries are batched and distances are great
+    circle distances in km.
+
+    """
+
+    def __init__(self, locations, level="clinic", only_case_report=False):
+        """
+        Builds the index
+
+        Args:
+            locations: Locations class
+            level: location level to index
+            only_case_report: only index case reporting clinics
+        """
+        self.locations = locations
+        self.level = level
+        ids = []
+        coordinates = []
+        for l in locations.get_level(level, only_case_report=only_case_report):
+            point = parse_geolocation(
+                locations.locations[l].get("geolocation"))
+            if point is not None:
+                ids.append(int(l))
+                coordinates.append(point)
+        self.ids = np.array(ids, dtype=np.int64)
+        coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.lat = coordinates[:, 0]
+        self.lon = coordinates[:, 1]
+        # A level without geolocations has no tree, nothing is ever found
+        self.tree = None
+        if len(ids):
+            self.tree = cKDTree(_unit_vectors(self.lat, self.lon))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @instrument
+    def nearest(self, lat, lon, k=1):
+        """
+        Returns the k nearest locations of each point
+
+        Args:
+            lat: array of latitudes
+            lon: array of longitudes
+            k: number of locations
+        Returns:
+            (ids, distances): arrays of shape (points, k), ids are -1 and
+            distances inf if there are fewer than k locations
+        """
+        chords, positions = self._query(lat, lon, k)
+        found = positions < len(self.ids)
+        ids = np.full(positions.shape, -1, dtype=np.int64)
+        ids[found] = self.ids[positions[found]]
+        distances = np.full(positions.shape, np.inf)
+        distances[found] = _distance(chords[found])
+        return ids, distances
+
+    def _query(self, lat, lon, k):
+        points = _unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        if self.tree is None:
+            return (np.full((len(points), k), np.inf),
+                    np.full((len(points), k), len(self.ids)))
+        chords, positions = self.tree.query(points, k=k)
+        return (np.asarray(chords).reshape(len(points), k),
+                np.asarray(positions).reshape(len(points), k))
+
+    @instrument
+    def within(self, lat, lon, radius):
+        """
+        Returns the locations within radius km of each point
+
+        Args:
+            lat: array of latitudes
+            lon: array of longitudes
+            radius: distance in km
+        Returns:
+            list with an array of location ids for each point
+        """
+        points = _unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        if self.tree is None:
+            return [np.array([], dtype=np.int64) for p in points]
+        matches = self.tree.query_ball_point(points, _chord(radius))
+        return [self.ids[np.sort(np.asarray(m, dtype=np.int64))]
+                for m in matches]
+
+    @instrument
+    def catchment(self, lat, lon, level=None, max_distance=None):
+        """
+        Assigns each point to the catchment of its nearest location
+
+        Args:
+            lat: array of latitudes
+            lon: array of longitudes
+            level: return the ancestor of the nearest location on this level
+            max_distance: points further away in km are not assigned
+        Returns:
+            array of location ids, -1 for points not assigned
+        """
+        ids = self.ids
+        if level is not None and level != self.level:
+            ancestors = level_ancestors(self.locations, level)
+            ids = np.array([ancestors.get(i, -1) for i in self.ids],
+                           dtype=np.int64)
+        chords, positions = self._query(lat, lon, 1)
+        chords, positions = chords[:, 0], positions[:, 0]
+        found = positions < len(self.ids)
+        if max_distance is not None:
+            found &= chords <= _chord(max_distance)
+        ret = np.full(len(positions), -1, dtype=np.int64)
+        ret[found] = ids[positions[found]]
+        return ret
+
+
+def _cylinder_llr(observed, expected, total):
+    """
+    Poisson log likelihood ratio of cylinders with more cases than expected
+    """
+    llr = np.zeros(observed.shape)
+    high = observed > expected
+    observed = observed[high]
+    expected = expected[high]
+    rest = total - observed
+    with np.errstate(divide="ignore", invalid="ignore"):
+        llr[high] = (observed * np.log(observed / expected) +
+                     np.where(rest > 0, rest * np.log(rest / (total - expected)),
+                              0))
+    return llr
+
+
+def _scan(table, neighbours, valid, max_weeks, prospective=False,
+          best=False):
+    """
+    Evaluates every cylinder of neighbours x time window
+
+    The counts of a cylinder come from cumulative sums over time and over
+    the sorted neighbours of each centre, and the expected counts factor
+    into clinic and week totals.
+
+    Args:
+        table: clinic x week counts
+        neighbours: (centres, k) clinic positions sorted by distance
+        valid: (centres, k) mask of the neighbours within the radius
+        max_weeks: longest time window
+        prospective: only windows ending in the last week
+        best: also return the best cylinder of every centre
+    Returns:
+        the highest log likelihood ratio, and if best an array of
+        (llr, neighbours, start, weeks, observed, expected) per centre
+    """
+    n_weeks = table.shape[1]
+    total = table.sum()
+    clinic_totals = np.cumsum(table.sum(axis=1)[neighbours], axis=1)
+    week_totals = np.concatenate([[0], np.cumsum(table.sum(axis=0))])
+    over_time = np.concatenate([np.zeros((table.shape[0], 1)),
+                                np.cumsum(table, axis=1)], axis=1)
+    results = np.zeros((len(neighbours), 6))
+    for weeks in range(1, min(max_weeks, n_weeks) + 1):
+        first = n_weeks - weeks if prospective else 0
+        windows = (over_time[:, first + weeks:] -
+                   over_time[:, first:n_weeks + 1 - weeks])
+        observed = np.cumsum(windows[neighbours], axis=1)
+        expected = (clinic_totals[:, :, None] *
+                    (week_totals[first + weeks:] -
+                     week_totals[first:n_weeks + 1 - weeks]) / total)
+        llr = _cylinder_llr(observed, expected, total) * valid[:, :, None]
+        flat = llr.reshape(len(neighbours), -1)
+        position = flat.argmax(axis=1)
+        centres = np.arange(len(neighbours))
+        better = flat[centres, position] > results[:, 0]
+        if not best:
+            results[better, 0] = flat[centres, position][better]
+            continue
+        k, start = np.unravel_index(position, llr.shape[1:])
+        results[better] = np.stack(
+            [flat[centres, position], k + 1, first + start,
+             np.full(len(neighbours), weeks),
+             observed[centres, k, start], expected[centres, k, start]],
+            axis=1)[better]
+    if best:
+        return results[:, 0].max(), results
+    return results[:, 0].max()
+
+
+def _scan_replicates(seed, size, clinics, weeks, shape, neighbours, valid,
+                     max_weeks, prospective):
+    """
+    Returns the highest log likelihood ratios of size permuted tables
+    """
+    rng = np.random.default_rng(seed)
+    ret = np.zeros(size)
+    for i in range(size):
+        permuted = rng.permutation(weeks)
+        table = np.bincount(clinics * shape[1] + permuted,
+                            minlength=shape[0] * shape[1])
+        ret[i] = _scan(table.reshape(shape).astype(np.float64), neighbours,
+                       valid, max_weeks, prospective)
+    return ret
+
+
+@instrument
+def space_time_scan(counts, locations, max_neighbours=10, max_weeks=8,
+                    max_radius=None, prospective=False, replicates=999,
+                    seed=None, workers=1, n_clusters=5, block_size=50):
+    """
+    Space-time permutation scan for clusters of cases
+
+    Scans cylinders of a clinic and its nearest neighbours over windows of
+    consecutive weeks, compares them with the counts expected from the
+    clinic and week totals and ranks the log likelihood ratios against
+    Monte Carlo replicates with permuted case weeks.
+
+    Args:
+        counts: clinic x week data frame indexed by clinic id, or a
+                series indexed by (clinic, date) as from
+                indicators.number_per_week_clinic
+        locations: Locations class with clinic geolocations
+        max_neighbours: largest number of clinics in a cylinder
+        max_weeks: longest time window in weeks
+        max_radius: largest cylinder radius in km
+        prospective: only scan windows ending in the last week, for
+                     surveillance of ongoing clusters
+        replicates: number of Monte Carlo replicates
+        seed: seed of the random streams
+        workers: number of processes, 1 runs in this process
+        n_clusters: number of clusters with no clinics in common to return
+        block_size: replicates per block
+    Returns:
+        data frame with location, clinics, radius, start, end, observed,
+        expected, llr and p_value of the clusters sorted by llr
+    """
+    if isinstance(counts, pd.Series):
+        counts = counts.unstack()
+    counts = counts.fillna(0)
+    counts.index = np.asarray(counts.index, dtype=np.float64).astype(np.int64)
+    index = LocationIndex(locations)
+    keep = np.isin(index.ids, counts.index)
+    ids = index.ids[keep]
+    if len(ids) == 0:
+        raise KeyError("No geolocated clinics in counts")
+    table = np.round(counts.reindex(ids).values).astype(np.int64)
+    shape = table.shape
+    k = min(max_neighbours, len(ids))
+    tree = cKDTree(_unit_vectors(index.lat[keep], index.lon[keep]))
+    chords, neighbours = tree.query(tree.data, k=k)
+    chords = np.asarray(chords).reshape(len(ids), k)
+    neighbours = np.asarray(neighbours).reshape(len(ids), k)
+    valid = np.ones(neighbours.shape, dtype=bool)
+    if max_radius is not None:
+        valid = chords <= _chord(max_radius)
+
+    _, best = _scan(table.astype(np.float64), neighbours, valid,
+                    max_weeks, prospective, best=True)
+    cells = np.repeat(np.arange(table.size), table.ravel())
+    sizes = [block_size] * (replicates // block_size)
+    if replicates % block_size:
+        sizes.append(replicates % block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    n = len(sizes)
+    arguments = [seeds, sizes, [cells // shape[1]] * n,
+                 [cells % shape[1]] * n, [shape] * n, [neighbours] * n,
+                 [valid] * n, [max_weeks] * n, [prospective] * n]
+    if workers == 1:
+        blocks = list(map(_scan_replicates, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            blocks = list(pool.map(_scan_replicates, *arguments))
+    replicated = np.concatenate(blocks) if blocks else np.zeros(0)
+
+    columns = ["location", "clinics", "radius", "start", "end", "observed",
+               "expected", "llr", "p_value"]
+    ret = pd.DataFrame(columns=columns)
+    used = set()
+    for centre in np.argsort(-best[:, 0], kind="stable"):
+        llr, size, start, weeks, observed, expected = best[centre]
+        if llr <= 0 or len(ret) >= n_clusters:
+            break
+        members = neighbours[centre, :int(size)]
+        if used.intersection(members):
+            continue
+        used.update(members)
+        start = int(start)
+        ret.loc[len(ret)] = [
+            ids[centre], list(ids[members]),
+            _distance(chords[centre, int(size) - 1]),
+            counts.columns[start], counts.columns[start + int(weeks) - 1],
+            observed, expected, llr,
+            (1 + np.sum(replicated >= llr)) / (1 + len(replicated))]
     return ret
@@ -2,11 +2,13 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from dateutil import parser
-try:
-    from matplotlib import pylab
-except ImportError:
-    pass
+from . import sparse
+from . import util
+from .accessor import weekly_window
+from .profiling import instrument, span
+from .plotting import pylab
 
+@instrument
 def fix_dates(start_date, end_date, epi_week_start_day):
     """
     We parse the start and end date and remove any timezone information
@@ -44,12 +46,13 @@ def fix_dates(start_date, end_date, epi_week_start_day):
     return start_date, end_date, freq
 
 
+@instrument
 def count(data, var_id, start_date=None, end_date=None, epi_week_start_day=None):
     """
     We return the total count of var_id and a timeline by epi_week
 
     Args:
-        data: data in dataframe
+        data: data in dataframe or PreparedData
         var_id: the variable id to count
         start_date: start date
         end_date: end_date
@@ -63,20 +66,19 @@ def count(data, var_id, start_date=None, end_date=None, epi_week_start_day=None)
                                            epi_week_start_day)
     dates = pd.date_range(start_date, end_date, freq=freq, closed="left")
 
-    data = data[data["date"] >= start_date]
-    data = data[data["date"] <= end_date]
+    data, weeks = weekly_window(data, start_date, end_date, freq, [var_id])
     total = data[var_id].sum()
-    timeline = data.groupby(
-        pd.Grouper(key="date", freq=freq, label="left", closed="left")).sum()[var_id]
+    timeline = data[var_id].groupby(weeks).sum()
     timeline = timeline.reindex(dates).fillna(0)
     return (total, timeline)
 
+@instrument
 def count_over_count(data, numerator_id, denominator_id, start_date=None, end_date=None, epi_week_start_day=None, restrict=False):
     """
     We return the total proportion of numerator_id over denominator_id and a timeline by epi_week
 
     Args:
-        data: data in dataframe
+        data: data in dataframe or PreparedData
         denominator: the denominator id
         numerator: the numerator_id
         start_date: start date
@@ -87,18 +89,18 @@ def count_over_count(data, numerator_id, denominator_id, start_date=None, end_da
        (total, timeline): a total and weekly timeline
 
     """
-
-    if restrict:
-        data = data[data[restrict] == 1]
-
     start_date, end_date, freq = fix_dates(start_date,
                                            end_date,
                                            epi_week_start_day)
-    data.replace(0, np.nan, inplace=True)
     dates = pd.date_range(start_date, end_date, freq=freq, closed="left")
-    data = data[data["date"] >= start_date]
-    data = data[data["date"] <= end_date]
-    data = data[["date", numerator_id, denominator_id]]
+    data, weeks = weekly_window(data, start_date, end_date, freq,
+                                [numerator_id, denominator_id, restrict])
+    if restrict:
+        weeks = weeks[np.asarray(data[restrict] == 1)]
+        data = data[data[restrict] == 1]
+    data = data[[numerator_id, denominator_id]]
+    data = data.replace(0, np.nan)
+    weeks = weeks[np.asarray(data[denominator_id] == 1)]
     data = data[data[denominator_id] == 1]
     if data[denominator_id].count() == 0:
         proportion =  np.array([0.0])
@@ -107,8 +109,7 @@ def count_over_count(data, numerator_id, denominator_id, start_date=None, end_da
         #        ci = proportion.proportion_confint(data[numerator_id].sum(), data[denominator_id].sum(), method="wilson")
 
 
-    timeline = data.groupby(
-        pd.Grouper(key="date", freq=freq, label="left", closed="left")).count()
+    timeline = data.groupby(weeks).count()
     timeline = timeline.reindex(dates).fillna(0)
     timeline.loc[timeline[denominator_id] == 0, denominator_id] = 1
     proportion_timeline = timeline[numerator_id] / timeline[denominator_id]
@@ -116,6 +117,7 @@ def count_over_count(data, numerator_id, denominator_id, start_date=None, end_da
     return (proportion, proportion_timeline)
 
 
+@instrument
 def number_per_week_clinic(data, variable, locations,
                            start_date=None, end_date=None,
                            epi_week_start_day=None,
@@ -134,6 +136,7 @@ def number_per_week_clinic(data, variable, locations,
     """
 
 
+    data = sparse.select(util.analysis_data(data), [variable])
     today = datetime.now()
     locs = locations.locations
     start_date, end_date, freq = fix_dates(start_date,
@@ -141,8 +144,9 @@ def number_per_week_clinic(data, variable, locations,
                                            epi_week_start_day)
 
     # We drop duplicates so each clinic can only have one record per day
+    # using the clinic and date keys cached on the frame by data.meerkat
     if drop_duplicates:
-        data = data.drop_duplicates(subset=["region", "district", "clinic", "date", variable])
+        data = data[data.meerkat.first_records(variable)]
     # We first create an index with sublevel, clinic, dates
     # Where dates are the dates after the clinic started reporting
     clinics = []
@@ -162,13 +166,15 @@ def number_per_week_clinic(data, variable, locations,
     new_index = pd.MultiIndex.from_tuples(tuples,
                                           names=["clinic", "date"])
 
-    completeness = data.groupby(
-        ["clinic",
-         pd.Grouper(key="date", freq=freq, label="left")]
-    ).sum().reindex(new_index)[variable].fillna(0).sort_index()
+    with span("indicators.number_per_week_clinic.groupby", len(data)):
+        completeness = data.groupby(
+            ["clinic",
+             pd.Grouper(key="date", freq=freq, label="left")]
+        ).sum().reindex(new_index)[variable].fillna(0).sort_index()
     return completeness
 
 
+@instrument
 def clinic_to_level(data, locations, level, cutoff_per_week=None):
     """
     Transform clinic data to data on a higher level
@@ -181,20 +187,26 @@ def clinic_to_level(data, locations, level, cutoff_per_week=None):
     Returns:
        Timelines for new level
     """
-    top_locations = locations.get_level(level)
+    top_locations = [int(l) for l in locations.get_level(level)]
     if cutoff_per_week:
         data[data > cutoff_per_week] = cutoff_per_week
-    ret = data.copy()
-    org = data.index.get_level_values(level=0)
-    #pd.DataFrame(columns=[level, "date", "value"], index=[level, "date"])
-    for tl in top_locations:
-        clinics = tuple([ int(l) for l in locations.get_clinics(tl)])
-        loc_data = data.loc[data.index.get_level_values(level=0).isin(clinics)].groupby(level=1).mean()
-        for d in loc_data.index:
-            ret.loc[(locations.name(tl), d)] = loc_data.loc[d]
-    return ret[~ret.index.get_level_values(level=0).isin(org)]
-
-
+    # The clinic to level membership comes from data.meerkat.ancestor
+    clinics = pd.DataFrame({"clinic": data.index.get_level_values(level=0)})
+    ancestors = clinics.meerkat.ancestor(level, locations)
+    known = ancestors >= 0
+    dates = data.index.get_level_values(level=1)[known]
+    ret = data[known].groupby([ancestors[known], dates]).mean()
+    order = {l: i for i, l in enumerate(top_locations)}
+    ret = ret.iloc[np.argsort([order[l] for l in
+                               ret.index.get_level_values(level=0)],
+                              kind="stable")]
+    ret.index = ret.index.set_levels(
+        [locations.name(l) for l in ret.index.levels[0]], level=0)
+    ret.index.names = data.index.names
+    return ret
+
+
+@instrument
 def number_of_sites(data, level, start_date=None, end_date=None,
                            epi_week_start_day=None):
     start_date, end_date, freq = fix_dates(start_date,
@@ -203,27 +215,26 @@ def number_of_sites(data, level, start_date=None, end_date=None,
 
     dates = pd.date_range(start_date, end_date, freq=freq, closed="left")
 
-    data = data[data["date"] >= start_date]
-    data = data[data["date"] <= end_date]
+    data, weeks = weekly_window(data, start_date, end_date, freq)
     total = data[level].nunique()
-    timeline = data.groupby(
-        pd.Grouper(
-            key="date", freq=freq,
-            label="left", closed="left")).agg({level: pd.Series.nunique})[level]
+    timeline = data[level].groupby(weeks).nunique()
     timeline = timeline.reindex(dates).fillna(0)
     return (total, timeline)
 
 
+@instrument
 def grouped_indicator(data, function,
                       group_by,
                       *args):
 
+    data = util.analysis_data(data)
     return_value = {}
     for name, group in data.groupby(group_by):
         return_value[name] = function(group, *args)
     return return_value
 
 
+@instrument
 def grouped_count_over_count(data, numerator, denominator, restrict=False,
                              group_by="clinic", start_date=None, end_date=None,
                              epi_week_start_day=None,
@@ -242,6 +253,8 @@ def grouped_count_over_count(data, numerator, denominator, restrict=False,
        dataframe: With a row for each group by
     """
 
+    data = sparse.select(util.analysis_data(data),
+                         [numerator, denominator, restrict])
     clinics = pd.DataFrame(columns=["score", "N"] + fields, index=[group_by])
     for name, group in data.groupby(group_by):
         if np.sum(group[denominator]) > 0:
@@ -258,7 +271,8 @@ def grouped_count_over_count(data, numerator, denominator, restrict=False,
     return clinics
 
 
-def plot_level_total(data, locations, level,  cutoff_per_week=None):
+@instrument
+def plot_level_total(data, locations, level,  cutoff_per_week=None, ax=None):
     """
     Transform clinic data to data on a higher level and plots it
 
@@ -267,20 +281,21 @@ def plot_level_total(data, locations, level,  cutoff_per_week=None):
        locations: Location class
        level: district, region or country
        cutoff_per_week: a cut off
+       ax: matplotlib axes to draw on, defaults to a new pylab figure
     """
 
     total = data.groupby(level=1).mean() / cutoff_per_week * 100
-    fig, ax = pylab.subplots()
+    if ax is None:
+        fig, ax = pylab().subplots()
     sublevels = clinic_to_level(data, locations, level, cutoff_per_week)
 
-    for label in sublevels.index.levels[0]:
-        t = sublevels.loc[label, :]
+    for label in sublevels.index.remove_unused_levels().levels[0]:
+        t = sublevels.xs(label, level=0)
         if len(t) > 0:
-            t.index = t.index.droplevel(level=0)
             t = t / cutoff_per_week * 100
-            t.plot(label=label, color="black", alpha=0.4)
-    total.plot(label="Country", lw=5)
-    axis = pylab.axis()
+            t.plot(label=label, color="black", alpha=0.4, ax=ax)
+    total.plot(label="Country", lw=5, ax=ax)
+    axis = ax.axis()
     x = [axis[0], axis[1]]
     green_upper = [100, 100]
     green_lower = [80, 80]
@@ -295,18 +310,20 @@ def plot_level_total(data, locations, level,  cutoff_per_week=None):
 
 
 
-def plot_multilevel_timeline(data):
+@instrument
+def plot_multilevel_timeline(data, ax=None):
     """
     Plots multilevel timeline
 
     Args:
        data: data to plot
+       ax: matplotlib axes to draw on, defaults to a new pylab figure
     """
-    f = pylab.figure()
-    for label in data.index.levels[0]:
-        t = data.loc[label, :]
+    if ax is None:
+        ax = pylab().figure().gca()
+    for label in data.index.remove_unused_levels().levels[0]:
+        t = data.xs(label, level=0)
         if len(t) > 0:
-            t.index = t.index.droplevel(level=0)
-            t.plot(label=label)
-    pylab.legend(loc="best")
+            t.plot(label=label, ax=ax)
+    ax.legend(loc="best")
     #return f
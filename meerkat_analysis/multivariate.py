@@ -1,9 +1,14 @@
 import pandas as pd
 import numpy as np
-from matplotlib import pylab
 from textwrap import fill
 from . import univariate
+from . import geo
+from . import util
+from . import sparse
+from .profiling import instrument
+from .plotting import pylab
 
+@instrument
 def cross_table(variables, category1, category2, data, use_names=True):
     """
     Gives a cross table of category1 and category2
@@ -12,9 +17,10 @@ def cross_table(variables, category1, category2, data, use_names=True):
        variables: Variables class
        category1: name of category
        category2: name of category
-       data: structured data in pandas Data Frame
+       data: structured data in pandas Data Frame or SparseData
        use_names: return object used variable names instead of ids
     """
+    data = util.analysis_data(data)
     # if category in ["country", "region", "district", "clinic"]:
     #     return data[category].value_counts()
 
@@ -30,158 +36,170 @@ def cross_table(variables, category1, category2, data, use_names=True):
     else:
         columns = ids1
     results = pd.DataFrame(columns=columns)
+    sums = sparse.cross_sums(data, ids1, ids2)
 
     for number, i2 in enumerate(ids2):
         if use_names:
             name = variables.name(i2)
         else:
             name = i2
-
-        if i2 in data.columns:
-            row = []
-            for i1 in ids1:
-                if i1 in data.columns:
-                    row.append(data[data[i1] == 1][i2].sum())
-                else:
-                    row.append(0)
-            results.loc[name] = row
-        else:
-            results.loc[name] = [0 for _ in ids1]
+        results.loc[name] = list(sums[:, number])
     return results.fillna(0)
 
 
+@instrument
 def incidence_rate_by_category(data, category, variables, populations=None, var_id=None, name=None, exclude=[]):
     """
     Calculate the incidence rates for all the groups in cateogory based on var_id
-    
-    Args: 
+
+    Args:
         data: data frame with data
         category: name of cateogory
         variables: Variables object
-        populations: list of populations to use, same length as number of variables in category
+        populations: dict of populations by variable name or id, defaults
+                     to the number of records in each group
         var_id: variable_id
         name: name of variable
+        exclude: group ids to leave out
     """
-
-    ret = pd.DataFrame(columns=["incidence_rate", "ci_lower", "ci_upper"])
-    for group in variables.groups[category]:
-        if group not in exclude:
-            group_data = data[data[group] == 1]
-            if populations:
-                name = variables.name(group)
-                if name in populations:
-                    population = populations[name]
-                elif group in populations:
-                    population = populations[group]
-                else:
-                    print(name, group)
-                    raise KeyError("Populations needs to include either variable id or name")
-                incidence_rate = univariate.incidence_rate(group_data, population=population,
-                                                       var_id=var_id, name=name, variables=variables)
+    data = util.analysis_data(data)
+    var_id = util.name_id(var_id=var_id, name=name, variables=variables)
+
+    groups = [g for g in variables.groups[category] if g not in exclude]
+    if populations:
+        population = []
+        for group in groups:
+            group_name = variables.name(group)
+            if group_name in populations:
+                population.append(populations[group_name])
+            elif group in populations:
+                population.append(populations[group])
             else:
-                incidence_rate = univariate.incidence_rate(group_data, var_id=var_id, name=name, variables=variables)
-            ret.loc[variables.name(group)] = [incidence_rate[0], incidence_rate[0]-incidence_rate[1][0], incidence_rate[1][1]-incidence_rate[0]]
+                print(group_name, group)
+                raise KeyError("Populations needs to include either variable id or name")
+    else:
+        population = sparse.mask_counts(data, groups)
+    if var_id not in data.columns:
+        ret = pd.DataFrame({"incidence_rate": 0.0, "ci_lower": 0.0,
+                            "ci_upper": 0.0}, index=range(len(groups)),
+                           columns=["incidence_rate", "ci_lower", "ci_upper"])
+    else:
+        counts = sparse.cross_sums(data, groups, [var_id])[:, 0]
+        ret = univariate.incidence_rates(counts, population)
+    ret.index = [variables.name(group) for group in groups]
     return ret
 
 
+@instrument
 def incidence_rate_by_location(data, level, locations, variables, populations=None, var_id=None, name=None, exclude=[]):
     """
-    Calculate the incidence rates for all the groups in cateogory based on var_id
-    
-    Args: 
+    Calculate the incidence rates for all the locations in level based on var_id
+
+    Args:
         data: data frame with data
-        category: name of cateogory
+        level: location level
+        locations: Locations object
         variables: Variables object
-        populations: list of populations to use, same length as number of variables in category
+        populations: dict of populations by location name or id,
+                     defaults to the number of records of each location
         var_id: variable_id
         name: name of variable
+        exclude: location ids to leave out
     """
-
-    ret = pd.DataFrame(columns=["incidence_rate", "ci_lower", "ci_upper"])
-    for loc in locations.get_level(level):
-        if loc not in exclude:
-            group_data = data[data[level] == int(loc)]
-            add = False
-            if populations:
-                name = locations.name(loc)
-                if name in populations:
-                    population = populations[name]
-                elif loc in populations:
-                    population = populations[loc]
-                else:
-                    print(populations)
-                    print(name, loc)
-
-
-                    raise KeyError("Populations needs to include either variable id or name")
-
-                if population != 0:
-                    add = True
-                    incidence_rate = univariate.incidence_rate(group_data, population=population,
-                                                               var_id=var_id, name=name, variables=variables)
+    data = util.analysis_data(data)
+    var_id = util.name_id(var_id=var_id, name=name, variables=variables)
+
+    locs = [loc for loc in locations.get_level(level) if loc not in exclude]
+    counts = geo.location_counts(data, level, var_id).reindex(
+        [int(loc) for loc in locs]).fillna(0)
+    if populations:
+        population = []
+        for loc in locs:
+            loc_name = locations.name(loc)
+            if loc_name in populations:
+                population.append(populations[loc_name])
+            elif loc in populations:
+                population.append(populations[loc])
             else:
-                add = True
-                incidence_rate = univariate.incidence_rate(group_data, var_id=var_id, name=name, variables=variables)
-            if add:
-                ret.loc[locations.name(loc)] = [incidence_rate[0], incidence_rate[0]-incidence_rate[1][0], incidence_rate[1][1]-incidence_rate[0]]
+                print(populations)
+                print(loc_name, loc)
+                raise KeyError("Populations needs to include either variable id or name")
+        population = np.array(population, dtype=np.float64)
+    else:
+        population = counts["rows"].values.astype(np.float64)
+    if var_id not in data.columns:
+        ret = pd.DataFrame({"incidence_rate": 0.0, "ci_lower": 0.0,
+                            "ci_upper": 0.0}, index=range(len(locs)),
+                           columns=["incidence_rate", "ci_lower", "ci_upper"])
+    else:
+        ret = univariate.incidence_rates(counts["count"].values, population)
+    ret.index = [locations.name(loc) for loc in locs]
+    if populations:
+        ret = ret[population != 0]
     return ret
 
 
-def plot_incidence_rate(incidence_rates, mult_factor=1, sort=False):
+@instrument
+def plot_incidence_rate(incidence_rates, mult_factor=1, sort=False, ax=None):
     """
     Plot a bar chart of incidece rates with error bars
 
     Args: 
         incidence_rates: data frame with incidence rates
+        ax: matplotlib axes to draw on, defaults to the current pylab axes
 
     """
 
+    if ax is None:
+        pylab()
     incidence_rates = incidence_rates.copy()
     if sort:
         incidence_rates.sort_index(inplace=True)
     
     error = np.array(incidence_rates[["ci_lower", "ci_upper"]]) * mult_factor
     incidence_rates["incidence_rate"] = incidence_rates["incidence_rate"] * mult_factor
-    incidence_rates["incidence_rate"].plot(kind="bar",yerr=error.transpose())
+    incidence_rates["incidence_rate"].plot(kind="bar",yerr=error.transpose(), ax=ax)
 
-def plot_odds_ratios(odds_ratios, rot=0):
+@instrument
+def plot_odds_ratios(odds_ratios, rot=0, ax=None):
     """
     Plot a bar chart of incidece rates with error bars
 
     Args: 
         incidence_rates: data frame with incidence rates
+        ax: matplotlib axes to draw on, defaults to the current pylab axes
 
     """
+    if ax is None:
+        pylab()
     upper_errors = odds_ratios["ci_upper"] - odds_ratios["odds_ratio"]
     lower_errors = odds_ratios["odds_ratio"] - odds_ratios["ci_lower"]
     
     errors = np.array([upper_errors, lower_errors])
-    odds_ratios["odds_ratio"].plot(kind="bar",yerr=errors, rot=rot)
-    ax = pylab.axis()
-    pylab.plot([ax[0], ax[1]], [1, 1], color="black", alpha=0.4)
+    ax = odds_ratios["odds_ratio"].plot(kind="bar",yerr=errors, rot=rot, ax=ax)
+    limits = ax.axis()
+    ax.plot([limits[0], limits[1]], [1, 1], color="black", alpha=0.4)
     
-def plot_many_incidence_rates(rate_list, rot=0, mult_factor=1):
+@instrument
+def plot_many_incidence_rates(rate_list, rot=0, mult_factor=1, ax=None):
     """
     Plot a dictionary of different incidence rates in one plot
 
     Args: 
         rate_list: ["name", incidence_rate_object]
+        ax: matplotlib axes to draw on, defaults to a new pylab figure
     """
 
-    keys = [r[0] for r in rate_list]
-
-    data = rate_list[0][1].copy()
-    del data["incidence_rate"]
-    del data["ci_lower"]
-    del data["ci_upper"]
-    errors = np.zeros((2, 2, len(rate_list)))
-    for i, k in enumerate(keys):
-        data[fill(k, 20)] = rate_list[i][1]["incidence_rate"] * mult_factor
-        errors[:, 0, i] = rate_list[i][1]["ci_upper"] * mult_factor
-        errors[:, 1, i] = rate_list[i][1]["ci_lower"] * mult_factor
-
-    data.transpose().plot(kind="bar", yerr=errors,  rot=rot)
+    if ax is None:
+        pylab()
+    keys, index, rates = _stack_rates(rate_list, mult_factor)
+    data = pd.DataFrame(rates[:, :, 0],
+                        index=[fill(k, 20) for k in keys], columns=index)
+    # yerr of a data frame has shape (columns, 2, rows)
+    errors = rates[:, :, [2, 1]].transpose(1, 2, 0)
+    data.plot(kind="bar", yerr=errors,  rot=rot, ax=ax)
 
+@instrument
 def odds_ratio_many(data, diseases, group, population=None, variables=None):
     """
     Calculate the incidence rates for all the groups in cateogory based on var_id
@@ -192,10 +210,13 @@ def odds_ratio_many(data, diseases, group, population=None, variables=None):
         group: (gr_1, gr_2)
         population: poulation dict
     """
+    data = util.analysis_data(data)
     ret_data = pd.DataFrame(columns=["odds_ratio", "ci_lower", "ci_upper"])
+    counts = _group_counts(data, diseases, group, population)
 
-    for d in diseases:
-        o_r = odds_ratio(data, d, group, population)
+    for number, d in enumerate(diseases):
+        o_r = _odds_ratio_from_counts(d in data.columns,
+                                      *[c[number] for c in counts])
 
         if variables:
             name = variables.name(d)
@@ -203,6 +224,7 @@ def odds_ratio_many(data, diseases, group, population=None, variables=None):
             name = d
         ret_data.loc[name] = o_r
     return ret_data
+@instrument
 def odds_ratio(data, disease, group, population=None):
     """
     Calculates the odds ratio of disease by group
@@ -212,24 +234,141 @@ def odds_ratio(data, disease, group, population=None):
         group: (gr_1, gr_2)
         population: poulation dict
     """
+    data = util.analysis_data(data)
     if disease not in data.columns:
         return (0, 0, 0)
-    group_one = data[data[group[0]] == 1]
-    group_two = data[data[group[1]] == 1]
-    
-    numerator_count = group_one[disease].sum()
-    denominator_count = group_two[disease].sum()
-    if numerator_count == 0:
-        return (0, 0, 0)
+    counts = _group_counts(data, [disease], group, population)
+    return _odds_ratio_from_counts(True, *[c[0] for c in counts])
+
+
+def _group_counts(data, diseases, group, population=None):
+    """
+    Returns the counts of diseases in both groups and the populations
+    of the groups
+    """
+    numerator_counts = sparse.masked_sums(data, group[0], diseases)
+    denominator_counts = sparse.masked_sums(data, group[1], diseases)
     if population:
         numerator_pop = population[group[0]]
         denominator_pop = population[group[1]]
     else:
-        numerator_pop = len(group_one)
-        denominator_pop = len(group_two)
+        numerator_pop = sparse.mask(data, group[0]).sum()
+        denominator_pop = sparse.mask(data, group[1]).sum()
+    n = len(diseases)
+    return (numerator_counts, [numerator_pop] * n,
+            denominator_counts, [denominator_pop] * n)
+
+
+def _odds_ratio_from_counts(present, numerator_count, numerator_pop,
+                            denominator_count, denominator_pop):
+    """
+    Returns the odds ratio or (0, 0, 0) if there are no cases
+    """
+    if not present or numerator_count == 0:
+        return (0, 0, 0)
     return calc_odds_ratio(numerator_count, numerator_pop, denominator_count, denominator_pop)
 
 
+def _stratum_codes(data, strata, variables=None):
+    """
+    Returns the stratum code of every row and the stratum labels
+    """
+    if variables is not None and strata in variables.groups:
+        ids = sorted(variables.groups[strata])
+        frame = sparse.select(data, ids)
+        codes, ids = frame.meerkat.category(strata, variables)
+        return codes, [variables.name(i) for i in ids]
+    codes, labels = pd.factorize(data[strata], sort=True)
+    return codes, list(labels)
+
+
+@instrument
+def stratified_tables(data, diseases, group, strata, variables=None):
+    """
+    Builds the 2x2 tables of diseases by group in every stratum with one
+    grouped reduction
+
+    Args:
+        data: data frame or SparseData
+        diseases: list of disease ids
+        group: (gr_1, gr_2) the exposed and the reference group
+        strata: a column such as district or a variable category such as
+                age
+        variables: Variables class, needed to stratify by category
+    Returns:
+        (tables, labels): int array of shape (strata, diseases, 4) with the
+        cases and non cases of gr_1 followed by those of gr_2 and the
+        stratum labels
+    """
+    data = util.analysis_data(data)
+    codes, labels = _stratum_codes(data, strata, variables)
+    cases, sizes = sparse.group_counts(data, codes, len(labels), diseases,
+                                       group)
+    cases = cases.round().astype(np.int64)
+    sizes = sizes[:, :, None]
+    tables = np.stack([cases[:, 0], sizes[:, 0] - cases[:, 0],
+                       cases[:, 1], sizes[:, 1] - cases[:, 1]], axis=-1)
+    return tables, labels
+
+
+@instrument
+def mantel_haenszel(tables, z=1.96):
+    """
+    Calculates Mantel-Haenszel odds ratios over strata with the
+    Robins-Breslow-Greenland confidence interval
+
+    Args:
+        tables: array of shape (strata, ..., 4) of 2x2 tables (a, b, c, d)
+        z: z value of the confidence interval
+    Returns:
+        (odds_ratio, ci_lower, ci_upper): arrays over the other axes
+    """
+    a, b, c, d = [tables[..., i].astype(np.float64) for i in range(4)]
+    n = a + b + c + d
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = np.where(n > 0, n, np.nan)
+        r = np.nansum(a * d / n, axis=0)
+        s = np.nansum(b * c / n, axis=0)
+        p = (a + d) / n
+        q = (b + c) / n
+        o_r = r / s
+        variance = (np.nansum(p * a * d / n, axis=0) / (2 * r ** 2) +
+                    np.nansum((p * b * c + q * a * d) / n, axis=0) /
+                    (2 * r * s) +
+                    np.nansum(q * b * c / n, axis=0) / (2 * s ** 2))
+        error = z * np.sqrt(variance)
+        return (o_r, np.exp(np.log(o_r) - error),
+                np.exp(np.log(o_r) + error))
+
+
+@instrument
+def odds_ratio_stratified(data, diseases, group, strata, variables=None):
+    """
+    Calculates the odds ratios of diseases by group adjusted for strata
+
+    Args:
+        data: data frame with data
+        diseases: list of disease ids
+        group: (gr_1, gr_2)
+        strata: a column such as district or a variable category such as
+                age
+        variables: Variables class, used for names and category strata
+    Returns:
+        data frame with odds_ratio, ci_lower and ci_upper for each disease
+    """
+    tables, labels = stratified_tables(data, diseases, group, strata,
+                                       variables)
+    o_r, lower, upper = mantel_haenszel(tables)
+    if variables:
+        index = [variables.name(d) for d in diseases]
+    else:
+        index = list(diseases)
+    return pd.DataFrame({"odds_ratio": o_r, "ci_lower": lower,
+                         "ci_upper": upper}, index=index,
+                        columns=["odds_ratio", "ci_lower", "ci_upper"])
+
+
+@instrument
 def calc_odds_ratio(numerator_count, numerator_pop, denominator_count, denominator_pop):
     """
     Calculates the odds ratio with confidence interval
@@ -252,31 +391,42 @@ def calc_odds_ratio(numerator_count, numerator_pop, denominator_count, denominat
     return (o_r, upper, lower)
 
 
+def _stack_rates(rate_list, mult_factor=1):
+    """
+    Stacks the incidence rate tables of rate_list
+
+    Returns:
+        (keys, index, rates): the names, the index of the first table and
+        an array of shape (tables, index, 3) with incidence_rate, ci_lower
+        and ci_upper of each table aligned to index
+    """
+    keys = [r[0] for r in rate_list]
+    index = rate_list[0][1].index
+    columns = ["incidence_rate", "ci_lower", "ci_upper"]
+    frames = [r[1] if r[1].index.equals(index) else r[1].reindex(index)
+              for r in rate_list]
+    rates = np.stack([np.asarray(f[columns], dtype=np.float64)
+                      for f in frames]) * mult_factor
+    return keys, index, rates
+
+
+@instrument
 def many_incidence_rates_to_flat(rate_list, rot=0, mult_factor=1):
     """
-    Plot a dictionary of different incidence rates in one plot
+    Flattens a list of incidence rates to one row per rate table
 
     Args: 
         rate_list: ["name", incidence_rate_object]
+    Returns:
+        data frame with a rate, error_lower and error_upper column for
+        every location
     """
 
-    keys = [r[0] for r in rate_list]
-
+    keys, index, rates = _stack_rates(rate_list, mult_factor)
     columns = []
-    for i in rate_list[0][1].index:
+    for i in index:
         columns.append(i)
         columns.append(i +" error_lower")
         columns.append(i +" error_upper")
-        
-    data = pd.DataFrame(columns=columns)
-    for i, k in enumerate(keys):
-        row = []
-        for c in rate_list[i][1].index:
-            r = rate_list[i][1].loc[c]
-            row.append(r["incidence_rate"] * mult_factor)
-            row.append(r["ci_lower"] * mult_factor)
-            row.append(r["ci_upper"] * mult_factor)
-        data.loc[k] = row
-
-        
-    return data
+    return pd.DataFrame(rates.reshape(len(keys), -1), index=keys,
+                        columns=columns)
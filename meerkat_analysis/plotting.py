@@ -0,0 +1,31 @@
+import os
+
+STYLE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "style",
+                     "meerkat.mplstyle")
+_pylab = None
+
+
+def pylab():
+    """
+    Returns matplotlib.pylab for the plot functions
+
+    matplotlib is imported and the meerkat style sheet applied the first
+    time a plot is made, so importing meerkat_analysis does not load it.
+
+    Raises:
+       ImportError: if matplotlib is not installed
+    """
+    global _pylab
+    if _pylab is None:
+        from matplotlib import pylab as module
+        module.style.use(STYLE)
+        _pylab = module
+    return _pylab
+
+
+def use_style():
+    """
+    Applies the meerkat style sheet to matplotlib, for plots made
+    directly with pandas or matplotlib before any meerkat plot
+    """
+    pylab()
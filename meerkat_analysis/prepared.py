@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from . import util
+from . import sparse
+from .profiling import instrument
+
+
+@instrument
+def tree_order(locations):
+    """
+    Returns the locations in depth first order of the location tree
+
+    Every location's subtree is a contiguous range in this order.
+
+    Args:
+        locations: Locations class
+    Returns:
+        (order, ranges): list of location ids and a dictionary of
+        location id: (first, last) position of its subtree
+    """
+    children = {}
+    roots = []
+    for l in sorted(locations.locations.values(), key=lambda l: int(l["id"])):
+        parent = l["parent_location"]
+        if parent is None or str(parent) not in locations.locations:
+            roots.append(int(l["id"]))
+        else:
+            children.setdefault(int(parent), []).append(int(l["id"]))
+    order = []
+    ranges = {}
+    for root in roots:
+        stack = [(root, False)]
+        while stack:
+            loc_id, done = stack.pop()
+            if done:
+                ranges[loc_id] = (ranges[loc_id][0], len(order) - 1)
+                continue
+            ranges[loc_id] = (len(order), None)
+            order.append(loc_id)
+            stack.append((loc_id, True))
+            for child in reversed(children.get(loc_id, [])):
+                stack.append((child, False))
+    return order, ranges
+
+
+class PreparedData:
+    """
+    Structured data sorted once for fast date and location slicing
+
+    Sorted by date, date windows are binary searched and returned as
+    slices of the sorted frame instead of boolean mask copies. Sorted by
+    location (in location tree order, then date), every location's
+    subtree is a contiguous range. All indicator functions accept
+    PreparedData in place of a data frame.
+
+    """
+
+    def __init__(self, data, locations=None, sort="date"):
+        """
+        Sorts the data
+
+        Args:
+            data: data frame
+            locations: Locations class, needed to sort by location
+            sort: date or location
+        """
+        data = util.analysis_data(data)
+        if sort not in ["date", "location"]:
+            raise KeyError("Can only sort by date or location")
+        if sort == "location" and locations is None:
+            raise KeyError("Need locations to sort by location")
+        self.locations = locations
+        self.sort = sort
+        dates = data["date"].values
+        if sort == "date":
+            order = np.argsort(dates, kind="mergesort")
+        else:
+            tree, self._ranges = tree_order(locations)
+            positions = pd.Index(tree).get_indexer(
+                np.asarray(data["clinic"]).astype(np.int64))
+            order = np.lexsort((dates, positions))
+            self._positions = positions[order]
+        self.data = data.take(order).reset_index(drop=True)
+        self._dates = self.data["date"].values
+
+    def __len__(self):
+        return len(self.data)
+
+    def analysis_data(self):
+        """
+        Returns the sorted data frame
+        """
+        return self.data
+
+    @instrument
+    def between(self, start_date, end_date):
+        """
+        Returns the rows with start_date <= date <= end_date
+
+        Args:
+            start_date: start date
+            end_date: end date
+        Returns:
+            data frame, a slice of the sorted data when sorted by date
+        """
+        start_date = np.datetime64(pd.Timestamp(start_date))
+        end_date = np.datetime64(pd.Timestamp(end_date))
+        if self.sort == "date":
+            start = np.searchsorted(self._dates, start_date, side="left")
+            end = np.searchsorted(self._dates, end_date, side="right")
+            return self.data.iloc[start:end]
+        return self.data[(self._dates >= start_date) &
+                         (self._dates <= end_date)]
+
+    @instrument
+    def location(self, loc_id):
+        """
+        Returns the data of all clinics in the subtree of loc_id
+
+        Args:
+            loc_id: location id
+        Returns:
+            PreparedData sorted by date
+        """
+        if self.sort == "location":
+            first, last = self._ranges.get(int(loc_id), (0, -1))
+            start = np.searchsorted(self._positions, first, side="left")
+            end = np.searchsorted(self._positions, last, side="right")
+            data = self.data.iloc[start:end]
+        else:
+            if self.locations is None:
+                raise KeyError("Need locations to select a location")
+            clinics = [int(c) for c in self.locations.get_clinics(loc_id)]
+            data = self.data[self.data["clinic"].isin(clinics)]
+        return PreparedData(data, self.locations)
+
+
+@instrument
+def date_window(data, start_date, end_date, columns=()):
+    """
+    Returns the rows of data with start_date <= date <= end_date
+
+    Args:
+        data: data frame, SparseData, PreparedData or dataset object
+        start_date: start date
+        end_date: end date
+        columns: variable columns needed from SparseData
+    Returns:
+        data frame
+    """
+    if isinstance(data, PreparedData):
+        return data.between(start_date, end_date)
+    data = sparse.select(util.analysis_data(data), list(columns))
+    dates = data["date"]
+    return data[(dates >= start_date) & (dates <= end_date)]
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+_active = None
+
+
+class Span:
+    """
+    One timed call of an instrumented function or span
+
+    """
+
+    def __init__(self, name, parent, depth, start, rows_in=None):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.start = start
+        self.seconds = 0.0
+        self.child_seconds = 0.0
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.memory_start = 0
+        self.peak = None
+
+    def to_dict(self):
+        return {"name": self.name, "depth": self.depth, "start": self.start,
+                "seconds": self.seconds, "rows_in": self.rows_in,
+                "rows_out": self.rows_out, "peak": self.peak}
+
+
+class Profile:
+    """
+    Records the instrumented calls made while it is active
+
+    Use it through profile(). For every function the number of calls,
+    the wall time, the time spent outside nested spans, the rows in and
+    out and, with memory, the peak traced allocation are summed up. With
+    trace every call is also kept as a span for the Chrome trace.
+
+    """
+
+    def __init__(self, memory=False, trace=True):
+        """
+        Args:
+            memory: record peak allocations with tracemalloc
+            trace: keep every span, not only the per function totals
+        """
+        self.memory = memory
+        self.trace = trace
+        self.spans = []
+        self.functions = {}
+        self._stack = []
+        self._origin = time.perf_counter()
+        self._thread = threading.get_ident()
+
+    def enter(self, name, rows_in=None):
+        parent = self._stack[-1] if self._stack else None
+        span = Span(name, parent, len(self._stack),
+                    time.perf_counter() - self._origin, rows_in)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            span.memory_start = current
+            span.peak = current
+            tracemalloc.reset_peak()
+        self._stack.append(span)
+        return span
+
+    def exit(self, span, rows_out=None):
+        span.seconds = (time.perf_counter() - self._origin) - span.start
+        span.rows_out = rows_out
+        self._stack.pop()
+        if self.memory:
+            peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+            if span.parent is not None:
+                span.parent.peak = max(span.parent.peak, peak)
+            span.peak = peak - span.memory_start
+        if span.parent is not None:
+            span.parent.child_seconds += span.seconds
+        totals = self.functions.setdefault(span.name, {
+            "calls": 0, "seconds": 0.0, "self_seconds": 0.0, "rows_in": 0,
+            "rows_out": 0, "peak": 0})
+        totals["calls"] += 1
+        # Recursive calls are only counted once in the total time
+        if not any(s.name == span.name for s in self._stack):
+            totals["seconds"] += span.seconds
+        totals["self_seconds"] += span.seconds - span.child_seconds
+        totals["rows_in"] += span.rows_in or 0
+        totals["rows_out"] += span.rows_out or 0
+        totals["peak"] = max(totals["peak"], span.peak or 0)
+        if self.trace:
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        Returns a data frame of the totals per function, slowest first
+        """
+        columns = ["calls", "seconds", "self_seconds", "rows_in", "rows_out",
+                   "peak"]
+        ret = pd.DataFrame.from_dict(self.functions, orient="index",
+                                     columns=columns)
+        return ret.sort_values("seconds", ascending=False)
+
+    def to_json(self, filename=None):
+        """
+        Returns the totals and spans as a json string, written to filename
+        if given
+        """
+        content = json.dumps({"functions": self.functions,
+                              "spans": [s.to_dict() for s in
+                                        sorted(self.spans,
+                                               key=lambda s: s.start)]},
+                             indent=1)
+        if filename:
+            with open(filename, "w") as f:
+                f.write(content)
+        return content
+
+    def to_chrome_trace(self, filename=None):
+        """
+        Returns the spans in the Chrome trace event format, written to
+        filename if given
+
+        The file can be opened in chrome://tracing or ui.perfetto.dev.
+        """
+        events = []
+        for s in sorted(self.spans, key=lambda s: s.start):
+            events.append({"name": s.name, "cat": s.name.split(".")[0],
+                           "ph": "X", "ts": s.start * 1e6,
+                           "dur": s.seconds * 1e6, "pid": os.getpid(),
+                           "tid": self._thread,
+                           "args": {"rows_in": s.rows_in,
+                                    "rows_out": s.rows_out,
+                                    "peak": s.peak}})
+        content = json.dumps({"traceEvents": events,
+                              "displayTimeUnit": "ms"})
+        if filename:
+            with open(filename, "w") as f:
+                f.write(content)
+        return content
+
+
+@contextmanager
+def profile(memory=False, trace=True):
+    """
+    Profiles the instrumented calls in the with block
+
+    Only calls from the thread that started the profile are recorded.
+
+    Args:
+        memory: record peak allocations with tracemalloc, which slows
+                down allocations while active
+        trace: keep every span, not only the per function totals
+    Returns:
+        Profile
+    """
+    global _active
+    previous = _active
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _active = Profile(memory, trace)
+    try:
+        yield _active
+    finally:
+        _active = previous
+        if started:
+            tracemalloc.stop()
+
+
+def rows(value):
+    """
+    Returns the number of rows of a data frame, series or SparseData,
+    for tuples of the first element that has rows, otherwise None
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple):
+        for v in value:
+            if isinstance(v, (pd.DataFrame, pd.Series)):
+                return len(v)
+        return None
+    if hasattr(value, "matrix") and hasattr(value, "keys"):
+        return len(value)
+    return None
+
+
+def _recording():
+    profile = _active
+    if profile is None or threading.get_ident() != profile._thread:
+        return None
+    return profile
+
+
+def instrument(function=None, name=None):
+    """
+    Decorator recording the calls of a function in the active profile
+
+    Without an active profile the only overhead is a global lookup.
+
+    Args:
+        function: function to instrument
+        name: name in the profile, defaults to module.function without
+              the meerkat_analysis prefix
+    """
+    if function is None:
+        return functools.partial(instrument, name=name)
+    if name is None:
+        name = "{}.{}".format(function.__module__.replace(
+            "meerkat_analysis.", ""), function.__qualname__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return function(*args, **kwargs)
+        profile = _recording()
+        if profile is None:
+            return function(*args, **kwargs)
+        rows_in = None
+        for a in args:
+            rows_in = rows(a)
+            if rows_in is not None:
+                break
+        span = profile.enter(name, rows_in)
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            profile.exit(span, rows(result))
+    return wrapper
+
+
+@contextmanager
+def span(name, rows_in=None):
+    """
+    Records the with block as a span nested in the current call
+
+    Args:
+        name: name in the profile
+        rows_in: number of rows going in
+    """
+    profile = _recording() if _active is not None else None
+    if profile is None:
+        yield
+        return
+    current = profile.enter(name, rows_in)
+    try:
+        yield
+    finally:
+        profile.exit(current)
@@ -0,0 +1,173 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from . import indicators
+from . import univariate
+from . import multivariate
+from .plotting import STYLE
+from .profiling import instrument
+
+PLOTS = {
+    "level_total": indicators.plot_level_total,
+    "multilevel_timeline": indicators.plot_multilevel_timeline,
+    "timeline_by_category": univariate.plot_timeline_by_category,
+    "incidence_rate": multivariate.plot_incidence_rate,
+    "odds_ratios": multivariate.plot_odds_ratios,
+    "many_incidence_rates": multivariate.plot_many_incidence_rates,
+}
+
+_shared = None
+
+
+class FigureSpec:
+    """
+    Specification of one figure for render
+
+    """
+
+    def __init__(self, plot, filename, args=(), kwargs=None, figsize=None,
+                 dpi=None, title=None):
+        """
+        Args:
+            plot: name of the plot function in PLOTS
+            filename: file to write, the format is taken from the extension
+                      such as .png or .svg
+            args: positional arguments of the plot function, usually the
+                  precomputed data
+            kwargs: keyword arguments of the plot function
+            figsize: (width, height) in inches, defaults to the style
+            dpi: resolution, defaults to the style
+            title: title of the axes
+        """
+        if plot not in PLOTS:
+            raise KeyError("Unknown plot {}".format(plot))
+        self.plot = plot
+        self.filename = filename
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.figsize = figsize
+        self.dpi = dpi
+        self.title = title
+
+
+class _Shared:
+    """
+    Reference to an argument in the table sent once to every worker
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def pack(specs):
+    """
+    Splits the figure specs into a table of their data and light tasks
+
+    Every argument that is not a scalar is stored once in the table, also
+    when several figures use it, and replaced by a reference.
+
+    Args:
+        specs: list of FigureSpec
+    Returns:
+        (table, tasks): list of arguments and a tuple per figure
+    """
+    table = []
+    positions = {}
+
+    def share(value):
+        if _is_scalar(value):
+            return value
+        if id(value) not in positions:
+            positions[id(value)] = len(table)
+            table.append(value)
+        return _Shared(positions[id(value)])
+
+    tasks = []
+    for spec in specs:
+        tasks.append((spec.plot, spec.filename,
+                      tuple(share(a) for a in spec.args),
+                      {k: share(v) for k, v in spec.kwargs.items()},
+                      spec.figsize, spec.dpi, spec.title))
+    return table, tasks
+
+
+def _initialize(table):
+    global _shared
+    _shared = table
+
+
+def _resolve(value, table):
+    if isinstance(value, _Shared):
+        value = table[value.index]
+        # Plot functions such as plot_level_total modify their data
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value.copy()
+    return value
+
+
+def render_figure(task, table):
+    """
+    Draws one packed figure on its own Agg figure and writes it
+
+    No pylab state is used, the style sheet is applied in a context.
+
+    Args:
+        task: task from pack
+        table: table from pack
+    Returns:
+        filename
+    """
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    plot, filename, args, kwargs, figsize, dpi, title = task
+    args = [_resolve(a, table) for a in args]
+    kwargs = {k: _resolve(v, table) for k, v in kwargs.items()}
+    with matplotlib.style.context(STYLE):
+        figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot(1, 1, 1)
+        PLOTS[plot](*args, ax=ax, **kwargs)
+        if title:
+            ax.set_title(title)
+        figure.savefig(filename, dpi=dpi or "figure")
+    return filename
+
+
+def _render_in_worker(task):
+    return render_figure(task, _shared)
+
+
+@instrument
+def render(specs, workers=None, chunksize=4):
+    """
+    Renders figures in a process pool
+
+    The data of the figures is sent once to every worker process, tasks
+    only hold references to it. The plot functions get copies of data
+    frame and series arguments, so they may modify them.
+
+    Args:
+        specs: list of FigureSpec
+        workers: number of processes, defaults to the number of cpus. 1
+                 renders in this process
+        chunksize: figures per task sent to a worker
+    Returns:
+        list of the filenames written
+    """
+    table, tasks = pack(specs)
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        return [render_figure(t, table) for t in tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize,
+                             initargs=(table,)) as pool:
+        return list(pool.map(_render_in_worker, tasks, chunksize=chunksize))
+
@@ -0,0 +1,360 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+from .util.loading import KEY_COLUMNS
+from .profiling import instrument
+
+
+class SparseData:
+    """
+    Structured data with the variable columns stored as a sparse matrix
+
+    The date and location keys are kept as a dense data frame and the
+    wide, mostly zero variable columns as a scipy CSC matrix.
+
+    """
+
+    def __init__(self, keys, matrix, variable_columns):
+        """
+        Initialises the class
+
+        Args:
+            keys: data frame with the dense key columns
+            matrix: sparse matrix with one column per variable
+            variable_columns: names of the matrix columns
+        """
+        self.keys = keys.reset_index(drop=True)
+        self.matrix = sp.csc_matrix(matrix)
+        self.variable_columns = list(variable_columns)
+        self._index = {c: i for i, c in enumerate(self.variable_columns)}
+        self.attrs = {}
+
+    @classmethod
+    def from_frame(cls, data, variable_columns=None, key_columns=KEY_COLUMNS):
+        """
+        Converts a data frame
+
+        Args:
+            data: data frame
+            variable_columns: the columns to store sparse, defaults to all
+                              columns not in key_columns
+            key_columns: columns kept dense
+        """
+        if variable_columns is None:
+            variable_columns = [c for c in data.columns
+                                if c not in key_columns]
+        keys = data[[c for c in data.columns if c not in variable_columns]]
+        values = data[variable_columns].fillna(0)
+        dtype = np.result_type(*values.dtypes) if len(variable_columns) else np.uint8
+        matrix = sp.csc_matrix(values.values.astype(dtype))
+        return cls(keys, matrix, variable_columns)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Concatenates the rows of several SparseData objects with the same
+        columns
+
+        Args:
+            parts: list of SparseData
+        """
+        keys = pd.concat([p.keys for p in parts], ignore_index=True)
+        matrix = sp.vstack([p.matrix for p in parts], format="csc")
+        return cls(keys, matrix, parts[0].variable_columns)
+
+    @property
+    def columns(self):
+        return pd.Index(list(self.keys.columns) + self.variable_columns)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, column):
+        if column in self.keys.columns:
+            return self.keys[column]
+        return pd.Series(self.column(column), name=column)
+
+    def column(self, var_id):
+        """
+        Returns a dense array of one variable column
+
+        Args:
+            var_id: variable id
+        """
+        i = self._index[var_id]
+        return self.matrix[:, i].toarray().ravel()
+
+    def sums(self, ids):
+        """
+        Returns the column sums of ids, 0 for columns not in the data
+
+        Args:
+            ids: list of variable ids
+        """
+        totals = np.asarray(self.matrix.sum(axis=0)).ravel()
+        return np.array([totals[self._index[i]] if i in self._index else 0
+                         for i in ids])
+
+    def mask_counts(self, ids):
+        """
+        Returns the number of rows where each of ids is 1, 0 for columns
+        not in the data
+
+        Args:
+            ids: list of variable ids
+        """
+        present = [i for i in ids if i in self._index]
+        ret = np.zeros(len(ids), dtype=np.int64)
+        if present:
+            ones = self.matrix[:, [self._index[i] for i in present]] == 1
+            counts = np.asarray(ones.sum(axis=0)).ravel()
+            ret[[ids.index(i) for i in present]] = counts
+        return ret
+
+    def mask(self, mask_id):
+        """
+        Returns a boolean array of the rows where mask_id is 1
+
+        Args:
+            mask_id: variable id
+        """
+        if mask_id in self._index:
+            return self.column(mask_id) == 1
+        return np.asarray(self[mask_id] == 1)
+
+    def cross(self, ids1, ids2):
+        """
+        Returns a matrix with the sum of ids2 over rows where ids1 is 1
+
+        Args:
+            ids1: list of variable ids
+            ids2: list of variable ids
+        Returns:
+            array of shape (len(ids1), len(ids2))
+        """
+        present1 = [i for i in ids1 if i in self._index]
+        present2 = [i for i in ids2 if i in self._index]
+        ret = np.zeros((len(ids1), len(ids2)))
+        if present1 and present2:
+            one = self.matrix[:, [self._index[i] for i in present1]] == 1
+            two = self.matrix[:, [self._index[i] for i in present2]]
+            product = (one.astype(np.float64).T @ two.astype(np.float64)).toarray()
+            rows = [ids1.index(i) for i in present1]
+            cols = [ids2.index(i) for i in present2]
+            ret[np.ix_(rows, cols)] = product
+        return ret
+
+    def grouped_sums(self, keys, n_keys, ids):
+        """
+        Returns the sums of ids over the rows of every key
+
+        Args:
+            keys: integer key of every row, rows with -1 are left out
+            n_keys: number of keys
+            ids: list of variable ids
+        Returns:
+            array of shape (n_keys, len(ids))
+        """
+        present = [i for i in ids if i in self._index]
+        ret = np.zeros((n_keys, len(ids)))
+        if present:
+            values = self.matrix[:, [self._index[i] for i in present]]
+            ret[:, [ids.index(i) for i in present]] = (
+                key_matrix(keys, n_keys) @ values.astype(np.float64)).toarray()
+        return ret
+
+    def select(self, columns):
+        """
+        Returns a dense data frame with the key columns and columns
+
+        Args:
+            columns: list of variable ids
+        """
+        ret = self.keys.copy()
+        for c in columns:
+            if c in self._index:
+                ret[c] = self.column(c)
+        return ret
+
+    def to_frame(self):
+        """
+        Returns the data as a dense data frame
+        """
+        return self.select(self.variable_columns)
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used
+        """
+        m = self.matrix
+        return int(self.keys.memory_usage(deep=True).sum() + m.data.nbytes +
+                   m.indices.nbytes + m.indptr.nbytes)
+
+
+@instrument
+def select(data, columns):
+    """
+    Returns data with at least the key columns and columns as a dense
+    data frame
+
+    Args:
+        data: data frame or SparseData
+        columns: list of variable ids
+    """
+    if isinstance(data, SparseData):
+        return data.select(columns)
+    return data
+
+
+@instrument
+def column_sums(data, ids):
+    """
+    Returns the sums of the columns ids, 0 for columns not in data
+
+    Args:
+        data: data frame or SparseData
+        ids: list of variable ids
+    """
+    if isinstance(data, SparseData):
+        return data.sums(ids)
+    present = [i for i in ids if i in data.columns]
+    totals = data[present].sum()
+    return np.array([totals[i] if i in present else 0 for i in ids])
+
+
+@instrument
+def mask(data, mask_id):
+    """
+    Returns a boolean array of the rows where mask_id is 1
+
+    Args:
+        data: data frame or SparseData
+        mask_id: column name
+    """
+    if isinstance(data, SparseData):
+        return data.mask(mask_id)
+    return np.asarray(data[mask_id] == 1)
+
+
+@instrument
+def mask_counts(data, ids):
+    """
+    Returns the number of rows where each of ids is 1, 0 for columns not
+    in data
+
+    Args:
+        data: data frame or SparseData
+        ids: list of variable ids
+    """
+    if isinstance(data, SparseData):
+        return data.mask_counts(ids)
+    present = [i for i in ids if i in data.columns]
+    totals = (data[present] == 1).sum()
+    return np.array([totals[i] if i in present else 0 for i in ids])
+
+
+@instrument
+def masked_sums(data, mask_id, ids):
+    """
+    Returns the sums of ids over the rows where mask_id is 1
+
+    Args:
+        data: data frame or SparseData
+        mask_id: column name
+        ids: list of variable ids
+    """
+    if isinstance(data, SparseData):
+        return data.cross([mask_id], ids)[0]
+    return column_sums(data[mask(data, mask_id)], ids)
+
+
+@instrument
+def cross_sums(data, ids1, ids2):
+    """
+    Returns a matrix with the sum of ids2 over the rows where ids1 is 1
+
+    Args:
+        data: data frame or SparseData
+        ids1: list of variable ids
+        ids2: list of variable ids
+    Returns:
+        array of shape (len(ids1), len(ids2))
+    """
+    if isinstance(data, SparseData):
+        return data.cross(ids1, ids2)
+    present1 = [i for i in ids1 if i in data.columns]
+    present2 = [i for i in ids2 if i in data.columns]
+    ret = np.zeros((len(ids1), len(ids2)))
+    if present1 and present2:
+        one = (data[present1] == 1).values.astype(np.float64)
+        two = data[present2].fillna(0).values.astype(np.float64)
+        rows = [ids1.index(i) for i in present1]
+        cols = [ids2.index(i) for i in present2]
+        ret[np.ix_(rows, cols)] = one.T @ two
+    return ret
+
+
+@instrument
+def key_matrix(keys, n_keys):
+    """
+    Returns a sparse (n_keys, rows) matrix with a one in the keys of every
+    row
+    """
+    keys = np.atleast_2d(keys)
+    which, rows = np.nonzero(keys >= 0)
+    return sp.csr_matrix((np.ones(len(rows)), (keys[which, rows], rows)),
+                         shape=(n_keys, keys.shape[1]))
+
+
+@instrument
+def grouped_sums(data, keys, n_keys, ids):
+    """
+    Returns the sums of ids over the rows of every key in one reduction
+
+    Args:
+        data: data frame or SparseData
+        keys: integer key of every row, rows with -1 are left out. A 2d
+              array of keys adds rows to several keys
+        n_keys: number of keys
+        ids: list of variable ids
+    Returns:
+        array of shape (n_keys, len(ids))
+    """
+    if isinstance(data, SparseData):
+        return data.grouped_sums(keys, n_keys, ids)
+    present = [i for i in ids if i in data.columns]
+    ret = np.zeros((n_keys, len(ids)))
+    if present:
+        values = data[present].fillna(0).values.astype(np.float64)
+        ret[:, [ids.index(i) for i in present]] = (
+            key_matrix(keys, n_keys) @ values)
+    return ret
+
+
+@instrument
+def group_counts(data, codes, n_codes, ids, groups):
+    """
+    Returns the sums of ids and the number of rows in each group for
+    every code, with one reduction
+
+    Args:
+        data: data frame or SparseData
+        codes: integer code of every row, rows with -1 are left out
+        n_codes: number of codes
+        ids: list of variable ids
+        groups: list of group ids, a row is in a group if the group is 1
+    Returns:
+        (sums, sizes): arrays of shape (n_codes, len(groups), len(ids))
+        and (n_codes, len(groups))
+    """
+    codes = np.asarray(codes)
+    keys = np.full((len(groups), len(codes)), -1, dtype=np.int64)
+    for number, g in enumerate(groups):
+        in_group = mask(data, g) & (codes >= 0)
+        keys[number, in_group] = len(groups) * codes[in_group] + number
+    n_keys = len(groups) * n_codes
+    sums = grouped_sums(data, keys, n_keys, list(ids))
+    sizes = np.bincount(keys[keys >= 0], minlength=n_keys)
+    return (sums.reshape(n_codes, len(groups), len(ids)),
+            sizes.reshape(n_codes, len(groups)))
@@ -0,0 +1,314 @@
+import pandas as pd
+import numpy as np
+
+from . import util
+from . import sparse
+from .indicators import fix_dates
+from .profiling import instrument
+
+
+class WeeklyCount:
+    """
+    Partial aggregate for indicators.count
+
+    """
+
+    def __init__(self, var_id, start_date=None, end_date=None,
+                 epi_week_start_day=None):
+        self.var_id = var_id
+        self.start_date, self.end_date, self.freq = fix_dates(
+            start_date, end_date, epi_week_start_day)
+        self.columns = [var_id]
+        self.total = 0
+        self.timeline = pd.Series(dtype=float)
+
+    def add(self, data):
+        """
+        Folds a chunk of data into the aggregate
+
+        Args:
+            data: data frame
+        """
+        data = _between(data, self.start_date, self.end_date)
+        if self.var_id not in data.columns:
+            return
+        self.total += data[self.var_id].sum()
+        timeline = data.groupby(
+            pd.Grouper(key="date", freq=self.freq, label="left",
+                       closed="left")).sum()[self.var_id]
+        self.timeline = self.timeline.add(timeline, fill_value=0)
+
+    def merge(self, other):
+        """
+        Merges another partial aggregate into this one
+
+        Args:
+            other: WeeklyCount
+        """
+        self.total += other.total
+        self.timeline = self.timeline.add(other.timeline, fill_value=0)
+
+    def finalize(self):
+        """
+        Returns (total, timeline) as indicators.count
+        """
+        dates = pd.date_range(self.start_date, self.end_date, freq=self.freq,
+                              closed="left")
+        return (self.total, self.timeline.reindex(dates).fillna(0))
+
+
+class DistinctSites:
+    """
+    Partial aggregate for indicators.number_of_sites
+
+    """
+
+    def __init__(self, level, start_date=None, end_date=None,
+                 epi_week_start_day=None):
+        self.level = level
+        self.start_date, self.end_date, self.freq = fix_dates(
+            start_date, end_date, epi_week_start_day)
+        self.columns = [level]
+        self.sites = set()
+        self.weekly_sites = {}
+
+    def add(self, data):
+        data = _between(data, self.start_date, self.end_date)
+        self.sites.update(data[self.level].dropna().unique())
+        weeks = data.groupby(
+            pd.Grouper(key="date", freq=self.freq, label="left",
+                       closed="left"))[self.level].unique()
+        for week, sites in weeks.items():
+            self.weekly_sites.setdefault(week, set()).update(
+                s for s in sites if not pd.isnull(s))
+
+    def merge(self, other):
+        self.sites.update(other.sites)
+        for week, sites in other.weekly_sites.items():
+            self.weekly_sites.setdefault(week, set()).update(sites)
+
+    def finalize(self):
+        """
+        Returns (total, timeline) as indicators.number_of_sites
+        """
+        dates = pd.date_range(self.start_date, self.end_date, freq=self.freq,
+                              closed="left")
+        timeline = pd.Series({week: len(sites) for week, sites
+                              in self.weekly_sites.items()}, dtype=float)
+        return (len(self.sites), timeline.reindex(dates).fillna(0))
+
+
+class CategoryBreakdown:
+    """
+    Partial aggregate for univariate.breakdown_by_category
+
+    """
+
+    def __init__(self, variables, category, use_names=True):
+        if (category not in ["country", "region", "district", "clinic"] and
+                category not in variables.groups):
+            raise KeyError("Category does not exists")
+        self.variables = variables
+        self.category = category
+        self.use_names = use_names
+        self.columns = [category]
+        self.ids = sorted(variables.groups.get(category, []))
+        self.sums = np.zeros(len(self.ids))
+        self.value_counts = pd.Series(dtype=float)
+
+    def add(self, data):
+        if not self.ids:
+            self.value_counts = self.value_counts.add(
+                data[self.category].value_counts(), fill_value=0)
+        else:
+            self.sums += sparse.column_sums(data, self.ids)
+
+    def merge(self, other):
+        self.sums += other.sums
+        self.value_counts = self.value_counts.add(other.value_counts,
+                                                  fill_value=0)
+
+    def finalize(self):
+        """
+        Returns the breakdown as univariate.breakdown_by_category
+        """
+        if not self.ids:
+            return self.value_counts.astype(int).sort_values(ascending=False)
+        results = pd.DataFrame(columns=["value"])
+        for number, i in enumerate(self.ids):
+            if self.use_names:
+                name = self.variables.name(i)
+            else:
+                name = i
+            results.loc[name] = [self.sums[number]]
+        return results
+
+
+class CrossTable:
+    """
+    Partial aggregate for multivariate.cross_table
+
+    """
+
+    def __init__(self, variables, category1, category2, use_names=True):
+        if category1 not in variables.groups:
+            raise KeyError("Category1 does not exists")
+        if category2 not in variables.groups:
+            raise KeyError("Category2 does not exists")
+        self.variables = variables
+        self.use_names = use_names
+        self.columns = [category1, category2]
+        self.ids1 = sorted(variables.groups[category1])
+        self.ids2 = sorted(variables.groups[category2])
+        self.sums = np.zeros((len(self.ids1), len(self.ids2)))
+
+    def add(self, data):
+        self.sums += sparse.cross_sums(data, self.ids1, self.ids2)
+
+    def merge(self, other):
+        self.sums += other.sums
+
+    def finalize(self):
+        """
+        Returns the cross table as multivariate.cross_table
+        """
+        if self.use_names:
+            columns = [self.variables.name(i) for i in self.ids1]
+        else:
+            columns = self.ids1
+        results = pd.DataFrame(columns=columns)
+        for number, i2 in enumerate(self.ids2):
+            if self.use_names:
+                name = self.variables.name(i2)
+            else:
+                name = i2
+            results.loc[name] = list(self.sums[:, number])
+        return results.fillna(0)
+
+
+def _between(data, start_date, end_date):
+    """
+    Returns the rows of data between start_date and end_date
+    """
+    return data[(data["date"] >= start_date) & (data["date"] <= end_date)]
+
+
+def iter_chunks(source, variables, columns=None, chunk_rows=100000):
+    """
+    Returns a generator of data chunks
+
+    Args:
+        source: csv filename or an iterable of data frames
+        variables: Variables class
+        columns: only read these columns, see util.resolve_columns
+        chunk_rows: number of rows per chunk
+    """
+    if isinstance(source, str):
+        return util.iter_structured_csv(source, variables, columns=columns,
+                                        chunk_rows=chunk_rows)
+    return iter(source)
+
+
+@instrument
+def aggregate(source, aggregates, variables, chunk_rows=100000):
+    """
+    Folds all the chunks of source into the partial aggregates in one pass
+
+    Only the columns needed by the aggregates are read and at most one
+    chunk is held in memory at a time.
+
+    Args:
+        source: csv filename or an iterable of data frames
+        aggregates: list of partial aggregates
+        variables: Variables class
+        chunk_rows: number of rows per chunk
+    Returns:
+        list of the finalized results
+    """
+    columns = [a.columns for a in aggregates]
+    for chunk in iter_chunks(source, variables, columns=columns,
+                             chunk_rows=chunk_rows):
+        for a in aggregates:
+            a.add(chunk)
+    return [a.finalize() for a in aggregates]
+
+
+@instrument
+def count(source, variables, var_id, start_date=None, end_date=None,
+          epi_week_start_day=None, chunk_rows=100000):
+    """
+    Streaming version of indicators.count
+
+    Args:
+        source: csv filename or an iterable of data frames
+        variables: Variables class
+        var_id: the variable id to count
+        start_date: start date
+        end_date: end_date
+        epi_week_start_day: what day of the week to start the timeline(Mon=0)
+        chunk_rows: number of rows per chunk
+    Returns:
+       (total, timeline): a total and weekly timeline
+    """
+    return aggregate(source, [WeeklyCount(var_id, start_date, end_date,
+                                          epi_week_start_day)],
+                     variables, chunk_rows=chunk_rows)[0]
+
+
+@instrument
+def number_of_sites(source, variables, level, start_date=None, end_date=None,
+                    epi_week_start_day=None, chunk_rows=100000):
+    """
+    Streaming version of indicators.number_of_sites
+
+    Args:
+        source: csv filename or an iterable of data frames
+        variables: Variables class
+        level: location level
+        start_date: start date
+        end_date: end_date
+        epi_week_start_day: what day of the week to start the timeline(Mon=0)
+        chunk_rows: number of rows per chunk
+    Returns:
+       (total, timeline): a total and weekly timeline
+    """
+    return aggregate(source, [DistinctSites(level, start_date, end_date,
+                                            epi_week_start_day)],
+                     variables, chunk_rows=chunk_rows)[0]
+
+
+@instrument
+def breakdown_by_category(source, variables, category, use_names=True,
+                          chunk_rows=100000):
+    """
+    Streaming version of univariate.breakdown_by_category
+
+    Args:
+        source: csv filename or an iterable of data frames
+        variables: Variables class
+        category: name of category
+        use_names: return object used variable names instead of ids
+        chunk_rows: number of rows per chunk
+    """
+    return aggregate(source, [CategoryBreakdown(variables, category,
+                                                use_names)],
+                     variables, chunk_rows=chunk_rows)[0]
+
+
+@instrument
+def cross_table(source, variables, category1, category2, use_names=True,
+                chunk_rows=100000):
+    """
+    Streaming version of multivariate.cross_table
+
+    Args:
+        source: csv filename or an iterable of data frames
+        variables: Variables class
+        category1: name of category
+        category2: name of category
+        use_names: return object used variable names instead of ids
+        chunk_rows: number of rows per chunk
+    """
+    return aggregate(source, [CrossTable(variables, category1, category2,
+                                         use_names)],
+                     variables, chunk_rows=chunk_rows)[0]
@@ -0,0 +1,342 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from . import util
+from .profiling import instrument
+
+AGES = ["<5", "5-15", "15-25", "25-40", "40-60", ">60"]
+KEYS = ["id", "country", "region", "district", "clinic", "date"]
+
+
+@instrument
+def make_locations(n_clinics, n_regions=5, clinics_per_district=10,
+                   start_date="2016-01-01", end_date="2017-12-31", seed=0):
+    """
+    Generates a location tree in the shape of locations.json
+
+    The country has n_regions regions with districts of
+    clinics_per_district clinics. Clinics have populations, a POINT
+    geolocation close to their district and region, a start_date
+    between start_date and end_date and about 5% of them do not do case
+    reporting. The populations of the other levels are the sums of their
+    children.
+
+    Args:
+        n_clinics: number of clinics
+        n_regions: number of regions
+        clinics_per_district: number of clinics in each district
+        start_date: first start date of the clinics
+        end_date: last date of the data
+        seed: random seed
+    Returns:
+        dictionary of location id: location
+    """
+    rng = np.random.default_rng(seed)
+    n_districts = max(1, -(-n_clinics // clinics_per_district))
+    locations = {}
+
+    def add(level, parent, point=None, population=0, case_report=None,
+            start=None):
+        loc_id = len(locations) + 1
+        locations[str(loc_id)] = {
+            "id": loc_id, "name": "{} {}".format(level.title(), loc_id),
+            "level": level, "parent_location": parent,
+            "population": int(population), "case_report": case_report,
+            "start_date": start, "clinic_type": None, "deviceid": None,
+            "other": None,
+            "geolocation": "POINT({:.5f} {:.5f})".format(point[1], point[0])
+            if point is not None else None}
+        return loc_id
+
+    country = add("country", None)
+    centre = np.array([15.0, 35.0])
+    regions = [(add("region", country), centre + rng.normal(0, 2, 2))
+               for r in range(n_regions)]
+    districts = []
+    for d in range(n_districts):
+        region, point = regions[d % n_regions]
+        districts.append((add("district", region), point +
+                          rng.normal(0, 0.5, 2)))
+    days = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days
+    starts = pd.Timestamp(start_date) + pd.to_timedelta(
+        np.where(rng.random(n_clinics) < 0.8, 0,
+                 rng.integers(0, max(days, 1), n_clinics)), unit="D")
+    populations = np.round(rng.lognormal(8.5, 0.7, n_clinics))
+    case_report = rng.random(n_clinics) >= 0.05
+    for c in range(n_clinics):
+        district, point = districts[c % n_districts]
+        add("clinic", district, point + rng.normal(0, 0.1, 2),
+            populations[c], int(case_report[c]),
+            starts[c].strftime("%Y-%m-%dT%H:%M:%S"))
+    for level in ["district", "region", "country"]:
+        for loc in locations.values():
+            if loc["level"] == level:
+                loc["population"] = sum(
+                    l["population"] for l in locations.values()
+                    if l["parent_location"] == loc["id"])
+    return locations
+
+
+@instrument
+def make_variables(n_diseases=20):
+    """
+    Generates variables in the shape of variables.json
+
+    There is a total tot_1, genders gen_1 and gen_2, six age groups age_1
+    to age_6 and n_diseases variables dis_1, ... in the disease category.
+
+    Args:
+        n_diseases: number of disease variables
+    Returns:
+        dictionary of variable id: variable
+    """
+    definitions = [("tot_1", "Total", "total"), ("gen_1", "Male", "gender"),
+                   ("gen_2", "Female", "gender")]
+    definitions += [("age_{}".format(i + 1), a, "age")
+                    for i, a in enumerate(AGES)]
+    definitions += [("dis_{}".format(i + 1), "Disease {}".format(i + 1),
+                     "disease") for i in range(n_diseases)]
+    return {v: {"id": v, "name": name, "category": [category]}
+            for v, name, category in definitions}
+
+
+def seasonality(n_diseases, seed=0):
+    """
+    Returns the daily base rate, amplitude and peak day of year of the
+    seasonal case curves of the diseases
+    """
+    rng = np.random.default_rng([seed, 1])
+    return (np.minimum(rng.lognormal(np.log(0.005), 1, n_diseases), 0.2),
+            rng.uniform(0, 0.9, n_diseases),
+            rng.uniform(0, 365, n_diseases))
+
+
+def generate_chunks(locations, variables, rows, start_date="2016-01-01",
+                    end_date="2017-12-31", chunk_rows=1000000, seed=0):
+    """
+    Generates structured data in chunks
+
+    Records are drawn from the case reporting clinics in proportion to
+    their populations, at a uniform time between the clinic start date
+    and end_date. Every record has one gender and one age group and the
+    probability of each disease follows a yearly cosine curve. Each chunk
+    has its own random stream, the data only depends on seed and
+    chunk_rows.
+
+    Args:
+        locations: dictionary as made by make_locations
+        variables: dictionary as made by make_variables
+        rows: total number of rows
+        start_date: first date
+        end_date: last date
+        chunk_rows: rows per chunk
+        seed: random seed
+    Returns:
+        iterator of data frames with the compact types of
+        load_structured_data
+    """
+    clinics = [l for l in locations.values()
+               if l["level"] == "clinic" and l["case_report"]]
+    if not clinics:
+        raise KeyError("No case reporting clinics")
+    parents = {int(l["id"]): l["parent_location"]
+               for l in locations.values()}
+    clinic_ids = np.array([l["id"] for l in clinics], dtype=np.int64)
+    districts = np.array([parents[c] for c in clinic_ids], dtype=np.int64)
+    regions = np.array([parents[d] for d in districts], dtype=np.int64)
+    countries = np.array([parents[r] for r in regions], dtype=np.int64)
+    weights = np.array([l["population"] for l in clinics], dtype=np.float64)
+    weights /= weights.sum()
+    end = pd.Timestamp(end_date).value
+    starts = np.array([max(pd.Timestamp(l["start_date"] or start_date),
+                           pd.Timestamp(start_date)).value
+                       for l in clinics], dtype=np.int64)
+    minute = 60 * 10**9
+    diseases = sorted((v for v in variables
+                       if "disease" in variables[v]["category"]),
+                      key=lambda v: int(v.split("_")[-1])
+                      if v.split("_")[-1].isdigit() else v)
+    base, amplitude, peak = seasonality(len(diseases), seed)
+    n_chunks = -(-rows // chunk_rows)
+    streams = np.random.SeedSequence(seed).spawn(n_chunks)
+    for number, stream in enumerate(streams):
+        rng = np.random.default_rng(stream)
+        size = min(chunk_rows, rows - number * chunk_rows)
+        which = rng.choice(len(clinic_ids), size, p=weights)
+        span = np.maximum(end - starts[which], 0)
+        dates = starts[which] + (rng.random(size) * span).astype(
+            np.int64) // minute * minute
+        data = pd.DataFrame({
+            "id": np.arange(number * chunk_rows,
+                            number * chunk_rows + size),
+            "country": countries[which], "region": regions[which],
+            "district": districts[which], "clinic": clinic_ids[which],
+            "date": pd.to_datetime(dates)})
+        columns = {"tot_1": np.ones(size, dtype=np.uint8)}
+        gender = rng.integers(0, 2, size)
+        age = rng.integers(0, len(AGES), size)
+        for i in range(2):
+            columns["gen_{}".format(i + 1)] = (gender == i).astype(np.uint8)
+        for i in range(len(AGES)):
+            columns["age_{}".format(i + 1)] = (age == i).astype(np.uint8)
+        day_of_year = (dates // (1440 * minute)) % 365.25
+        for i, d in enumerate(diseases):
+            # Thinning: candidates are drawn at the peak rate and kept with
+            # the ratio of the seasonal rate, so the cost is per case
+            highest = min(base[i] * (1 + amplitude[i]), 1)
+            candidates = np.unique(rng.integers(
+                0, size, rng.binomial(size, highest)))
+            rate = base[i] * (1 + amplitude[i] * np.cos(
+                2 * np.pi * (day_of_year[candidates] - peak[i]) / 365.25))
+            column = np.zeros(size, dtype=np.uint8)
+            column[candidates[rng.random(len(candidates)) * highest <
+                              rate]] = 1
+            columns[d] = column
+        columns = {v: c for v, c in columns.items() if v in variables}
+        yield pd.concat([data, pd.DataFrame(columns)], axis=1)
+
+
+@instrument
+def generate_data(locations, variables, rows, start_date="2016-01-01",
+                  end_date="2017-12-31", chunk_rows=1000000, seed=0):
+    """
+    Returns all chunks of generate_chunks as one data frame
+    """
+    return pd.concat(generate_chunks(locations, variables, rows, start_date,
+                                     end_date, chunk_rows, seed),
+                     ignore_index=True)
+
+
+def _digits(values, width):
+    """
+    Returns ascii digits of non negative integers as a (rows, width) uint8
+    array and a mask without the leading zeros
+    """
+    values = np.asarray(values, dtype=np.int64)
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = (values[:, None] // powers % 10 + ord("0")).astype(np.uint8)
+    keep = values[:, None] >= powers
+    keep[:, -1] = True
+    return digits, keep
+
+
+def _text(values, width):
+    """
+    Returns strings of equal length as a (rows, width) uint8 array
+    """
+    text = np.asarray(values, dtype="S{}".format(width))
+    return text.view(np.uint8).reshape(len(values), width)
+
+
+@instrument
+def export_bytes(data, columns):
+    """
+    Formats data as the lines of a structured export
+
+    The dates are written with util.loading.DATE_FORMAT and variables
+    that are 0 are left empty. Rows are formatted as fixed width byte
+    arrays and the padding is removed with one mask.
+
+    Args:
+        data: data frame from generate_chunks
+        columns: the variable columns to write
+    Returns:
+        bytes
+    """
+    size = len(data)
+    parts = []
+    masks = []
+
+    def field(digits, keep):
+        parts.append(digits)
+        masks.append(keep)
+        parts.append(np.full((size, 1), ord(","), dtype=np.uint8))
+        masks.append(np.ones((size, 1), dtype=bool))
+
+    for c in KEYS[:-1]:
+        values = np.asarray(data[c], dtype=np.int64)
+        width = len(str(values.max())) if size else 1
+        field(*_digits(values, width))
+    dates = data["date"].dt
+    text = np.concatenate([
+        _digits(dates.day, 2)[0], _text(["/"] * size, 1),
+        _digits(dates.month, 2)[0], _text(["/"] * size, 1),
+        _digits(dates.year % 100, 2)[0], _text([" "] * size, 1),
+        _digits(dates.hour, 2)[0], _text([":"] * size, 1),
+        _digits(dates.minute, 2)[0]], axis=1)
+    parts.append(text)
+    masks.append(np.ones(text.shape, dtype=bool))
+    # Every variable is a comma and a 1 that is only kept if it is set
+    cells = np.empty((size, 2 * len(columns) + 1), dtype=np.uint8)
+    cells[:, 0:-1:2] = ord(",")
+    cells[:, 1::2] = ord("1")
+    cells[:, -1] = ord("\n")
+    keep = np.ones(cells.shape, dtype=bool)
+    keep[:, 1::2] = np.asarray(data[columns]) != 0
+    parts.append(cells)
+    masks.append(keep)
+    return np.concatenate(parts, axis=1)[np.concatenate(masks,
+                                                        axis=1)].tobytes()
+
+
+@instrument
+def write_export(filename, locations, variables, rows,
+                 start_date="2016-01-01", end_date="2017-12-31",
+                 chunk_rows=1000000, seed=0):
+    """
+    Writes a structured export csv of generated data chunk by chunk
+
+    Args:
+        filename: filename of the csv
+        locations: dictionary as made by make_locations
+        variables: dictionary as made by make_variables
+        rows: number of rows
+        start_date: first date
+        end_date: last date
+        chunk_rows: rows per chunk
+        seed: random seed
+    """
+    columns = None
+    with open(filename, "wb") as f:
+        for chunk in generate_chunks(locations, variables, rows, start_date,
+                                     end_date, chunk_rows, seed):
+            if columns is None:
+                columns = [c for c in chunk.columns if c not in KEYS]
+                f.write((",".join(KEYS + columns) + "\n").encode())
+            f.write(export_bytes(chunk, columns))
+
+
+@instrument
+def write_dataset(directory, rows, n_clinics=500, n_diseases=20,
+                  start_date="2016-01-01", end_date="2017-12-31",
+                  chunk_rows=1000000, seed=0):
+    """
+    Writes locations.json, variables.json and export.csv of a generated
+    dataset to directory
+
+    Args:
+        directory: directory to write to
+        rows: number of rows of the export
+        n_clinics: number of clinics
+        n_diseases: number of disease variables
+        start_date: first date
+        end_date: last date
+        chunk_rows: rows per chunk
+        seed: random seed
+    Returns:
+        (locations, variables, filename): Locations and Variables classes
+        and the filename of the export
+    """
+    locations = make_locations(n_clinics, start_date=start_date,
+                               end_date=end_date, seed=seed)
+    variables = make_variables(n_diseases)
+    for name, content in [("locations.json", locations),
+                          ("variables.json", variables)]:
+        with open(os.path.join(directory, name), "w") as f:
+            json.dump(content, f, indent=1)
+    filename = os.path.join(directory, "export.csv")
+    write_export(filename, locations, variables, rows, start_date, end_date,
+                 chunk_rows, seed)
+    return util.Locations(locations), util.Variables(variables), filename
@@ -0,0 +1,99 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import util, accessor
+
+
+class AccessorTest(unittest.TestCase):
+    """ Testing the data.meerkat accessor"""
+
+    def setUp(self):
+        self.data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv",
+                                parse_dates=["date"], dayfirst=True).fillna(0)
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        self.variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]}})
+
+    def test_epi_week(self):
+        for day, freq in [(0, "W-MON"), (2, "W-WED")]:
+            weeks = self.data.meerkat.epi_week(freq)
+            expected = self.data.groupby(
+                pd.Grouper(key="date", freq=freq, label="left",
+                           closed="left"))["id"].apply(list)
+            for week, ids in expected.items():
+                self.assertEqual(
+                    sorted(self.data["id"][weeks == np.datetime64(week)]),
+                    sorted(ids))
+            self.assertIs(self.data.meerkat.epi_week(day), weeks)
+
+    def test_invalidation(self):
+        weeks = self.data.meerkat.epi_week(0)
+        self.assertIs(self.data.meerkat.epi_week(0), weeks)
+        self.data["date"] = self.data["date"] - pd.Timedelta(days=7)
+        new_weeks = self.data.meerkat.epi_week(0)
+        self.assertIsNot(new_weeks, weeks)
+        self.assertEqual(new_weeks[0], weeks[0] - np.timedelta64(7, "D"))
+        self.data.loc[0, "date"] = pd.Timestamp("2016-01-01")
+        self.data.meerkat.clear()
+        self.assertEqual(self.data.meerkat.epi_week(0)[0],
+                         np.datetime64("2015-12-28"))
+
+    def test_swap(self):
+        weeks = self.data.meerkat.epi_week(0).copy()
+        second = int(np.flatnonzero(weeks != weeks[0])[0])
+        self.data.loc[[0, second], "date"] = \
+            self.data.loc[[second, 0], "date"].values
+        self.data.meerkat.clear()
+        new_weeks = self.data.meerkat.epi_week(0)
+        self.assertEqual(new_weeks[0], weeks[second])
+        self.assertEqual(new_weeks[second], weeks[0])
+
+    def test_ancestor(self):
+        with self.assertRaises(KeyError):
+            self.data.meerkat.ancestor("district")
+        self.data.meerkat.bind(locations=self.locations)
+        districts = self.data.meerkat.ancestor("district")
+        parents = {7: 4, 8: 4, 9: 4, 10: 5, 11: 6}
+        self.assertEqual(list(districts),
+                         [parents[c] for c in self.data["clinic"]])
+        regions = self.data.meerkat.ancestor("region")
+        self.assertEqual(list(regions), list(self.data["region"]))
+
+    def test_category(self):
+        self.data.meerkat.bind(variables=self.variables)
+        positions, ids = self.data.meerkat.category("gender")
+        self.assertEqual(ids, ["gen_1", "gen_2"])
+        self.assertEqual(list(positions),
+                         list(np.where(self.data["gen_1"] == 1, 0, 1)))
+        with self.assertRaises(KeyError):
+            self.data.meerkat.category("not_a_category")
+
+    def test_fingerprint(self):
+        values = np.arange(10, dtype=np.int32)
+        before = accessor.fingerprint(values)
+        self.assertEqual(accessor.fingerprint(values), before)
+        self.assertNotEqual(accessor.fingerprint(values.copy()), before)
+        self.assertNotEqual(accessor.fingerprint(values[:5]), before)
+        self.assertNotEqual(accessor.fingerprint(values.astype(np.int64)),
+                            before)
+        # In-place edits are not detected, they need data.meerkat.clear()
+        values[3] = 100
+        self.assertEqual(accessor.fingerprint(values), before)
+
+    def test_first_records(self):
+        data = pd.concat([self.data, self.data.iloc[[0, 3, 3]]],
+                         ignore_index=True)
+        data.loc[len(data) - 1, "gen_1"] = 1 - data.loc[len(data) - 1,
+                                                        "gen_1"]
+        for column in ["tot_1", "gen_1"]:
+            expected = data.drop_duplicates(
+                subset=["region", "district", "clinic", "date", column])
+            mask = data.meerkat.first_records(column)
+            self.assertEqual(list(data.index[mask]), list(expected.index))
+        key = data.meerkat.record_key()
+        self.assertEqual(key[0], key[len(self.data)])
+        self.assertNotEqual(key[0], key[1])
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import bootstrap, indicators, multivariate, univariate
+
+
+class BootstrapTest(unittest.TestCase):
+    """ Testing cluster bootstrap confidence intervals"""
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        n = 5000
+        self.data = pd.DataFrame({"clinic": random.randint(0, 50, n),
+                                  "date": pd.Timestamp("2016-06-01")})
+        self.data["exposed"] = (random.rand(n) < 0.4).astype(float)
+        self.data["reference"] = 1 - self.data["exposed"]
+        self.data["disease"] = (
+            random.rand(n) < 0.1 + 0.05 * self.data["exposed"]).astype(float)
+
+    def test_cluster_weights(self):
+        weights = bootstrap.cluster_weights(np.random.default_rng(1), 20, 100)
+        self.assertEqual(weights.shape, (100, 20))
+        self.assertTrue((weights.sum(axis=1) == 20).all())
+
+    def test_incidence_rate(self):
+        rate, ci = bootstrap.incidence_rate(self.data, "disease", seed=1,
+                                            replicates=2000)
+        self.assertAlmostEqual(
+            rate, univariate.incidence_rate(self.data, var_id="disease")[0])
+        self.assertTrue(ci[0] < rate < ci[1])
+
+    def test_count_over_count(self):
+        proportion, ci = bootstrap.count_over_count(
+            self.data, "disease", "exposed", seed=1, replicates=2000)
+        expected = indicators.count_over_count(
+            self.data, "disease", "exposed", start_date="2016-01-01",
+            end_date="2016-12-31")[0]
+        self.assertAlmostEqual(proportion, expected)
+        self.assertTrue(ci[0] < proportion < ci[1])
+
+    def test_odds_ratio(self):
+        ratios = bootstrap.odds_ratio(self.data, ["disease"],
+                                      ("exposed", "reference"), seed=1,
+                                      replicates=2000, workers=1)
+        expected = multivariate.odds_ratio(self.data, "disease",
+                                           ("exposed", "reference"))
+        row = ratios.loc["disease"]
+        self.assertAlmostEqual(row["odds_ratio"], expected[0])
+        self.assertTrue(row["ci_lower"] < row["odds_ratio"] < row["ci_upper"])
+        parallel = bootstrap.odds_ratio(self.data, ["disease"],
+                                        ("exposed", "reference"), seed=1,
+                                        replicates=2000, workers=2)
+        self.assertTrue(parallel.equals(ratios))
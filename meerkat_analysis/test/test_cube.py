@@ -0,0 +1,92 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import cube, indicators, geo, univariate, util
+
+
+class CubeTest(unittest.TestCase):
+    """ Testing the count cube"""
+
+    def setUp(self):
+        self.filename = "meerkat_analysis/test/test_data/univariate.csv"
+        self.data = pd.read_csv(self.filename, parse_dates=["date"],
+                                dayfirst=True).fillna(0)
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        variables = {"tot_1": {"id": "tot_1", "name": "Total",
+                               "category": []},
+                     "gen_1": {"id": "gen_1", "name": "Male",
+                               "category": ["gender"]},
+                     "gen_2": {"id": "gen_2", "name": "Female",
+                               "category": ["gender"]}}
+        self.variables = util.Variables(variables)
+        self.dates = {"epi_week_start_day": 0, "start_date": "2016/1/1",
+                      "end_date": "2016/12/31"}
+        self.cube = cube.build_cube(self.data, self.variables)
+
+    def test_build(self):
+        self.assertEqual(list(self.cube.locations), [7, 8, 10, 11])
+        self.assertEqual(self.cube.variables, ["tot_1", "gen_1", "gen_2"])
+        self.assertEqual(self.cube.counts.dtype, np.int32)
+        self.assertEqual(self.cube.counts.sum(axis=(0, 1)).tolist(),
+                         [10, 4, 6])
+        chunks = [self.data[:3], self.data[3:7], self.data[7:]]
+        chunked = cube.build_cube(chunks, self.variables)
+        self.assertTrue(np.array_equal(chunked.counts, self.cube.counts))
+        self.assertTrue(np.array_equal(chunked.days, self.cube.days))
+        from_file = cube.build_cube(self.filename, self.variables,
+                                    chunk_rows=4)
+        self.assertTrue(np.array_equal(from_file.counts, self.cube.counts))
+
+    def test_count(self):
+        for var_id in ["tot_1", "gen_2", "not_a_variable"]:
+            expected = indicators.count(self.data, var_id, **self.dates) \
+                if var_id in self.data.columns else (0, None)
+            total, timeline = cube.count(self.cube, var_id, **self.dates)
+            self.assertEqual(total, expected[0])
+            if expected[1] is not None:
+                self.assertTrue(timeline.equals(expected[1]))
+        with self.assertRaises(KeyError):
+            cube.count(self.cube, "tot_1", epi_week_start_day=2)
+
+    def test_number_per_week_clinic(self):
+        for variable in ["tot_1", "gen_2"]:
+            expected = indicators.number_per_week_clinic(
+                self.data, variable, self.locations, **self.dates)
+            clinics = cube.number_per_week_clinic(
+                self.cube, variable, self.locations, **self.dates)
+            self.assertTrue(clinics.index.equals(expected.index))
+            self.assertEqual(list(clinics), list(expected))
+
+    def test_rollup(self):
+        regions = self.cube.rollup(self.locations, "region")
+        self.assertEqual(list(regions.locations), [2, 3])
+        self.assertEqual(regions.variable("tot_1").sum(axis=1).tolist(),
+                         [5, 5])
+        self.assertEqual(regions.counts.sum(), self.cube.counts.sum())
+        self.assertEqual(regions.counts.dtype, np.int32)
+        large = cube.CountCube(self.cube.locations, self.cube.weeks,
+                               self.cube.variables,
+                               np.full(self.cube.counts.shape, 2**30,
+                                       dtype=np.int32), 0)
+        country = large.rollup(self.locations, "country")
+        self.assertEqual(country.counts.dtype, np.int64)
+        self.assertEqual(country.counts[0, 0, 0],
+                         2**30 * len(self.cube.locations))
+
+    def test_breakdown_and_incidence(self):
+        expected = univariate.breakdown_by_category(self.variables, "gender",
+                                                    self.data)
+        breakdown = cube.breakdown_by_category(self.cube, self.variables,
+                                               "gender")
+        self.assertEqual(list(breakdown["value"]), list(expected["value"]))
+        expected = geo.incidence_rate_by_location(self.data, self.locations,
+                                                  "gen_2")
+        rates = cube.incidence_rate_by_location(self.cube, self.locations,
+                                                "gen_2")
+        self.assertTrue(np.allclose(rates.values.astype(float),
+                                    expected.values.astype(float)))
+        regions = cube.incidence_rate_by_location(self.cube, self.locations,
+                                                  "gen_2", level="region")
+        self.assertEqual(list(regions.index), ["Region 1", "Region 2"])
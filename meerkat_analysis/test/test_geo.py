@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import pandas as pd
 from statsmodels.stats import proportion
 
@@ -41,3 +42,143 @@ class GeoTest(unittest.TestCase):
                                                level="region").fillna(0)
         self.assertEqual(rates.loc["Region 1"]["incidence_rate"], 2 / 6500)
         self.assertEqual(rates.loc["Region 2"]["incidence_rate"], 2 / 2000 )
+
+    def test_incidence_rates_by_level(self):
+        data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv")
+        locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        counts = geo.location_counts(data, "clinic", "gen_1")
+        self.assertEqual(counts.loc[11].tolist(), [2, 5])
+        rates = geo.incidence_rates_by_level(data, locations, "gen_1")
+        self.assertEqual(list(rates.index.levels[0]),
+                         ["clinic", "district", "region", "country"])
+        for level in ["clinic", "district", "region"]:
+            expected = geo.incidence_rate_by_location(data, locations,
+                                                      "gen_1", level=level)
+            self.assertTrue(rates.loc[level].equals(expected))
+        self.assertEqual(rates.loc[("country", "Demo"), "incidence_rate"],
+                         4 / 8500)
+
+    def test_parse_geolocation(self):
+        self.assertEqual(geo.parse_geolocation("0.1,0.2"), (0.1, 0.2))
+        self.assertEqual(geo.parse_geolocation("POINT(30.5 -1.25)"),
+                         (-1.25, 30.5))
+        for value in [None, "", "abc", "1,2,3", "95,10"]:
+            self.assertIsNone(geo.parse_geolocation(value))
+
+    def test_location_index(self):
+        locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        index = geo.LocationIndex(locations)
+        self.assertEqual(list(index.ids), [7, 8, 9, 10, 11])
+        ids, distances = index.nearest([0.11, 0.3], [0.1, 0.21], k=2)
+        self.assertEqual(ids.tolist(), [[7, 8], [10, 8]])
+        self.assertAlmostEqual(distances[0, 0], 1.112, places=3)
+        ids, distances = index.nearest(0, 0, k=6)
+        self.assertEqual(ids[0, -1], -1)
+        self.assertEqual(distances[0, -1], float("inf"))
+        within = index.within([0.1, 10], [0.1, 10], 20)
+        self.assertEqual(within[0].tolist(), [7, 8])
+        self.assertEqual(within[1].tolist(), [])
+        self.assertEqual(index.catchment([0.11, 5], [0.1, 5]).tolist(),
+                         [7, 10])
+        self.assertEqual(index.catchment([0.11, 5, -0.1], [0.1, 5, 0.4],
+                                         level="district",
+                                         max_distance=100).tolist(),
+                         [4, -1, 6])
+
+        empty = geo.LocationIndex(locations, level="district")
+        self.assertEqual(len(empty), 0)
+        ids, distances = empty.nearest([0.1, 5], [0.1, 5], k=2)
+        self.assertEqual(ids.tolist(), [[-1, -1], [-1, -1]])
+        self.assertTrue(np.isinf(distances).all())
+        self.assertEqual([w.tolist() for w in empty.within(0.1, 0.1, 20)],
+                         [[]])
+        self.assertEqual(empty.catchment([0.1, 5], [0.1, 5],
+                                         level="region").tolist(), [-1, -1])
+
+    def test_space_time_scan(self):
+        random = np.random.RandomState(0)
+        locs = {"1": {"id": 1, "level": "country", "parent_location": None,
+                      "geolocation": None}}
+        lat = random.uniform(-1, 1, 40)
+        lon = random.uniform(30, 32, 40)
+        for i in range(40):
+            locs[str(i + 2)] = {"id": i + 2, "level": "clinic",
+                                "parent_location": 1, "case_report": 1,
+                                "geolocation": "{},{}".format(lat[i], lon[i])}
+        locations = util.Locations(locs)
+        weeks = pd.date_range("2016-01-04", periods=12, freq="W-MON")
+        counts = pd.DataFrame(random.poisson(3, (40, 12)),
+                              index=np.arange(2, 42), columns=weeks)
+        near = np.argsort((lat - lat[0]) ** 2 + (lon - lon[0]) ** 2)[:3]
+        counts.iloc[near, 9:11] += 12
+
+        clusters = geo.space_time_scan(counts, locations, max_neighbours=5,
+                                       max_weeks=4, replicates=19, seed=1)
+        top = clusters.iloc[0]
+        self.assertTrue(set(near + 2) <= set(top["clinics"]))
+        self.assertEqual(top["start"], weeks[9])
+        self.assertEqual(top["end"], weeks[10])
+        self.assertEqual(top["p_value"], 1 / 20)
+        self.assertGreater(top["observed"], top["expected"])
+        for a, b in zip(clusters["clinics"][:-1], clusters["clinics"][1:]):
+            self.assertFalse(set(a) & set(b))
+
+        stacked = counts.stack()
+        prospective = geo.space_time_scan(stacked, locations,
+                                          max_neighbours=5, max_weeks=4,
+                                          prospective=True, replicates=19,
+                                          seed=1, workers=2)
+        self.assertTrue((prospective["end"] == weeks[-1]).all())
+
+        counts.index = counts.index.astype(str)
+        named = geo.space_time_scan(counts, locations, max_neighbours=5,
+                                    max_weeks=4, replicates=19, seed=1)
+        self.assertEqual(named.iloc[0]["clinics"], top["clinics"])
+        self.assertEqual(named.iloc[0]["observed"], top["observed"])
+        counts.index = counts.index + "00"
+        with self.assertRaises(KeyError):
+            geo.space_time_scan(counts, locations)
+
+    def test_empirical_bayes(self):
+        random = np.random.RandomState(0)
+        populations = random.randint(100, 10000, 500).astype(float)
+        populations[3] = 0
+        true_rates = random.gamma(5, 0.002, 500)
+        cases = random.poisson(true_rates * populations)
+        smoothed = geo.empirical_bayes(np.stack([cases, cases * 0], axis=1),
+                                       populations)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            raw = cases / populations
+        self.assertTrue(np.isnan(smoothed[3]).all())
+        self.assertLess(np.nanmean((smoothed[:, 0] - true_rates) ** 2),
+                        np.nanmean((raw - true_rates) ** 2))
+        self.assertEqual(np.nansum(smoothed[:, 1]), 0)
+        # A rate is never moved beyond the mean
+        mean = cases.sum() / populations.sum()
+        known = populations > 0
+        self.assertTrue(((smoothed[known, 0] - mean) *
+                         (raw[known] - mean) >= -1e-15).all())
+
+    def test_smoothed_rates(self):
+        data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv")
+        locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        rates = geo.smoothed_rates(data, locations, ["gen_1", "gen_2"])
+        self.assertEqual(list(rates.index), ["Clinic 1", "Clinic 2",
+                                             "Clinic 4", "Clinic 5"])
+        self.assertEqual(list(rates.columns), ["gen_1", "gen_2"])
+        local = geo.smoothed_rates(data, locations, ["gen_1"], local=True)
+        # Clinic 5 is the only clinic in its district
+        self.assertAlmostEqual(local.loc["Clinic 5", "gen_1"], 2 / 2000)
+        raw = geo.incidence_rate_by_location(data, locations, "gen_1")
+        self.assertTrue((rates["gen_1"] >= 0).all())
+        self.assertEqual(len(raw), len(rates))
+        empty = geo.smoothed_rates(data.iloc[:0], locations, ["gen_1"],
+                                   local=True)
+        self.assertEqual(list(empty.index), list(rates.index))
+        self.assertTrue((empty["gen_1"].fillna(0) == 0).all())
+        data["clinic"] = np.nan
+        missing = geo.smoothed_rates(data, locations, ["gen_1"])
+        self.assertTrue((missing["gen_1"].fillna(0) == 0).all())
@@ -1,7 +1,11 @@
 import unittest
 import pandas as pd
 
-from meerkat_analysis import multivariate, util
+import numpy as np
+from statsmodels.stats import proportion
+from statsmodels.stats.contingency_tables import StratifiedTable
+
+from meerkat_analysis import multivariate, sparse, util
 
 
 class MultivariateTest(unittest.TestCase):
@@ -18,3 +22,132 @@ class MultivariateTest(unittest.TestCase):
 
         self.assertEqual(cross_table[">60"]["Female"], 3)
         self.assertEqual(cross_table[">60"]["Male"], 0)
+
+    def test_incidence_rate_by_location(self):
+        data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv")
+        locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": []}})
+        rates = multivariate.incidence_rate_by_location(
+            data, "clinic", locations, variables, name="Male")
+        self.assertEqual(list(rates.index),
+                         ["Clinic 1", "Clinic 2", "Clinic 4", "Clinic 5"])
+        self.assertEqual(rates.loc["Clinic 5", "incidence_rate"], 2 / 5)
+        self.assertEqual(rates.loc["Clinic 1", "incidence_rate"], 1 / 2)
+
+        populations = {"Region 1": 6500, "3": 0}
+        rates = multivariate.incidence_rate_by_location(
+            data, "region", locations, variables, populations=populations,
+            var_id="gen_1")
+        self.assertEqual(list(rates.index), ["Region 1"])
+        self.assertEqual(rates.loc["Region 1", "incidence_rate"], 2 / 6500)
+
+        rates = multivariate.incidence_rate_by_location(
+            data, "district", locations, variables, var_id="gen_1",
+            exclude=["5"])
+        self.assertEqual(list(rates.index), ["District 1", "District 3"])
+        with self.assertRaises(KeyError):
+            multivariate.incidence_rate_by_location(
+                data, "region", locations, variables, var_id="gen_1",
+                populations={"Region 1": 6500})
+
+    def test_incidence_rate_by_category(self):
+        data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv")
+        variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]},
+             "age_6": {"id": "age_6", "name": ">60", "category": ["age"]}})
+        rates = multivariate.incidence_rate_by_category(
+            data, "gender", variables, var_id="age_6")
+        self.assertEqual(rates.loc["Female", "incidence_rate"], 3 / 6)
+        self.assertEqual(rates.loc["Male", "incidence_rate"], 0)
+        ci = proportion.proportion_confint(3, 6, method="wilson")
+        self.assertAlmostEqual(rates.loc["Female", "ci_lower"], 0.5 - ci[0])
+        self.assertAlmostEqual(rates.loc["Female", "ci_upper"], ci[1] - 0.5)
+
+        rates = multivariate.incidence_rate_by_category(
+            data, "gender", variables, name=">60",
+            populations={"Female": 30, "gen_1": 20}, exclude=["gen_1"])
+        self.assertEqual(list(rates.index), ["Female"])
+        self.assertEqual(rates.loc["Female", "incidence_rate"], 3 / 30)
+
+        sparse_data = sparse.SparseData.from_frame(data.fillna(0))
+        sparse_rates = multivariate.incidence_rate_by_category(
+            sparse_data, "gender", variables, var_id="age_6")
+        self.assertEqual(sparse_rates.loc["Female", "incidence_rate"], 3 / 6)
+        with self.assertRaises(KeyError):
+            multivariate.incidence_rate_by_category(
+                data, "gender", variables, var_id="age_6",
+                populations={"Female": 30})
+
+    def test_odds_ratio_stratified(self):
+        random = np.random.RandomState(1)
+        n = 2000
+        data = pd.DataFrame({"district": random.randint(4, 8, n)})
+        data["exposed"] = (random.rand(n) < 0.4).astype(float)
+        data["reference"] = 1 - data["exposed"]
+        for k in range(3):
+            risk = 0.1 + 0.05 * k + 0.1 * k * data["exposed"]
+            data["dis_{}".format(k)] = (random.rand(n) < risk).astype(float)
+        diseases = ["dis_0", "dis_1", "dis_2"]
+        tables, labels = multivariate.stratified_tables(
+            data, diseases, ("exposed", "reference"), "district")
+        self.assertEqual(tables.shape, (4, 3, 4))
+        self.assertEqual(labels, [4, 5, 6, 7])
+        self.assertEqual(tables.sum(), n * 3)
+        ratios = multivariate.odds_ratio_stratified(
+            data, diseases, ("exposed", "reference"), "district")
+        for k, d in enumerate(diseases):
+            expected = StratifiedTable([t[k].reshape(2, 2) for t in tables])
+            self.assertAlmostEqual(ratios.loc[d, "odds_ratio"],
+                                   expected.oddsratio_pooled)
+            lower, upper = expected.oddsratio_pooled_confint()
+            self.assertAlmostEqual(ratios.loc[d, "ci_lower"], lower, places=3)
+            self.assertAlmostEqual(ratios.loc[d, "ci_upper"], upper, places=3)
+
+    def test_odds_ratio_stratified_by_category(self):
+        data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv")
+        variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]},
+             "age_5": {"id": "age_5", "name": "40-60", "category": ["age"]},
+             "age_6": {"id": "age_6", "name": ">60", "category": ["age"]}})
+        tables, labels = multivariate.stratified_tables(
+            data, ["tot_1"], ("gen_1", "gen_2"), "age", variables)
+        self.assertEqual(labels, ["40-60", ">60"])
+        self.assertEqual(tables[:, 0].tolist(), [[0, 0, 0, 0],
+                                                 [0, 0, 3, 0]])
+        sparse_tables, labels = multivariate.stratified_tables(
+            sparse.SparseData.from_frame(data.fillna(0)), ["tot_1"],
+            ("gen_1", "gen_2"), "age", variables)
+        self.assertTrue(np.array_equal(sparse_tables, tables))
+
+    def test_many_incidence_rates(self):
+        index = ["Clinic 1", "Clinic 2", "Clinic 3"]
+        rate_list = []
+        for k in range(4):
+            rates = pd.DataFrame({"incidence_rate": [k, k + 1, k + 2],
+                                  "ci_lower": [0.1 * k, 0.2, 0.3],
+                                  "ci_upper": [0.4, 0.5 * k, 0.6]},
+                                 index=index)
+            rate_list.append(("Rate {}".format(k), rates))
+        rate_list[2] = ("Rate 2", rate_list[2][1].iloc[::-1])
+        flat = multivariate.many_incidence_rates_to_flat(rate_list,
+                                                         mult_factor=10)
+        self.assertEqual(list(flat.columns)[:3],
+                         ["Clinic 1", "Clinic 1 error_lower",
+                          "Clinic 1 error_upper"])
+        self.assertEqual(list(flat.index),
+                         ["Rate 0", "Rate 1", "Rate 2", "Rate 3"])
+        for key, rates in rate_list:
+            for c in index:
+                self.assertAlmostEqual(flat.loc[key, c],
+                                       rates.loc[c, "incidence_rate"] * 10)
+                self.assertAlmostEqual(flat.loc[key, c + " error_lower"],
+                                       rates.loc[c, "ci_lower"] * 10)
+                self.assertAlmostEqual(flat.loc[key, c + " error_upper"],
+                                       rates.loc[c, "ci_upper"] * 10)
+        multivariate.plot_many_incidence_rates(rate_list)
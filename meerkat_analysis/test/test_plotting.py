@@ -0,0 +1,27 @@
+import sys
+import unittest
+import subprocess
+
+from meerkat_analysis import plotting
+
+
+class PlottingTest(unittest.TestCase):
+    """ Testing the lazy matplotlib import"""
+
+    def test_import_without_matplotlib(self):
+        statement = ("import sys; from meerkat_analysis import indicators, "
+                     "univariate, multivariate, geo, cube, bootstrap; "
+                     "print('matplotlib' in sys.modules)")
+        output = subprocess.run([sys.executable, "-c", statement],
+                                check=True, capture_output=True, text=True)
+        self.assertEqual(output.stdout.strip(), "False")
+
+    def test_pylab(self):
+        pylab = plotting.pylab()
+        self.assertIs(pylab, plotting.pylab())
+        self.assertTrue(hasattr(pylab, "subplots"))
+        self.assertIn("matplotlib", sys.modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
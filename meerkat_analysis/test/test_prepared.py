@@ -0,0 +1,64 @@
+import unittest
+import pandas as pd
+
+from meerkat_analysis import prepared, indicators, util
+
+
+class PreparedDataTest(unittest.TestCase):
+    """ Testing PreparedData"""
+
+    def setUp(self):
+        self.data = pd.read_csv("meerkat_analysis/test/test_data/univariate.csv",
+                                parse_dates=["date"], dayfirst=True).fillna(0)
+        self.data = self.data.sample(frac=1, random_state=1)
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        self.dates = {"epi_week_start_day": 0, "start_date": "2016/1/1",
+                      "end_date": "2016/12/31"}
+
+    def test_tree_order(self):
+        order, ranges = prepared.tree_order(self.locations)
+        self.assertEqual(order[0], 1)
+        self.assertEqual(ranges[1], (0, len(order) - 1))
+        first, last = ranges[2]
+        self.assertEqual(sorted(order[first:last + 1]),
+                         [2, 4, 5, 7, 8, 9, 10])
+
+    def test_between(self):
+        data = prepared.PreparedData(self.data)
+        window = data.between("2016/06/16", "2016/06/20")
+        self.assertEqual(list(window["id"]), [2, 3, 4, 5, 6])
+        self.assertEqual(len(data.between("2017/01/01", "2017/12/31")), 0)
+
+    def test_location(self):
+        for sort in ["date", "location"]:
+            data = prepared.PreparedData(self.data, self.locations, sort=sort)
+            region = data.location(2)
+            self.assertEqual(sorted(region.data["id"]), [1, 3, 5, 7, 9])
+            self.assertEqual(list(region.data["id"]), [1, 3, 5, 7, 9])
+            self.assertEqual(list(data.location(11).data["id"]),
+                             [2, 4, 6, 8, 10])
+            window = region.between("2016/06/16", "2016/06/20")
+            self.assertEqual(list(window["id"]), [3, 5])
+
+    def test_indicators(self):
+        data = prepared.PreparedData(self.data)
+        total, timeline = indicators.count(data, "gen_2", **self.dates)
+        expected = indicators.count(self.data, "gen_2", **self.dates)
+        self.assertEqual(total, expected[0])
+        self.assertTrue(timeline.equals(expected[1]))
+
+        proportion, timeline = indicators.count_over_count(
+            data, "gen_2", "tot_1", **self.dates)
+        self.assertEqual(proportion, 0.6)
+        self.assertEqual(timeline["2016/06/13"], 0.2)
+
+        total, timeline = indicators.number_of_sites(data, "clinic",
+                                                     **self.dates)
+        self.assertEqual(total, 4)
+        self.assertEqual(timeline["2016/06/20"], 3)
+
+        clinics = indicators.number_per_week_clinic(data, "tot_1",
+                                                    self.locations,
+                                                    **self.dates)
+        self.assertEqual(clinics.loc[11, "2016/06/13"], 3)
@@ -0,0 +1,88 @@
+import json
+import unittest
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import profiling, indicators, univariate, util
+
+
+class ProfilingTest(unittest.TestCase):
+    """ Testing the instrumentation"""
+
+    def setUp(self):
+        self.data = pd.read_csv(
+            "meerkat_analysis/test/test_data/univariate.csv",
+            parse_dates=["date"], dayfirst=True).fillna(0)
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+
+    def test_disabled(self):
+        self.assertIsNone(profiling._active)
+        total, timeline = indicators.count(self.data, "gen_1", "2016-01-01",
+                                           "2016-12-31")
+        self.assertEqual(total, 4)
+        self.assertEqual(indicators.count.__name__, "count")
+        self.assertIn("Args", indicators.count.__doc__)
+
+    def test_profile(self):
+        with profiling.profile(memory=True) as p:
+            indicators.count(self.data, "gen_1", "2016-01-01", "2016-12-31")
+            indicators.number_per_week_clinic(self.data, "gen_1",
+                                              self.locations, "2016-01-01",
+                                              "2016-12-31")
+            univariate.incidence_rate(self.data, population=100,
+                                      var_id="gen_1")
+        self.assertIsNone(profiling._active)
+        functions = p.functions
+        self.assertEqual(functions["indicators.count"]["calls"], 1)
+        self.assertEqual(functions["indicators.fix_dates"]["calls"], 2)
+        self.assertEqual(functions["indicators.count"]["rows_in"], 10)
+        self.assertIn("indicators.number_per_week_clinic.groupby", functions)
+        self.assertIn("statsmodels.proportion_confint", functions)
+        count = functions["indicators.count"]
+        self.assertLessEqual(count["self_seconds"], count["seconds"])
+        self.assertGreater(count["peak"], 0)
+
+        spans = {s.name: s for s in p.spans}
+        fix_dates = [s for s in p.spans if s.name == "indicators.fix_dates"]
+        self.assertEqual(fix_dates[0].parent, spans["indicators.count"])
+        self.assertEqual(fix_dates[0].depth, 1)
+        self.assertEqual(spans["indicators.count"].depth, 0)
+        self.assertGreater(spans["indicators.number_per_week_clinic"].peak,
+                           0)
+
+        summary = p.summary()
+        self.assertEqual(summary.loc["indicators.count", "calls"], 1)
+        content = json.loads(p.to_json())
+        self.assertEqual(content["functions"]["indicators.count"]["calls"], 1)
+        self.assertEqual(len(content["spans"]), len(p.spans))
+        trace = json.loads(p.to_chrome_trace())["traceEvents"]
+        self.assertEqual(len(trace), len(p.spans))
+        self.assertEqual(set(e["ph"] for e in trace), {"X"})
+        starts = [e["ts"] for e in trace]
+        self.assertEqual(starts, sorted(starts))
+
+    def test_exceptions_and_nesting(self):
+        with profiling.profile(trace=False) as outer:
+            with profiling.profile() as inner:
+                with self.assertRaises(KeyError):
+                    univariate.breakdown_by_category(util.Variables({}),
+                                                     "none", self.data)
+                with profiling.span("block", rows_in=3):
+                    pass
+            indicators.fix_dates(None, None, 0)
+        self.assertEqual(
+            inner.functions["univariate.breakdown_by_category"]["calls"], 1)
+        self.assertEqual(inner.functions["block"]["rows_in"], 3)
+        self.assertNotIn("indicators.fix_dates", inner.functions)
+        self.assertEqual(outer.functions["indicators.fix_dates"]["calls"], 1)
+        self.assertEqual(outer.spans, [])
+
+    def test_rows(self):
+        self.assertEqual(profiling.rows(self.data), 10)
+        self.assertEqual(profiling.rows((1, self.data["gen_1"])), 10)
+        self.assertIsNone(profiling.rows(np.arange(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
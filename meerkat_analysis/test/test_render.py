@@ -0,0 +1,91 @@
+import os
+import unittest
+import tempfile
+import pandas as pd
+
+from meerkat_analysis import render, indicators, multivariate, util
+
+
+class RenderTest(unittest.TestCase):
+    """ Testing the batch rendering"""
+
+    def setUp(self):
+        self.data = pd.read_csv(
+            "meerkat_analysis/test/test_data/univariate.csv",
+            parse_dates=["date"], dayfirst=True).fillna(0)
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        self.variables = util.Variables.from_json_file(
+            "meerkat_analysis/test/test_data/variables.json")
+        self.clinics = indicators.number_per_week_clinic(
+            self.data, "tot_1", self.locations, epi_week_start_day=0,
+            start_date="2016/1/1", end_date="2016/12/31")
+        self.rates = multivariate.incidence_rate_by_category(
+            self.data, "gender", self.variables, var_id="tot_1")
+        self.odds_ratios = multivariate.odds_ratio_many(
+            self.data, ["age_1", "age_2"], ("gen_1", "gen_2"))
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def specs(self):
+        path = self.directory.name
+        regions = indicators.clinic_to_level(self.clinics.copy(),
+                                             self.locations, "region", 2)
+        return [
+            render.FigureSpec("level_total", os.path.join(path, "total.png"),
+                              (self.clinics, self.locations, "region", 2)),
+            render.FigureSpec("multilevel_timeline",
+                              os.path.join(path, "regions.svg"), (regions,)),
+            render.FigureSpec("timeline_by_category",
+                              os.path.join(path, "age.png"),
+                              (self.variables, "age", self.data),
+                              {"smooth": False}, figsize=(4, 3), dpi=50),
+            render.FigureSpec("incidence_rate", os.path.join(path, "ir.png"),
+                              (self.rates,), {"mult_factor": 1000},
+                              title="Incidence"),
+            render.FigureSpec("odds_ratios", os.path.join(path, "or.png"),
+                              (self.odds_ratios,)),
+            render.FigureSpec("many_incidence_rates",
+                              os.path.join(path, "many.png"),
+                              ([("a", self.rates), ("b", self.rates)],))]
+
+    def test_pack(self):
+        specs = self.specs()
+        specs.append(render.FigureSpec("incidence_rate", "other.png",
+                                       (self.rates,)))
+        table, tasks = render.pack(specs)
+        self.assertEqual(len(tasks), 7)
+        self.assertEqual(sum(t is self.rates for t in table), 1)
+        self.assertEqual(tasks[0][2][2], "region")
+        self.assertEqual(tasks[3][3]["mult_factor"], 1000)
+        self.assertEqual(tasks[3][2][0].index, tasks[6][2][0].index)
+        with self.assertRaises(KeyError):
+            render.FigureSpec("pie", "pie.png")
+
+    def test_render(self):
+        from matplotlib import pyplot
+        figures = pyplot.get_fignums()
+        clinics = self.clinics.copy()
+        for workers in [1, 2]:
+            specs = self.specs()
+            written = render.render(specs, workers=workers)
+            self.assertEqual(written, [s.filename for s in specs])
+            for filename in written:
+                self.assertGreater(os.path.getsize(filename), 0)
+                os.remove(filename)
+        self.assertEqual(pyplot.get_fignums(), figures)
+        self.assertTrue(self.clinics.equals(clinics))
+
+    def test_ax(self):
+        from matplotlib.figure import Figure
+        figure = Figure()
+        ax = figure.add_subplot(1, 1, 1)
+        multivariate.plot_odds_ratios(self.odds_ratios, ax=ax)
+        self.assertEqual(len(ax.patches), 2)
+        self.assertEqual(list(ax.lines[-1].get_ydata()), [1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import sparse, util, univariate, multivariate, indicators
+
+
+class SparseTest(unittest.TestCase):
+    """ Testing the sparse representation"""
+
+    def setUp(self):
+        self.filename = "meerkat_analysis/test/test_data/univariate.csv"
+        variables = {"tot_1": {"id": "tot_1", "name": "Total",
+                               "category": []},
+                     "gen_1": {"id": "gen_1", "name": "Male",
+                               "category": ["gender"]},
+                     "gen_2": {"id": "gen_2", "name": "Female",
+                               "category": ["gender"]}}
+        for number, name in enumerate(["<5", "5-15", "15-25", "25-40",
+                                       "40-60", ">60"]):
+            var_id = "age_{}".format(number + 1)
+            variables[var_id] = {"id": var_id, "name": name,
+                                 "category": ["age"]}
+        self.variables = util.Variables(variables)
+        self.dense = util.load_structured_data(self.filename, self.variables)
+        self.sparse = util.load_structured_data(self.filename, self.variables,
+                                                sparse=True, chunk_rows=4)
+
+    def test_load(self):
+        self.assertIsInstance(self.sparse, sparse.SparseData)
+        self.assertEqual(len(self.sparse), 10)
+        self.assertEqual(sorted(self.sparse.columns),
+                         sorted(self.dense.columns))
+        pd.testing.assert_frame_equal(
+            self.sparse.to_frame()[self.dense.columns], self.dense,
+            check_dtype=False)
+        self.assertIn("memory_usage", self.sparse.attrs)
+
+    def test_helpers(self):
+        for data in [self.dense, self.sparse]:
+            self.assertEqual(list(sparse.column_sums(data, ["gen_1", "gen_2",
+                                                            "nothing"])),
+                             [4, 6, 0])
+            self.assertEqual(list(sparse.masked_sums(data, "gen_1",
+                                                     ["age_1", "age_6"])),
+                             [1, 0])
+            cross = sparse.cross_sums(data, ["gen_1", "gen_2"],
+                                      ["age_4", "age_6", "nothing"])
+            np.testing.assert_array_equal(cross, [[0, 0, 0], [3, 3, 0]])
+
+    def test_analysis(self):
+        breakdown = univariate.breakdown_by_category(self.variables, "gender",
+                                                     self.sparse)
+        self.assertEqual(breakdown.loc["Female"]["value"], 6)
+        cross_table = multivariate.cross_table(self.variables, "age",
+                                               "gender", self.sparse)
+        self.assertEqual(cross_table[">60"]["Female"], 3)
+        self.assertEqual(cross_table["<5"]["Male"], 1)
+        self.assertEqual(
+            multivariate.odds_ratio(self.sparse, "age_6", ("gen_2", "tot_1")),
+            multivariate.odds_ratio(self.dense, "age_6", ("gen_2", "tot_1")))
+        total, timeline = indicators.count(self.sparse, "gen_2",
+                                           epi_week_start_day=0,
+                                           start_date="2016/1/1",
+                                           end_date="2016/12/31")
+        self.assertEqual(total, 6)
+        self.assertEqual(timeline["2016/06/20"], 5)
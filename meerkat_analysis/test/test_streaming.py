@@ -0,0 +1,95 @@
+import os
+import unittest
+import tempfile
+import pandas as pd
+
+from meerkat_analysis import (streaming, util, indicators, univariate,
+                              multivariate)
+
+
+class StreamingTest(unittest.TestCase):
+    """ Testing streaming aggregation"""
+
+    def setUp(self):
+        self.filename = "meerkat_analysis/test/test_data/univariate.csv"
+        variables = {"tot_1": {"id": "tot_1", "name": "Total",
+                               "category": []},
+                     "gen_1": {"id": "gen_1", "name": "Male",
+                               "category": ["gender"]},
+                     "gen_2": {"id": "gen_2", "name": "Female",
+                               "category": ["gender"]}}
+        for number, name in enumerate(["<5", "5-15", "15-25", "25-40",
+                                       "40-60", ">60"]):
+            var_id = "age_{}".format(number + 1)
+            variables[var_id] = {"id": var_id, "name": name,
+                                 "category": ["age"]}
+        self.variables = util.Variables(variables)
+        self.data = util.load_structured_data(self.filename, self.variables)
+        self.dates = {"epi_week_start_day": 0, "start_date": "2016/1/1",
+                      "end_date": "2016/12/31"}
+
+    def test_count(self):
+        total, timeline = streaming.count(self.filename, self.variables,
+                                          "gen_2", chunk_rows=3, **self.dates)
+        expected = indicators.count(self.data, "gen_2", **self.dates)
+        self.assertEqual(total, expected[0])
+        pd.testing.assert_series_equal(timeline, expected[1],
+                                       check_dtype=False, check_names=False,
+                                       check_freq=False)
+
+    def test_number_of_sites(self):
+        total, timeline = streaming.number_of_sites(
+            self.filename, self.variables, "clinic", chunk_rows=3,
+            **self.dates)
+        expected = indicators.number_of_sites(self.data, "clinic",
+                                              **self.dates)
+        self.assertEqual(total, expected[0])
+        self.assertEqual(list(timeline), list(expected[1]))
+
+    def test_number_of_sites_other_level(self):
+        data = pd.read_csv(self.filename)
+        data["clinic_type"] = ["Hospital" if c % 2 else "Primary"
+                               for c in data["clinic"]]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "types.csv")
+            data.to_csv(filename, index=False)
+            total, timeline = streaming.number_of_sites(
+                filename, self.variables, "clinic_type", chunk_rows=3,
+                **self.dates)
+            expected = indicators.number_of_sites(
+                util.load_structured_data(filename, self.variables),
+                "clinic_type", **self.dates)
+        self.assertEqual(total, 2)
+        self.assertEqual(total, expected[0])
+        self.assertEqual(list(timeline), list(expected[1]))
+
+    def test_breakdown_and_cross_table(self):
+        breakdown = streaming.breakdown_by_category(
+            self.filename, self.variables, "age", chunk_rows=3)
+        expected = univariate.breakdown_by_category(self.variables, "age",
+                                                    self.data)
+        self.assertEqual(list(breakdown["value"]), list(expected["value"]))
+
+        breakdown = streaming.breakdown_by_category(
+            self.filename, self.variables, "clinic", chunk_rows=3)
+        self.assertEqual(breakdown[11], 5)
+
+        cross_table = streaming.cross_table(self.filename, self.variables,
+                                            "age", "gender", chunk_rows=4)
+        expected = multivariate.cross_table(self.variables, "age", "gender",
+                                            self.data)
+        pd.testing.assert_frame_equal(cross_table.astype(float),
+                                      expected.astype(float))
+
+    def test_aggregate_and_merge(self):
+        chunks = [self.data[:5], self.data[5:]]
+        one = streaming.CrossTable(self.variables, "age", "gender")
+        two = streaming.CrossTable(self.variables, "age", "gender")
+        one.add(chunks[0])
+        two.add(chunks[1])
+        one.merge(two)
+        both = streaming.aggregate(
+            chunks, [streaming.CrossTable(self.variables, "age", "gender")],
+            self.variables)[0]
+        pd.testing.assert_frame_equal(one.finalize(), both)
+        self.assertEqual(both[">60"]["Female"], 3)
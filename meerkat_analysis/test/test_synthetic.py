@@ -0,0 +1,88 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+
+from meerkat_analysis import synthetic, util, geo
+
+
+class SyntheticTest(unittest.TestCase):
+    """ Testing the synthetic data generator"""
+
+    def setUp(self):
+        self.locations = synthetic.make_locations(25, seed=1)
+        self.variables = synthetic.make_variables(4)
+
+    def test_locations(self):
+        locations = util.Locations(self.locations)
+        self.assertEqual(len(locations.get_level("region",
+                                                 only_case_report=False)), 5)
+        clinics = locations.get_level("clinic", only_case_report=False)
+        self.assertEqual(len(clinics), 25)
+        country = self.locations["1"]
+        self.assertEqual(country["population"],
+                         sum(self.locations[str(c)]["population"]
+                             for c in clinics))
+        for c in clinics:
+            self.assertIsNotNone(geo.parse_geolocation(
+                self.locations[str(c)]["geolocation"]))
+        self.assertEqual(synthetic.make_locations(25, seed=1), self.locations)
+
+    def test_variables(self):
+        variables = util.Variables(self.variables)
+        self.assertEqual(sorted(variables.groups["gender"]), ["gen_1", "gen_2"])
+        self.assertEqual(len(variables.groups["age"]), 6)
+        self.assertEqual(sorted(variables.groups["disease"]),
+                         ["dis_1", "dis_2", "dis_3", "dis_4"])
+
+    def test_generate(self):
+        chunks = list(synthetic.generate_chunks(
+            self.locations, self.variables, 2500, chunk_rows=1000))
+        self.assertEqual([len(c) for c in chunks], [1000, 1000, 500])
+        data = synthetic.generate_data(self.locations, self.variables, 2500,
+                                       chunk_rows=1000)
+        self.assertTrue(data.equals(pd.concat(chunks, ignore_index=True)))
+        self.assertEqual(data["id"].tolist(), list(range(2500)))
+        self.assertTrue((data[["gen_1", "gen_2"]].sum(axis=1) == 1).all())
+        ages = ["age_{}".format(i) for i in range(1, 7)]
+        self.assertTrue((data[ages].sum(axis=1) == 1).all())
+        self.assertTrue(data["date"].between("2016-01-01",
+                                             "2017-12-31").all())
+        for clinic, dates in data.groupby("clinic")["date"]:
+            loc = self.locations[str(clinic)]
+            self.assertTrue(loc["case_report"])
+            self.assertGreaterEqual(dates.min(),
+                                    pd.Timestamp(loc["start_date"]))
+            self.assertEqual(data.loc[dates.index, "district"].iloc[0],
+                             loc["parent_location"])
+        other = synthetic.generate_data(self.locations, self.variables, 2500,
+                                        chunk_rows=1000, seed=1)
+        self.assertFalse(data.equals(other))
+
+    def test_export(self):
+        data = synthetic.generate_data(self.locations, self.variables, 1200,
+                                       chunk_rows=500, seed=1)
+        with tempfile.TemporaryDirectory() as directory:
+            locations, variables, filename = synthetic.write_dataset(
+                directory, 1200, n_clinics=25, n_diseases=4, chunk_rows=500,
+                seed=1)
+            self.assertEqual(locations.locations, self.locations)
+            self.assertTrue(os.path.exists(os.path.join(directory,
+                                                        "variables.json")))
+            with open(filename) as f:
+                f.readline()
+                cells = f.readline().strip().split(",")
+            self.assertIn("", cells)
+            self.assertNotIn("0", cells[6:])
+            loaded = util.load_structured_data(filename, variables)
+        self.assertEqual(list(loaded.columns), list(data.columns))
+        self.assertTrue(np.array_equal(loaded["date"].values,
+                                       data["date"].values))
+        for c in data.columns.drop("date"):
+            self.assertTrue(np.array_equal(loaded[c].astype(np.int64),
+                                           data[c].astype(np.int64)), c)
+
+
+if __name__ == "__main__":
+    unittest.main()
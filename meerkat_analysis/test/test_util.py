@@ -3,12 +3,31 @@ import unittest
 
 import requests_mock
 import os
+import io
+import gzip
 import json
 import csv
+import shutil
+import tempfile
+import numpy as np
+import multiprocessing
+import pandas as pd
 
 from meerkat_analysis import util
 
 
+def _count_in_worker(name):
+    from meerkat_analysis import indicators
+    dataset = util.SharedDataset.attach(name)
+    total, timeline = indicators.count(dataset, "gen_2",
+                                       epi_week_start_day=0,
+                                       start_date="2016/1/1",
+                                       end_date="2016/12/31")
+    population = dataset.location_arrays["population"].sum()
+    dataset.close()
+    return int(total), float(population)
+
+
 class UtilTest(unittest.TestCase):
     """ Testing util"""
 
@@ -29,6 +48,64 @@ class UtilTest(unittest.TestCase):
             self.assertEqual(f.read(), "This is a second test")
         os.remove(filename)
 
+    @requests_mock.mock()
+    def test_download_and_parse(self, mo):
+        with open("meerkat_analysis/test/test_data/univariate.csv", "rb") as f:
+            raw = f.read()
+        raw = raw.replace(b"1,2,4,7,15/06/16", b'1,2,4,7,"15/06/16')
+        raw = raw.replace(b"15/06/16 00:00", b'15/06/16\n00:00"')
+        mo.get("http://test.test", content=gzip.compress(raw),
+               headers={"Content-Encoding": "gzip"})
+        filename = "test.test"
+        data = util.download_and_parse("http://test.test", filename,
+                                       chunk_rows=3, queue_size=1,
+                                       parse_chunk=util.parse_csv_chunk)
+        expected = pd.read_csv(io.BytesIO(raw))
+        expected["date"] = pd.to_datetime(expected["date"], dayfirst=True)
+        pd.testing.assert_frame_equal(data, expected)
+        self.assertEqual(data["date"][1], pd.Timestamp("2016-06-16"))
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), raw)
+        os.remove(filename)
+
+        # The first chunk has no gen_2 values, every chunk still gets the
+        # compact types of the whole file
+        variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]}})
+        data = util.download_and_parse("http://test.test", chunk_rows=3,
+                                       variables=variables)
+        expected = util.downcast_locations(
+            util.read_structured_csv(raw, variables))
+        pd.testing.assert_frame_equal(data, expected)
+        self.assertEqual(data["gen_2"].dtype, "uint8")
+        self.assertEqual(data["clinic"].dtype, "uint8")
+        self.assertEqual(data["date"][0], pd.Timestamp("2016-06-15"))
+
+        with self.assertRaises(KeyError):
+            util.download_and_parse("http://test.test")
+
+        pulled = []
+
+        def row_chunks(req, chunk_rows, out=None):
+            for i in range(100):
+                pulled.append(i)
+                yield b"a", [b"1"]
+
+        def fail(header, rows):
+            raise IOError("Bad chunk")
+        with mock.patch.object(util, "iter_row_chunks", row_chunks):
+            with self.assertRaises(IOError):
+                util.download_and_parse("http://test.test", queue_size=1,
+                                        parse_chunk=fail)
+        self.assertLess(len(pulled), 10)
+
+        mo.get("http://test.test", status_code=404)
+        with self.assertRaises(IOError):
+            util.download_and_parse("http://test.test",
+                                    parse_chunk=util.parse_csv_chunk)
+
     def test_load_from_json_file(self):
         v = {"test": {"test2": [1, 2, 3],
                       "test3": "test3"
@@ -127,6 +204,18 @@ class LiveDownloaderTest(unittest.TestCase):
         with open(filename, "r") as f:
             self.assertEqual(f.read(), "This is a test")
         os.remove(filename)
+
+        mo.get("http://test.test/api/export/getcsv/1234",
+               text="id,tot_1\n1,1\n2,\n3,1\n")
+        mo.get("http://test.test/api/variables/all",
+               text=json.dumps({"tot_1": {"id": "tot_1", "name": "Total",
+                                          "category": []}}))
+        with mock.patch("time.sleep"):
+            data = ld.download_structured_data(None, pipeline=True,
+                                               chunk_rows=2)
+        self.assertEqual(list(data.columns), ["id", "tot_1"])
+        self.assertEqual(data["tot_1"].dtype, "uint8")
+        self.assertEqual(data["tot_1"].sum(), 2)
         
     @requests_mock.mock()
     def test_download_variables(self, mo):
@@ -207,3 +296,221 @@ class LocationsTest(unittest.TestCase):
         self.assertEqual(location.population("7"), 1500)
         self.assertEqual(location.population(7), 1500)
         self.assertEqual(location.population("Not a location"), 0)
+
+
+class LoadingTest(unittest.TestCase):
+    """ Testing loading of structured data """
+
+    def setUp(self):
+        self.filename = "meerkat_analysis/test/test_data/univariate.csv"
+        variables = {}
+        for var_id in ["tot_1", "gen_1", "gen_2", "age_1", "age_2",
+                       "age_3", "age_4", "age_5", "age_6"]:
+            variables[var_id] = {"id": var_id, "name": var_id,
+                                 "category": [var_id.split("_")[0]]}
+        self.variables = util.Variables(variables)
+
+    def test_parse_dates(self):
+        dates = pd.Series(["15/06/16 00:00", "01/02/16 00:00",
+                           "15/06/16 00:00", None, "2016-03-04"])
+        parsed = util.parse_dates(dates)
+        self.assertEqual(parsed[0], pd.Timestamp("2016-06-15"))
+        self.assertEqual(parsed[1], pd.Timestamp("2016-02-01"))
+        self.assertEqual(parsed[2], pd.Timestamp("2016-06-15"))
+        self.assertTrue(pd.isnull(parsed[3]))
+        self.assertEqual(parsed[4], pd.Timestamp("2016-03-04"))
+
+    def test_load_structured_data(self):
+        data = util.load_structured_data(self.filename, self.variables)
+        expected = pd.read_csv(self.filename, parse_dates=["date"],
+                               dayfirst=True).fillna(0)
+        self.assertEqual(data["gen_1"].dtype, "uint8")
+        self.assertEqual(data["clinic"].dtype, "uint8")
+        self.assertEqual(list(data.columns), list(expected.columns))
+        for c in data.columns:
+            self.assertEqual(list(data[c]), list(expected[c]))
+        memory = data.attrs["memory_usage"]
+        self.assertLess(memory["after"], memory["before"])
+
+    def test_structured_chunk_parser(self):
+        with open(self.filename, "rb") as f:
+            lines = f.read().strip().split(b"\n")
+        parse_chunk = util.structured_chunk_parser(self.variables)
+        data = parse_chunk(lines[0], lines[1:4])
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data["gen_2"].dtype, "uint8")
+        self.assertEqual(data["date"][0], pd.Timestamp("2016-06-15"))
+        other = parse_chunk(lines[0], lines[4:8])
+        self.assertEqual(data["clinic"].dtype, "uint32")
+        self.assertEqual(other["clinic"].dtype, "uint32")
+        # Values that do not fit in uint8 are not wrapped around
+        rows = [lines[1].replace(b",1,1,,", b",1,300,,"),
+                lines[2].replace(b",1,1,,", b",1,0.5,,")]
+        data = parse_chunk(lines[0], rows)
+        self.assertEqual(data["gen_1"].dtype, "float64")
+        self.assertEqual(list(data["gen_1"]), [300, 0.5])
+
+    def test_resolve_columns(self):
+        columns = util.resolve_columns(["gen", "age_1"], self.variables)
+        self.assertEqual(columns, ["date", "country", "region", "district",
+                                   "clinic", "gen_1", "gen_2", "age_1"])
+        columns = util.resolve_columns({"numerator": "gen_1",
+                                        "denominator": "tot_1",
+                                        "restrict": False},
+                                       self.variables, key_columns=[])
+        self.assertEqual(columns, ["gen_1", "tot_1"])
+
+    def test_load_structured_data_columns(self):
+        data = util.load_structured_data(self.filename, self.variables,
+                                         columns=["gen"])
+        self.assertEqual(list(data.columns),
+                         ["country", "region", "district", "clinic", "date",
+                          "gen_1", "gen_2"])
+        self.assertEqual(data["gen_2"].sum(), 6)
+
+    def test_parse_dates_cache(self):
+        cache = {}
+        dates = pd.Series(["15/06/16 00:00", "16/06/16 00:00"])
+        util.parse_dates(dates, cache=cache)
+        self.assertEqual(len(cache), 2)
+        dates = pd.Series(["16/06/16 00:00", "17/06/16 00:00", None])
+        parsed = util.parse_dates(dates, cache=cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(list(parsed[:2]), [pd.Timestamp("2016-06-16"),
+                                            pd.Timestamp("2016-06-17")])
+        self.assertTrue(pd.isnull(parsed[2]))
+
+    def test_read_csv_parallel(self):
+        expected = util.load_structured_data(self.filename, self.variables)
+        header, ranges = util.loading.split_file(self.filename, 100)
+        self.assertGreater(len(ranges), 3)
+        data = util.read_csv_parallel(self.filename, self.variables,
+                                      workers=3, chunk_bytes=100)
+        pd.testing.assert_frame_equal(data, expected)
+        self.assertEqual(data["clinic"].dtype, "uint8")
+        data = util.load_structured_data(self.filename, self.variables,
+                                         columns=["gen"], workers=2)
+        self.assertEqual(list(data.columns),
+                         ["country", "region", "district", "clinic", "date",
+                          "gen_1", "gen_2"])
+        data = util.read_csv_parallel(self.filename, chunk_bytes=10**6)
+        self.assertEqual(data["date"][9], pd.Timestamp("2016-06-24"))
+
+    def test_split_file_quoted(self):
+        data = pd.read_csv(self.filename)
+        data["comment"] = ['"line {}\nnext, line"'.format(i) if i % 3 else
+                           "plain" for i in range(len(data))]
+        data["weight"] = [round(0.1 * (i + 1), 1) for i in range(len(data))]
+        variables = util.Variables(dict(
+            self.variables.variables,
+            weight={"id": "weight", "name": "Weight", "category": [],
+                    "method": "value"}))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "quoted.csv")
+            data.to_csv(filename, index=False)
+            header, ranges = util.loading.split_file(filename, 40)
+            self.assertGreater(len(ranges), 3)
+            with open(filename, "rb") as f:
+                for start, end in ranges:
+                    f.seek(start)
+                    self.assertEqual(f.read(end - start).count(b'"') % 2, 0)
+            parallel = util.read_csv_parallel(filename, variables,
+                                              workers=2, chunk_bytes=40)
+        self.assertEqual(list(parallel["comment"]), list(data["comment"]))
+        self.assertEqual(parallel["weight"].dtype, np.float64)
+        self.assertEqual(list(parallel["weight"]), list(data["weight"]))
+        self.assertEqual(parallel["gen_1"].dtype, np.uint8)
+
+
+class CacheTest(unittest.TestCase):
+    """ Testing the columnar cache """
+
+    def setUp(self):
+        self.filename = "test_cache.csv"
+        shutil.copy("meerkat_analysis/test/test_data/univariate.csv",
+                    self.filename)
+        self.cache_dir = "test_cache"
+        self.variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]}})
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+
+    def tearDown(self):
+        os.remove(self.filename)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_write_and_read_cache(self):
+        data = util.load_structured_data(self.filename, self.variables)
+        data["name"] = ["a", "b", None, "a", "c", "a", "b", "b", "c", "a"]
+        util.write_cache(data, self.cache_dir, source=self.filename,
+                         variables=self.variables, locations=self.locations)
+        self.assertTrue(util.cache_is_valid(self.cache_dir, self.filename))
+
+        cached, variables, locations = util.read_context(self.cache_dir)
+        self.assertEqual(variables.variables, self.variables.variables)
+        self.assertEqual(locations.locations, self.locations.locations)
+        self.assertEqual(list(cached.columns), list(data.columns))
+        for c in data.columns:
+            self.assertEqual(list(cached[c].astype(object).fillna(0)),
+                             list(data[c].astype(object).fillna(0)))
+        self.assertIsInstance(cached["gen_1"].values, np.memmap)
+
+        cached = util.read_cache(self.cache_dir, columns=["gender"])
+        self.assertEqual(list(cached.columns),
+                         ["country", "region", "district", "clinic", "date",
+                          "gen_1", "gen_2"])
+
+    def test_load_cached(self):
+        data = util.load_cached(self.filename, self.variables,
+                                cache_dir=self.cache_dir)
+        self.assertEqual(data["gen_2"].sum(), 6)
+        self.assertTrue(util.cache_is_valid(self.cache_dir, self.filename))
+        with open(self.filename, "a") as f:
+            f.write("11,1,2,4,7,25/06/16 00:00,1,,1,,,,,,1\n")
+        self.assertFalse(util.cache_is_valid(self.cache_dir, self.filename))
+        data = util.load_cached(self.filename, self.variables,
+                                cache_dir=self.cache_dir, columns=["gen_2"])
+        self.assertEqual(data["gen_2"].sum(), 7)
+        self.assertNotIn("gen_1", data.columns)
+
+
+class SharedDatasetTest(unittest.TestCase):
+    """ Testing datasets in shared memory """
+
+    def setUp(self):
+        self.variables = util.Variables(
+            {"gen_1": {"id": "gen_1", "name": "Male", "category": ["gender"]},
+             "gen_2": {"id": "gen_2", "name": "Female",
+                       "category": ["gender"]}})
+        self.locations = util.Locations.from_json_file(
+            "meerkat_analysis/test/test_data/locations.json")
+        self.data = util.load_structured_data(
+            "meerkat_analysis/test/test_data/univariate.csv", self.variables)
+        self.data["name"] = ["a", "b", None, "a", "c", "a", "b", "b", "c", "a"]
+        self.dataset = util.SharedDataset.publish(self.data, self.variables,
+                                                  self.locations)
+
+    def tearDown(self):
+        self.dataset.close()
+
+    def test_attach(self):
+        attached = util.SharedDataset.attach(self.dataset.name)
+        self.assertEqual(list(attached.data.columns), list(self.data.columns))
+        for c in self.data.columns:
+            self.assertEqual(list(attached.data[c].astype(object).fillna(0)),
+                             list(self.data[c].astype(object).fillna(0)))
+        self.assertFalse(attached.data["gen_1"].values.flags.writeable)
+        self.assertEqual(attached.variables.variables,
+                         self.variables.variables)
+        self.assertEqual(attached.locations.name(7), "Clinic 1")
+        arrays = attached.location_arrays
+        self.assertEqual(arrays["parent"][list(arrays["id"]).index(7)], 4)
+        self.assertIs(util.analysis_data(attached), attached.data)
+        attached.close()
+
+    def test_workers(self):
+        with multiprocessing.Pool(2) as pool:
+            results = pool.map(_count_in_worker, [self.dataset.name] * 2)
+        self.assertEqual(results, [(6, 34000.0), (6, 34000.0)])
@@ -1,9 +1,13 @@
+import numpy as np
 import pandas as pd
 from statsmodels.stats import proportion
-from matplotlib import pylab
 
 from . import util
+from . import sparse
+from .profiling import instrument, span
+from .plotting import pylab
 
+@instrument
 def breakdown_by_category(variables, category, data, use_names=True):
     """
     Gives a breakdown of data for category
@@ -11,9 +15,10 @@ def breakdown_by_category(variables, category, data, use_names=True):
     Args:
        variables: Variables class
        category: name of category
-       data: structured data in pandas Data Frame
+       data: structured data in pandas Data Frame or SparseData
        use_names: return object used variable names instead of ids
     """
+    data = util.analysis_data(data)
     if category in ["country", "region", "district", "clinic"]:
         return data[category].value_counts()
 
@@ -22,20 +27,19 @@ def breakdown_by_category(variables, category, data, use_names=True):
 
     results = pd.DataFrame(columns=["value"])
     ids = sorted(variables.groups[category])
+    sums = sparse.column_sums(data, ids)
     for number, i in enumerate(ids):
         if use_names:
             name = variables.name(i)
         else:
             name = i
-        if i in data.columns:
-            results.loc[name] = [data[i].sum()]
-        else:
-            results.loc[name] = [0]
+        results.loc[name] = [sums[number]]
 
     return results
     
+@instrument
 def plot_timeline_by_category(variables, category, data, use_names=True, freq="W",
-                              smooth=True, lw=1):
+                              smooth=True, lw=1, ax=None):
     """
     Gives a breakdown of data for category
 
@@ -44,7 +48,9 @@ def plot_timeline_by_category(variables, category, data, use_names=True, freq="W
        category: name of category
        data: structured data in pandas Data Frame
        use_names: return object used variable names instead of ids
+       ax: matplotlib axes to draw on, defaults to a new pylab figure
     """
+    data = util.analysis_data(data)
     if category in ["country", "region", "district", "clinic"]:
         return data[category].value_counts()
 
@@ -53,7 +59,8 @@ def plot_timeline_by_category(variables, category, data, use_names=True, freq="W
 
     results = pd.DataFrame(columns=["value"])
     ids = sorted(variables.groups[category])
-    fig, ax = pylab.subplots()
+    if ax is None:
+        fig, ax = pylab().subplots()
     results = data.groupby(pd.Grouper(key="date", freq=freq)).sum()
     for number, i in enumerate(ids):
         if smooth:
@@ -66,33 +73,61 @@ def plot_timeline_by_category(variables, category, data, use_names=True, freq="W
                     label=variables.name(i), ax=ax, lw=lw)
         else:
             results[i].plot(label=variables.name(i), ax=ax, lw=lw)
-    pylab.legend(loc="best")
+    ax.legend(loc="best")
     return ax
 
+@instrument
 def incidence_rate(data, population=None, var_id=None, name=None, variables=None, alpha=0.95):
     """
     Calculates the incidence rate and confidence interval for the variable specified either by id or name
 
     Args:
-       data: data frame
+       data: data frame or SparseData
        var_id: variable id
        name: name of variable
        variables: Variables class
     Returns:
        incedence rate, confidence interval
     """
+    data = util.analysis_data(data)
 
     var_id = util.name_id(var_id=var_id, name=name, variables=variables)
     
 
     if var_id not in data.columns:
         return (0, (0,0))
-    count = data[var_id].sum()
+    count = sparse.column_sums(data, [var_id])[0]
     
     if population is None:
         population = len(data)
     incidence = count / population
 
-    confidence_interval = proportion.proportion_confint(count, population, method="wilson")
+    with span("statsmodels.proportion_confint"):
+        confidence_interval = proportion.proportion_confint(count, population, method="wilson")
     return (incidence, confidence_interval)
 
+
+@instrument
+def incidence_rates(counts, populations):
+    """
+    Calculates incidence rates and wilson confidence intervals for arrays
+    of counts and populations
+
+    Args:
+       counts: array of counts
+       populations: array of populations, the same length as counts
+    Returns:
+       data frame with incidence_rate, ci_lower and ci_upper where the ci
+       columns are the distances from the rate as in the other rate tables
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    populations = np.asarray(populations, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"), \
+            span("statsmodels.proportion_confint", len(counts)):
+        rates = counts / populations
+        lower, upper = proportion.proportion_confint(counts, populations,
+                                                     method="wilson")
+    return pd.DataFrame({"incidence_rate": rates,
+                         "ci_lower": rates - lower,
+                         "ci_upper": upper - rates},
+                        columns=["incidence_rate", "ci_lower", "ci_upper"])
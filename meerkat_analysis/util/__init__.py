@@ -1,8 +1,37 @@
 import requests
 import os
+import io
 import csv
 import json
 import time
+import queue
+import threading
+import pandas as pd
+
+from .loading import (parse_dates, load_structured_data, read_structured_csv,
+                      structured_chunk_parser, memory_usage, resolve_columns,
+                      iter_structured_csv, read_csv_parallel,
+                      downcast_locations)
+from .cache import (write_cache, read_cache, read_context, load_cached,
+                    cache_is_valid)
+from .shared import SharedDataset
+from ..profiling import instrument
+
+
+def analysis_data(data):
+    """
+    Returns the data the analysis functions work on
+
+    Dataset objects such as SharedDataset provide an analysis_data
+    method, data frames and SparseData are returned as they are.
+
+    Args:
+        data: data frame, SparseData or dataset object
+    """
+    if isinstance(data, pd.DataFrame) or not hasattr(data, "analysis_data"):
+        return data
+    return data.analysis_data()
+
 
 def name_id(name=None, var_id=None, variables=None):
     """
@@ -24,6 +53,7 @@ def name_id(name=None, var_id=None, variables=None):
         raise KeyError("Need to provide either name or id")
 
     
+@instrument
 def download_file(url, filename, params=None, cookies=None):
     """
     Download an url and saves it as file
@@ -48,7 +78,168 @@ def download_file(url, filename, params=None, cookies=None):
                       "got stats_code {code}".format(url=url,
                                                      code=req.status_code))
 
-    
+
+def iter_row_chunks(req, chunk_rows, out=None, block_size=2**16):
+    """
+    Splits a streaming csv response into chunks of complete rows
+
+    Records with quoted newlines are kept together.
+
+    Args:
+        req: streaming requests response
+        chunk_rows: number of rows per chunk
+        out: optional file object the raw data is also written to
+        block_size: number of bytes read from the response at a time
+    Returns:
+        generator of (header, rows) where rows is a list of lines
+    """
+    header = None
+    rows = []
+    remainder = b""
+    emitted = False
+    for block in req.iter_content(chunk_size=block_size):
+        if out is not None:
+            out.write(block)
+        lines = (remainder + block).split(b"\n")
+        remainder = lines.pop()
+        if b'"' in block or b'"' in remainder:
+            lines, pending = _join_quoted(lines)
+            if pending:
+                remainder = pending + b"\n" + remainder
+        if header is None and lines:
+            header = lines.pop(0)
+        rows.extend(lines)
+        while len(rows) >= chunk_rows:
+            yield header, rows[:chunk_rows]
+            emitted = True
+            rows = rows[chunk_rows:]
+    if remainder.strip():
+        if header is None:
+            header = remainder
+        else:
+            rows.append(remainder)
+    if rows or (header is not None and not emitted):
+        yield header, rows
+
+
+def _join_quoted(lines):
+    """
+    Joins lines that are split inside a quoted field
+
+    Args:
+        lines: list of lines
+    Returns:
+        (lines, pending): complete records and an unterminated record
+    """
+    records = []
+    pending = None
+    for line in lines:
+        if pending is not None:
+            pending = pending + b"\n" + line
+            if line.count(b'"') % 2 == 1:
+                records.append(pending)
+                pending = None
+        elif line.count(b'"') % 2 == 1:
+            pending = line
+        else:
+            records.append(line)
+    return records, pending
+
+
+def parse_csv_chunk(header, rows):
+    """
+    Parses a chunk of csv rows into a data frame
+
+    Args:
+        header: the csv header line
+        rows: list of csv lines
+    Returns:
+        data frame with typed columns
+    """
+    buffer = io.BytesIO(header + b"\n" + b"\n".join(rows))
+    data = pd.read_csv(buffer)
+    if "date" in data.columns:
+        data["date"] = parse_dates(data["date"])
+    return data
+
+
+@instrument
+def download_and_parse(url, filename=None, params=None, cookies=None,
+                       chunk_rows=50000, queue_size=4, parse_chunk=None,
+                       variables=None):
+    """
+    Downloads a csv file and parses it while the download continues
+
+    The file is requested with gzip transfer encoding and decompressed on
+    the fly. Chunks of chunk_rows rows are handed to a parser thread
+    through a queue of at most queue_size chunks, so the total time is
+    close to the larger of the download and the parse time. Without a
+    parse_chunk the chunks are parsed with structured_chunk_parser of
+    variables, so the variable and location columns get the same compact
+    types in every chunk. The download stops at the first parse error.
+
+    Args:
+        url: url to be downloaded
+        filename: if given the csv file is also saved here
+        params: any get parameters
+        cookies: cookies for the request
+        chunk_rows: number of rows per parsed chunk
+        queue_size: maximum number of chunks waiting to be parsed
+        parse_chunk: function(header, rows) returning a data frame
+        variables: Variables class, needed without parse_chunk
+    Returns:
+        data frame with the parsed data
+    Raises:
+       IOError: if not status_code is 200
+       KeyError: if neither parse_chunk nor variables are given
+    """
+    if parse_chunk is None:
+        if variables is None:
+            raise KeyError("Variables are needed to parse the chunks")
+        parse_chunk = structured_chunk_parser(variables)
+    req = requests.get(url, params=params, cookies=cookies, stream=True,
+                       headers={"Accept-Encoding": "gzip"})
+    if req.status_code != 200:
+        raise IOError("Could not download url {url}, "
+                      "got stats_code {code}".format(url=url,
+                                                     code=req.status_code))
+    chunks = queue.Queue(maxsize=queue_size)
+    frames = []
+    errors = []
+
+    def parse():
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if not errors:
+                try:
+                    frames.append(parse_chunk(*item))
+                except Exception as e:
+                    errors.append(e)
+
+    parser = threading.Thread(target=parse, daemon=True)
+    parser.start()
+    out = open(filename, "wb") if filename else None
+    try:
+        for header, rows in iter_row_chunks(req, chunk_rows, out=out):
+            if errors:
+                break
+            chunks.put((header, rows))
+    finally:
+        req.close()
+        chunks.put(None)
+        parser.join()
+        if out is not None:
+            out.close()
+    if errors:
+        raise errors[0]
+    if not frames:
+        return pd.DataFrame()
+    return downcast_locations(pd.concat(frames, ignore_index=True))
+
+
+@instrument
 def load_from_json_file(filename):
     """ Loads variables from json file
     
@@ -174,6 +365,7 @@ class Locations:
         live_downloader.download_locations(filename)
         return cls(load_from_json_file(filename))
 
+    @instrument
     def population(self, loc_id):
         """
         Returns the population
@@ -204,6 +396,7 @@ class Locations:
             ret = self.locations[str(loc_id)]["name"]
         return ret
 
+    @instrument
     def populations(self, level):
         """
         Returns the populations for the given level
@@ -218,6 +411,7 @@ class Locations:
         return ret
         
         
+    @instrument
     def get_level(self, level, only_case_report=True):
         """
         Returns all the locations with the correct level
@@ -233,6 +427,7 @@ class Locations:
                     ret.append(l)
             
         return ret
+    @instrument
     def get_clinics(self, loc_id):
         """
         Returns the clincs that are sublocations to the given location
@@ -297,11 +492,20 @@ class LiveDownloader:
         else:
             raise IOError("Could not authorise with that username/password")
 
-    def download_structured_data(self, filename):
+    @instrument
+    def download_structured_data(self, filename, pipeline=False, **kwargs):
         """ Download stucutred data from url and saves it as a csv file
-        
+
+        In pipeline mode the data is parsed while it is downloaded,
+        see download_and_parse. The variables are downloaded for the
+        parser unless variables or parse_chunk are given.
+
         Args:
-            filename: name of file
+            filename: name of file, can be None in pipeline mode
+            pipeline: if True return the parsed data frame
+            kwargs: passed on to download_and_parse
+        Returns:
+            data frame if pipeline is True
         """
         url = self.base_url + "/api/export/data/1"
         req = requests.get(url, cookies=self.cookies)
@@ -316,8 +520,14 @@ class LiveDownloader:
 
                 status = res["status"]
             if res["success"]:
-                download_file(self.base_url + "/api/export/getcsv/" + uid,
-                              filename, cookies=self.cookies)
+                url = self.base_url + "/api/export/getcsv/" + uid
+                if pipeline:
+                    if ("variables" not in kwargs and
+                            "parse_chunk" not in kwargs):
+                        kwargs["variables"] = self.get_variables()
+                    return download_and_parse(url, filename,
+                                              cookies=self.cookies, **kwargs)
+                download_file(url, filename, cookies=self.cookies)
             else:
                 print("Not successfull")
         
@@ -330,6 +540,22 @@ class LiveDownloader:
         url = self.base_url + "/api/export/alerts"
         download_file(url, filename, cookies=self.cookies)
         
+    def get_variables(self):
+        """ Downloads the variables from url
+
+        Returns:
+            Variables class
+        Raises:
+            IOError: if not status_code is 200
+        """
+        url = self.base_url + "/api/variables/all"
+        req = requests.get(url, cookies=self.cookies)
+        if req.status_code != 200:
+            raise IOError("Could not download url {url}, "
+                          "got stats_code {code}".format(
+                              url=url, code=req.status_code))
+        return Variables(req.json())
+
     def download_variables(self, filename):
         """ Download variables from url and saves it as a json file
         
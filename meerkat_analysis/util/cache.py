@@ -0,0 +1,227 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .loading import resolve_columns, load_structured_data
+from ..profiling import instrument
+
+MANIFEST = "manifest.json"
+CACHE_VERSION = 1
+
+
+@instrument
+def file_checksum(filename, block_size=2**20):
+    """
+    Returns the sha1 checksum of a file
+
+    Args:
+        filename: name of file
+        block_size: number of bytes read at a time
+    """
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_info(filename):
+    """
+    Returns size, modification time and checksum of the source file
+
+    Args:
+        filename: name of file
+    """
+    stat = os.stat(filename)
+    return {"path": os.path.abspath(filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": file_checksum(filename)}
+
+
+@instrument
+def write_cache(data, directory, source=None, variables=None, locations=None):
+    """
+    Writes data to a columnar cache with one .npy file per column
+
+    Object and categorical columns are stored as integer codes with the
+    categories in the manifest.
+
+    Args:
+        data: data frame
+        directory: cache directory
+        source: the csv file the data was parsed from
+        variables: Variables class to store with the data
+        locations: Locations class to store with the data
+    """
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        os.remove(os.path.join(directory, MANIFEST))
+    manifest = {"version": CACHE_VERSION,
+                "rows": len(data),
+                "columns": [],
+                "source": source_info(source) if source else None,
+                "variables": None,
+                "locations": None}
+    for number, column in enumerate(data.columns):
+        values = data[column]
+        entry = {"name": str(column), "file": "{}.npy".format(number)}
+        if values.dtype == object or isinstance(values.dtype,
+                                                 pd.CategoricalDtype):
+            codes, categories = pd.factorize(values)
+            entry["categories"] = pd.Index(categories).tolist()
+            values = codes
+        values = np.ascontiguousarray(np.asarray(values))
+        entry["dtype"] = values.dtype.str
+        np.save(os.path.join(directory, entry["file"]), values)
+        manifest["columns"].append(entry)
+    if variables is not None:
+        manifest["variables"] = "variables.json"
+        with open(os.path.join(directory, "variables.json"), "w") as f:
+            json.dump(variables.variables, f)
+    if locations is not None:
+        manifest["locations"] = "locations.json"
+        with open(os.path.join(directory, "locations.json"), "w") as f:
+            json.dump(locations.locations, f)
+    # The manifest is written last so a partial cache is never valid
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+
+
+def read_manifest(directory):
+    """
+    Returns the manifest of a cache or None if there is no cache
+
+    Args:
+        directory: cache directory
+    """
+    filename = os.path.join(directory, MANIFEST)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != CACHE_VERSION:
+        return None
+    return manifest
+
+
+@instrument
+def cache_is_valid(directory, source):
+    """
+    Determines if the cache was written from the current source file
+
+    The checksum is only computed if size or modification time changed.
+
+    Args:
+        directory: cache directory
+        source: csv file
+    """
+    manifest = read_manifest(directory)
+    if manifest is None or manifest["source"] is None:
+        return False
+    cached = manifest["source"]
+    stat = os.stat(source)
+    if stat.st_size != cached["size"]:
+        return False
+    if stat.st_mtime == cached["mtime"]:
+        return True
+    return file_checksum(source) == cached["sha1"]
+
+
+@instrument
+def read_cache(directory, columns=None, variables=None, mmap_mode="c"):
+    """
+    Opens the cached data as memory mapped columns
+
+    With the default copy on write mode processes share the physical
+    pages until a column is modified.
+
+    Args:
+        directory: cache directory
+        columns: only these columns, see resolve_columns
+        variables: Variables class to resolve columns with, defaults to
+                   the stored snapshot
+        mmap_mode: numpy memory map mode, None reads into memory
+    Returns:
+        data frame
+    """
+    from . import Variables
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise IOError("No cache in {}".format(directory))
+    entries = manifest["columns"]
+    if columns is not None:
+        if variables is None and manifest["variables"]:
+            variables = Variables.from_json_file(
+                os.path.join(directory, manifest["variables"]))
+        elif variables is None:
+            variables = Variables({})
+        wanted = set(resolve_columns(columns, variables))
+        entries = [e for e in entries if e["name"] in wanted]
+    arrays = {}
+    for entry in entries:
+        values = np.load(os.path.join(directory, entry["file"]),
+                         mmap_mode=mmap_mode)
+        if "categories" in entry:
+            values = pd.Categorical.from_codes(values, entry["categories"])
+        arrays[entry["name"]] = values
+    return pd.DataFrame(arrays, copy=False)
+
+
+@instrument
+def read_context(directory, columns=None, mmap_mode="c"):
+    """
+    Loads data, variables and locations stored in a cache
+
+    Args:
+        directory: cache directory
+        columns: only these columns, see resolve_columns
+        mmap_mode: numpy memory map mode
+    Returns:
+        (data, variables, locations): Variables and Locations are None if
+        they were not stored
+    """
+    from . import Variables, Locations
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise IOError("No cache in {}".format(directory))
+    variables = None
+    locations = None
+    if manifest["variables"]:
+        variables = Variables.from_json_file(
+            os.path.join(directory, manifest["variables"]))
+    if manifest["locations"]:
+        locations = Locations.from_json_file(
+            os.path.join(directory, manifest["locations"]))
+    data = read_cache(directory, columns=columns, variables=variables,
+                      mmap_mode=mmap_mode)
+    return data, variables, locations
+
+
+@instrument
+def load_cached(filename, variables, cache_dir=None, columns=None,
+                locations=None):
+    """
+    Loads the structured export through a columnar cache
+
+    The csv file is parsed with load_structured_data and cached the first
+    time, later calls open the memory mapped cache.
+
+    Args:
+        filename: name of csv file
+        variables: Variables class
+        cache_dir: cache directory, defaults to filename + ".cache"
+        columns: only these columns, see resolve_columns
+        locations: Locations class to store with the data
+    Returns:
+        data frame
+    """
+    if cache_dir is None:
+        cache_dir = filename + ".cache"
+    if not cache_is_valid(cache_dir, filename):
+        data = load_structured_data(filename, variables)
+        write_cache(data, cache_dir, source=filename, variables=variables,
+                    locations=locations)
+    return read_cache(cache_dir, columns=columns, variables=variables)
@@ -0,0 +1,506 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from ..profiling import instrument
+
+DATE_FORMAT = "%d/%m/%y %H:%M"
+LOCATION_COLUMNS = ["country", "region", "district", "clinic"]
+KEY_COLUMNS = ["date"] + LOCATION_COLUMNS
+NON_INDICATOR_METHODS = ["sum", "value", "calc"]
+# Nullable integer parsing in read_csv is slow, so integer columns are
+# read as floats and converted once the missing values are filled
+READ_DTYPES = {"uint8": "float32", "uint32": "float64"}
+
+
+@instrument
+def parse_dates(values, date_format=DATE_FORMAT, cache=None):
+    """
+    Parses date strings through a cache of the unique values
+
+    The export only has a few thousand distinct dates, so each distinct
+    string is parsed once and the result is mapped back to the rows.
+    Strings not matching date_format are parsed day first. A cache
+    dictionary can be shared between calls, e.g. for the chunks of a file.
+
+    Args:
+        values: series with date strings
+        date_format: expected strftime format
+        cache: dictionary of string: datetime64 to use and update
+    Returns:
+        series with datetimes
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = np.asarray(values.cat.codes)
+        uniques = values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques).astype(str)
+    if cache is None:
+        parsed = _parse_unique_dates(uniques, date_format)
+    else:
+        missing = pd.Index([u for u in uniques if u not in cache])
+        if len(missing):
+            cache.update(zip(missing,
+                             _parse_unique_dates(missing, date_format)))
+        parsed = np.array([cache[u] for u in uniques],
+                          dtype="datetime64[ns]")
+    result = parsed.take(codes)
+    result[codes < 0] = np.datetime64("NaT")
+    return pd.Series(result, index=values.index, name=values.name)
+
+
+def _parse_unique_dates(uniques, date_format):
+    """
+    Parses an index of distinct date strings to a datetime64 array
+    """
+    parsed = pd.Series(pd.to_datetime(uniques, format=date_format,
+                                      errors="coerce"))
+    failed = parsed.isna().values
+    if failed.any():
+        parsed[failed] = pd.to_datetime(uniques[failed], dayfirst=True,
+                                        errors="coerce")
+    return parsed.values
+
+
+def indicator_columns(columns, variables):
+    """
+    Returns the columns that are 0/1 indicator variables
+
+    Args:
+        columns: column names of the export
+        variables: Variables class
+    Returns:
+        list of column names
+    """
+    ret = []
+    for c in columns:
+        variable = variables.variables.get(c)
+        if variable and variable.get("method") not in NON_INDICATOR_METHODS:
+            ret.append(c)
+    return ret
+
+
+def resolve_columns(requested, variables, key_columns=KEY_COLUMNS):
+    """
+    Resolves what an analysis needs to the minimal set of columns
+
+    Requested items can be variable ids, variable names, category names
+    from variables.groups or indicator definitions given as dictionaries,
+    lists or tuples of these. The date and location keys are always
+    included.
+
+    Args:
+        requested: list of items
+        variables: Variables class
+        key_columns: columns that are always included
+    Returns:
+        list of column names
+    """
+    columns = list(key_columns)
+
+    def add(item):
+        if isinstance(item, dict):
+            for value in item.values():
+                add(value)
+        elif isinstance(item, (list, tuple, set)):
+            for value in item:
+                add(value)
+        elif item is None or isinstance(item, bool):
+            return
+        elif item in variables.groups:
+            for var_id in sorted(variables.groups[item]):
+                add(var_id)
+        elif item in variables.variables or variables.get_id(item) is None:
+            if item not in columns:
+                columns.append(item)
+        else:
+            add(variables.get_id(item))
+    add(requested)
+    return columns
+
+
+def structured_dtypes(columns, variables):
+    """
+    Returns the compact dtypes of the structured export
+
+    Only the 0/1 indicator variables are downcast, other variables such
+    as sums and values stay float64.
+
+    Args:
+        columns: column names of the export
+        variables: Variables class
+    Returns:
+        dictionary of column: dtype
+    """
+    dtypes = {}
+    for c in columns:
+        if c in variables.variables:
+            dtypes[c] = "float64"
+    for c in indicator_columns(columns, variables):
+        dtypes[c] = "uint8"
+    for c in LOCATION_COLUMNS:
+        if c in columns:
+            dtypes[c] = "uint32"
+    if "date" in columns:
+        dtypes["date"] = "category"
+    return dtypes
+
+
+def _header_and_dtypes(source, variables, columns):
+    """
+    Reads the header of source and returns the columns to read and their
+    dtypes
+    """
+    header = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, "seek"):
+        source.seek(0)
+    if columns is not None:
+        wanted = set(resolve_columns(columns, variables))
+        header = [c for c in header if c in wanted]
+    return list(header), structured_dtypes(header, variables)
+
+
+def _read_dtypes(dtypes):
+    """
+    Returns the dtypes to give read_csv for the compact dtypes
+    """
+    return {c: READ_DTYPES.get(dtype, dtype) for c, dtype in dtypes.items()}
+
+
+def _fits_uint8(values):
+    """
+    Returns True if all values are whole numbers from 0 to 255
+    """
+    return bool(((values >= 0) & (values <= 255) &
+                 (values == np.floor(values))).all())
+
+
+def _compact(data, dtypes, date_format, date_cache=None):
+    """
+    Converts the columns of a data frame read with _read_dtypes to their
+    compact types
+
+    Indicator columns with values that do not fit in uint8 are kept as
+    float64 instead of wrapping around.
+    """
+    for c, dtype in dtypes.items():
+        if dtype == "uint8":
+            values = data[c].fillna(0)
+            if _fits_uint8(values.values):
+                data[c] = values.astype("uint8")
+            else:
+                data[c] = values.astype("float64")
+        elif dtype == "float64":
+            data[c] = data[c].fillna(0)
+        elif dtype == "uint32":
+            data[c] = data[c].fillna(0).astype("uint32")
+    if "date" in data.columns:
+        data["date"] = parse_dates(data["date"], date_format,
+                                   cache=date_cache)
+    return data
+
+
+@instrument
+def read_structured_csv(source, variables, columns=None,
+                        date_format=DATE_FORMAT, date_cache=None, **kwargs):
+    """
+    Reads structured data with compact column types
+
+    Indicator variables become uint8, location columns uint32 and dates
+    are parsed through parse_dates. Missing values in variable and
+    location columns are set to 0. The types only depend on the columns,
+    so chunks of one file read with this function can be concatenated
+    without conversions.
+
+    Args:
+        source: filename or file object
+        variables: Variables class
+        columns: only read these columns, see resolve_columns
+        date_format: format of the date column
+        date_cache: dictionary shared with parse_dates
+        kwargs: passed on to pd.read_csv
+    Returns:
+        data frame
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    header, dtypes = _header_and_dtypes(source, variables, columns)
+    if columns is not None:
+        kwargs["usecols"] = header
+    data = pd.read_csv(source, dtype=_read_dtypes(dtypes), **kwargs)
+    return _compact(data, dtypes, date_format, date_cache)
+
+
+def _read_record(f):
+    """
+    Reads one csv record from f, also when a quoted field holds newlines
+
+    Returns:
+        (record, quotes): the bytes read and the number of quotes in them
+    """
+    record = f.readline()
+    quotes = record.count(b'"')
+    while quotes % 2 == 1:
+        line = f.readline()
+        if not line:
+            break
+        record += line
+        quotes += line.count(b'"')
+    return record, quotes
+
+
+def split_file(filename, chunk_bytes, block_size=2**20):
+    """
+    Splits a csv file into byte ranges that start and end at row boundaries
+
+    The quotes before every boundary are counted so no range starts in
+    the middle of a quoted field holding a newline.
+
+    Args:
+        filename: name of csv file
+        chunk_bytes: approximate size of each range
+        block_size: number of bytes read at a time while counting quotes
+    Returns:
+        (header, ranges): the header line and a list of (start, end)
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        header = _read_record(f)[0].rstrip(b"\r\n")
+        bounds = [f.tell()]
+        position = bounds[-1]
+        quotes = 0
+        while bounds[-1] + chunk_bytes < size:
+            target = bounds[-1] + chunk_bytes
+            while position < target:
+                block = f.read(min(block_size, target - position))
+                quotes += block.count(b'"')
+                position += len(block)
+            line = f.readline()
+            quotes += line.count(b'"')
+            while quotes % 2 == 1 and line:
+                line = f.readline()
+                quotes += line.count(b'"')
+            position = f.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+    bounds.append(size)
+    return header, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _concat_columns(frames):
+    """
+    Concatenates frames with the same columns by copying each column once
+    into a preallocated array, freeing the chunks as they are copied
+    """
+    total = sum(len(f) for f in frames)
+    columns = {}
+    for c in frames[0].columns:
+        dtypes = set(f[c].dtype for f in frames)
+        dtype = dtypes.pop() if len(dtypes) == 1 else None
+        if dtype is None or not isinstance(dtype, np.dtype):
+            columns[c] = pd.concat([f[c] for f in frames],
+                                   ignore_index=True).values
+            continue
+        values = np.empty(total, dtype=dtype)
+        start = 0
+        for f in frames:
+            values[start:start + len(f)] = f[c].values
+            start += len(f)
+        columns[c] = values
+        for f in frames:
+            del f[c]
+    return pd.DataFrame(columns, copy=False)
+
+
+@instrument
+def read_csv_parallel(filename, variables=None, columns=None, workers=None,
+                      chunk_bytes=2**25, date_format=DATE_FORMAT):
+    """
+    Reads the structured export with several threads
+
+    The file is split at row boundaries into ranges of about chunk_bytes
+    that are parsed in a thread pool with read_structured_csv. Dates go
+    through one memo table of the distinct date strings for all chunks.
+
+    Args:
+        filename: name of csv file
+        variables: Variables class
+        columns: only read these columns, see resolve_columns
+        workers: number of threads, defaults to the number of cpus
+        chunk_bytes: approximate number of bytes per chunk
+        date_format: format of the date column
+    Returns:
+        data frame
+    """
+    if variables is None:
+        from . import Variables
+        variables = Variables({})
+    header, ranges = split_file(filename, chunk_bytes)
+    date_cache = {}
+
+    def parse(byte_range):
+        start, end = byte_range
+        with open(filename, "rb") as f:
+            f.seek(start)
+            rows = f.read(end - start)
+        return read_structured_csv(header + b"\n" + rows, variables,
+                                   columns=columns, date_format=date_format,
+                                   date_cache=date_cache)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        frames = list(pool.map(parse, ranges))
+    return downcast_locations(_concat_columns(frames))
+
+
+def downcast_locations(data):
+    """
+    Converts the location columns of a whole data set to the smallest
+    unsigned integer type
+
+    Chunks keep uint32 location columns so they all have the same types,
+    this is done once after they are concatenated.
+
+    Args:
+        data: data frame
+    Returns:
+        data frame
+    """
+    for c in LOCATION_COLUMNS:
+        if c in data.columns and data[c].dtype.kind == "u":
+            data[c] = pd.to_numeric(data[c], downcast="unsigned")
+    return data
+
+
+def iter_structured_csv(source, variables, columns=None, chunk_rows=100000,
+                        date_format=DATE_FORMAT):
+    """
+    Reads structured data in chunks with compact column types
+
+    Args:
+        source: filename or file object
+        variables: Variables class
+        columns: only read these columns, see resolve_columns
+        chunk_rows: number of rows per chunk
+        date_format: format of the date column
+    Returns:
+        generator of data frames
+    """
+    header, dtypes = _header_and_dtypes(source, variables, columns)
+    usecols = header if columns is not None else None
+    for chunk in pd.read_csv(source, dtype=_read_dtypes(dtypes),
+                             usecols=usecols, chunksize=chunk_rows):
+        yield _compact(chunk, dtypes, date_format)
+
+
+@instrument
+def memory_usage(data, naive=False):
+    """
+    Returns the memory used by data in bytes
+
+    Args:
+        data: data frame
+        naive: estimate the usage with numeric columns as 64 bit
+    Returns:
+        number of bytes
+    """
+    usage = data.memory_usage(deep=True)
+    if naive:
+        for c in data.columns:
+            if data[c].dtype.kind in "biuf":
+                usage[c] = 8 * len(data)
+    return int(usage.sum())
+
+
+@instrument
+def load_structured_data(filename, variables, columns=None,
+                         date_format=DATE_FORMAT, verbose=False,
+                         sparse=False, chunk_rows=100000, workers=1):
+    """
+    Loads the structured export with compact column types
+
+    With columns only what the analysis needs is read, e.g.
+    columns=["age", "gender"] for a cross table of the two categories.
+    With sparse the file is read in chunks of chunk_rows rows and the
+    variable columns are stored in a sparse matrix, see
+    meerkat_analysis.sparse.SparseData.
+    Location columns get the smallest unsigned integer type of the whole
+    file. The memory usage before (as with a plain read_csv and fillna)
+    and after is stored in data.attrs["memory_usage"].
+
+    Args:
+        filename: name of csv file
+        variables: Variables class
+        columns: variable ids, names, categories or indicator definitions
+        date_format: format of the date column
+        verbose: print the memory usage
+        sparse: return SparseData
+        chunk_rows: number of rows per chunk when sparse
+        workers: parse with read_csv_parallel using this many threads
+    Returns:
+        data frame or SparseData
+    """
+    if sparse:
+        return _load_sparse(filename, variables, columns, date_format,
+                            verbose, chunk_rows)
+    if workers != 1:
+        data = read_csv_parallel(filename, variables, columns=columns,
+                                 workers=workers, date_format=date_format)
+    else:
+        data = downcast_locations(read_structured_csv(
+            filename, variables, columns=columns, date_format=date_format))
+    _report_memory(data, memory_usage(data, naive=True), memory_usage(data),
+                   verbose)
+    return data
+
+
+def _report_memory(data, before, after, verbose):
+    """
+    Stores the memory usage in data.attrs and optionally prints it
+    """
+    data.attrs["memory_usage"] = {"before": before, "after": after}
+    if verbose:
+        print("Memory usage: {before:.1f} MB before, {after:.1f} MB after".format(
+            before=before / 1e6, after=after / 1e6))
+
+
+def _load_sparse(filename, variables, columns, date_format, verbose,
+                 chunk_rows):
+    """
+    Loads the structured export as SparseData
+    """
+    from ..sparse import SparseData
+    parts = []
+    naive = 0
+    for chunk in iter_structured_csv(filename, variables, columns=columns,
+                                     chunk_rows=chunk_rows,
+                                     date_format=date_format):
+        naive += memory_usage(chunk, naive=True)
+        variable_columns = [c for c in chunk.columns
+                            if c in variables.variables]
+        parts.append(SparseData.from_frame(chunk, variable_columns))
+    data = SparseData.concat(parts)
+    _report_memory(data, naive, data.memory_usage(), verbose)
+    return data
+
+
+def structured_chunk_parser(variables, date_format=DATE_FORMAT):
+    """
+    Returns a parse_chunk function for download_and_parse that builds
+    compact typed chunks
+
+    Args:
+        variables: Variables class
+        date_format: format of the date column
+    """
+    date_cache = {}
+
+    def parse_chunk(header, rows):
+        return read_structured_csv(header + b"\n" + b"\n".join(rows),
+                                   variables, date_format=date_format,
+                                   date_cache=date_cache)
+    return parse_chunk
@@ -0,0 +1,196 @@
+import json
+import uuid
+import struct
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+from ..profiling import instrument
+
+ALIGNMENT = 64
+LEVELS = ["country", "region", "district", "clinic"]
+
+
+def _attach_segment(name):
+    """
+    Attaches to an existing shared memory segment without registering it
+    with the resource tracker, so a worker exiting does not remove it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+@instrument
+def location_arrays(locations):
+    """
+    Returns the location hierarchy as arrays sorted by location id
+
+    Args:
+        locations: Locations class
+    Returns:
+        dictionary with id, parent, level (index in LEVELS),
+        population and case_report arrays
+    """
+    locs = sorted(locations.locations.values(), key=lambda l: int(l["id"]))
+    return {"id": np.array([int(l["id"]) for l in locs], dtype=np.int64),
+            "parent": np.array([int(l["parent_location"] or 0)
+                                for l in locs], dtype=np.int64),
+            "level": np.array([LEVELS.index(l["level"])
+                               if l["level"] in LEVELS else -1
+                               for l in locs], dtype=np.int8),
+            "population": np.array([l.get("population") or 0
+                                    for l in locs], dtype=np.float64),
+            "case_report": np.array([l.get("case_report") or 0
+                                     for l in locs], dtype=np.int8)}
+
+
+class SharedDataset:
+    """
+    A prepared dataset in shared memory
+
+    The owner publishes the data once and worker processes attach to it by
+    name and get read-only numpy and pandas views without copying. The
+    data frame holds the numeric columns, integer location codes and
+    dates as datetime64; object and categorical columns are stored as
+    integer codes. Analysis functions accept the dataset directly.
+
+    """
+
+    def __init__(self, name, segments, manifest, owner=False):
+        """
+        Initialises the class, use publish or attach
+
+        Args:
+            name: name of the dataset
+            segments: (data, meta) shared memory segments
+            manifest: the dataset manifest
+            owner: True in the publishing process
+        """
+        from . import Variables, Locations
+        self.name = name
+        self.owner = owner
+        self._segments = segments
+        self._manifest = manifest
+        buffer = segments[0].buf
+        columns = {}
+        for entry in manifest["columns"]:
+            values = self._view(buffer, entry)
+            if "categories" in entry:
+                values = pd.Categorical.from_codes(values,
+                                                   entry["categories"])
+            columns[entry["name"]] = values
+        self.data = pd.DataFrame(columns, copy=False)
+        self.location_arrays = {e["name"]: self._view(buffer, e)
+                                for e in manifest["locations_arrays"]}
+        self.variables = None
+        self.locations = None
+        if manifest["variables"] is not None:
+            self.variables = Variables(manifest["variables"])
+        if manifest["locations"] is not None:
+            self.locations = Locations(manifest["locations"])
+
+    @staticmethod
+    def _view(buffer, entry):
+        values = np.ndarray((entry["length"],), dtype=np.dtype(entry["dtype"]),
+                            buffer=buffer, offset=entry["offset"])
+        values.flags.writeable = False
+        return values
+
+    @classmethod
+    def publish(cls, data, variables=None, locations=None, name=None):
+        """
+        Copies data, variables and locations into shared memory
+
+        Args:
+            data: data frame
+            variables: Variables class
+            locations: Locations class
+            name: name of the dataset, generated if None
+        Returns:
+            SharedDataset owning the shared memory
+        """
+        if name is None:
+            name = "meerkat_" + uuid.uuid4().hex[:12]
+        arrays = []
+        manifest = {"columns": [], "locations_arrays": [],
+                    "variables": variables.variables if variables else None,
+                    "locations": locations.locations if locations else None}
+        for column in data.columns:
+            values = data[column]
+            entry = {"name": column}
+            if values.dtype == object or isinstance(values.dtype,
+                                                     pd.CategoricalDtype):
+                codes, categories = pd.factorize(values)
+                entry["categories"] = pd.Index(categories).tolist()
+                values = codes
+            manifest["columns"].append(entry)
+            arrays.append((entry, np.asarray(values)))
+        if locations is not None:
+            for key, values in location_arrays(locations).items():
+                entry = {"name": key}
+                manifest["locations_arrays"].append(entry)
+                arrays.append((entry, values))
+        offset = 0
+        for entry, values in arrays:
+            entry.update({"offset": offset, "length": len(values),
+                          "dtype": values.dtype.str})
+            offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+        segment = shared_memory.SharedMemory(name=name, create=True,
+                                             size=max(offset, 1))
+        for entry, values in arrays:
+            target = np.ndarray(values.shape, dtype=values.dtype,
+                                buffer=segment.buf, offset=entry["offset"])
+            target[:] = values
+        meta = json.dumps(manifest, default=str).encode("utf-8")
+        meta_segment = shared_memory.SharedMemory(name=name + "_meta",
+                                                  create=True,
+                                                  size=len(meta) + 8)
+        meta_segment.buf[:8] = struct.pack("<q", len(meta))
+        meta_segment.buf[8:8 + len(meta)] = meta
+        return cls(name, (segment, meta_segment), manifest, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attaches to a published dataset
+
+        Args:
+            name: name of the dataset
+        Returns:
+            SharedDataset with read-only views
+        """
+        meta_segment = _attach_segment(name + "_meta")
+        length = struct.unpack("<q", bytes(meta_segment.buf[:8]))[0]
+        manifest = json.loads(bytes(meta_segment.buf[8:8 + length]))
+        segment = _attach_segment(name)
+        return cls(name, (segment, meta_segment), manifest)
+
+    def analysis_data(self):
+        """
+        Returns the data frame used by the analysis functions
+        """
+        return self.data
+
+    def close(self):
+        """
+        Releases the views in this process and removes the shared memory
+        if this process published it
+        """
+        self.data = None
+        self.location_arrays = None
+        for segment in self._segments:
+            try:
+                segment.close()
+            except BufferError:
+                # Views are still referenced elsewhere, the mapping is
+                # released when they are freed
+                pass
+            if self.owner:
+                segment.unlink()